@@ -6,23 +6,27 @@ Run connected components analysis to get rid of small bits of oversegmentation.
 import os
 
 from skimage.io import imread
-from tqdm import tqdm
 
 from src.connected_components import keep_regions_over_threshold
-from src.image_processing import save_image
+from src.executor import run_items
+from src.image_processing import save_image, get_image_bytes
 from src.helpers import sizenm_to_dpum
 
 
-def remove_small_regions(images_dir, model_size_xy_nm, model_size_z_nm):
+def remove_stack_small_regions(image_file_path, resxy, size_z_um, res_unit, codec=None):
+    image_stack = imread(image_file_path)
+    image_stack = keep_regions_over_threshold(image_stack)
+
+    save_image(image_file_path, image_stack,
+               resx=resxy, resy=resxy, size_z=size_z_um, res_unit=res_unit, compress=True, codec=codec)
+
+
+def remove_small_regions(images_dir, model_size_xy_nm, model_size_z_nm, codec=None):
     resxy = sizenm_to_dpum(model_size_xy_nm)
     size_z_um = model_size_z_nm / 1000
     res_unit = "micron"
 
-    for image_stack_filename in tqdm(os.listdir(images_dir)):
-        image_file_path = os.path.join(images_dir, image_stack_filename)
-        image_stack = imread(image_file_path)
-        image_stack = keep_regions_over_threshold(image_stack)
-
-        save_image(image_file_path, image_stack,
-                   resx=resxy, resy=resxy, size_z=size_z_um, res_unit=res_unit, compress=True)
-
+    image_file_paths = [os.path.join(images_dir, image_stack_filename) for image_stack_filename in os.listdir(images_dir)]
+    # labelling holds the stack, its binary copy and an int64 label per voxel, about 4 times a float32 stack
+    run_items(remove_stack_small_regions, image_file_paths, (resxy, size_z_um, res_unit, codec),
+              item_size=lambda image_file_path: 4 * get_image_bytes(image_file_path), unit=' stacks')
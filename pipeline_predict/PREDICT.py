@@ -9,10 +9,11 @@ import json
 from src.ml.DataLoader import DataLoader
 from src.ml.model import load_latest_model
 from src.ml.model_predict import model_predict
+from src.image_codecs import get_stage_codec
 
 
 def predict(params, images_dir, predictions_dir, model_dir, aggregation_method, model_size_xy_nm, model_size_z_nm,
-            model_name=None, clear_existing=False, tri_axis=False):
+            model_name=None, clear_existing=False, tri_axis=False, codec=None):
     if clear_existing and os.path.exists(predictions_dir):
         shutil.rmtree(predictions_dir)
     if not os.path.exists(predictions_dir):
@@ -24,7 +25,8 @@ def predict(params, images_dir, predictions_dir, model_dir, aggregation_method,
     else:
         model, epoch = load_latest_model(model_name)
     if epoch != 0:
-        model_predict(model, images_dir, predictions_dir, model_size_xy_nm, model_size_z_nm, tri_axis=tri_axis)
+        model_predict(model, images_dir, predictions_dir, model_size_xy_nm, model_size_z_nm, tri_axis=tri_axis,
+                      codec=codec)
     else:
         raise Exception("Model load error")
 
@@ -55,4 +57,4 @@ if __name__ == '__main__':
     aggregation_method = params['aggregation_method']
 
     predict(params, images_dir, predictions_dir, model_dir, aggregation_method,
-            model_size_xy_nm, model_size_z_nm, tri_axis=tri_axis)
+            model_size_xy_nm, model_size_z_nm, tri_axis=tri_axis, codec=get_stage_codec(params, 'predict'))
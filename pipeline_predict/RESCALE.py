@@ -5,53 +5,61 @@ import os
 import shutil
 import json
 import argparse
-from tqdm import tqdm
 
-from src.helpers import get_file, dpum_to_sizenm
-from src.image_processing import scale_save_image, get_tag_resolution, get_tag_imagesize
+from src.executor import run_items
+from src.helpers import dpum_to_sizenm
+from src.image_processing import scale_save_image, find_file, get_resolution, get_image_size, get_image_bytes
 
 
-def rescale(source_dir, target_dir, ref_dir, sourcesize_nm_xy0, targetsize_nm_xy0, targetsize_nm_z, clear_existing=False, binary_format=False, compress=False):
+def rescale_file(file, source_dir, target_dir, ref_dir, sourcesize_nm_xy0, targetsize_nm_xy0, binary_format=False,
+                 compress=False, codec=None):
+    filename, ext = os.path.splitext(file)
+    sourcesize_nm_xy = sourcesize_nm_xy0
+    targetsize_nm_xy = targetsize_nm_xy0
+
+    # use source image resolution (assume pixes / micron)
+    if not sourcesize_nm_xy:
+        filename_source = os.path.join(source_dir, file)
+        resx, resy, size_z, res_unit = get_resolution(filename_source)
+        if resx:
+            sourcesize_nm_xy = dpum_to_sizenm(resx)
+        else:
+            print("Rescale error: no source resolution for: " + filename_source)
+
+    if not targetsize_nm_xy:
+        filename_source = os.path.join(source_dir, file)
+        swidth, sheight = get_image_size(filename_source)
+        filename_dest = os.path.join(ref_dir, filename) + ".*"
+        dwidth, dheight = get_image_size(find_file(filename_dest))
+        if swidth and dwidth:
+            targetsize_nm_xy = sourcesize_nm_xy * (swidth / dwidth + sheight / dheight) / 2
+        else:
+            print("Rescale error: no destination size for: " + filename_dest)
+
+    if sourcesize_nm_xy and targetsize_nm_xy:
+        scale_xy = sourcesize_nm_xy / targetsize_nm_xy
+    else:
+        scale_xy = 1
+
+    # TODO: if z scale is not target z scale, resample images in z direction
+    # scale_z = sourcesize_nm_z / targetsize_nm_z
+    scale_z = 1
+
+    if scale_xy:
+        scale_save_image(source_dir, target_dir, filename, scale_xy, scale_z, binary_format=binary_format, compress=compress,
+                         codec=codec)
+
+
+def rescale(source_dir, target_dir, ref_dir, sourcesize_nm_xy0, targetsize_nm_xy0, targetsize_nm_z, clear_existing=False, binary_format=False, compress=False,
+            codec=None):
     if clear_existing and os.path.exists(target_dir):
         shutil.rmtree(target_dir)
     if not os.path.exists(target_dir):
         os.makedirs(target_dir)
 
-    for file in tqdm(os.listdir(source_dir)):
-        filename, ext = os.path.splitext(file)
-        sourcesize_nm_xy = sourcesize_nm_xy0
-        targetsize_nm_xy = targetsize_nm_xy0
-
-        # use source image resolution (assume pixes / micron)
-        if not sourcesize_nm_xy:
-            filename_source = os.path.join(source_dir, file)
-            resx, resy, size_z, res_unit = get_tag_resolution(filename_source)
-            if resx:
-                sourcesize_nm_xy = dpum_to_sizenm(resx)
-            else:
-                print("Rescale error: no source resolution for: " + filename_source)
-
-        if not targetsize_nm_xy:
-            filename_source = os.path.join(source_dir, file)
-            swidth, sheight = get_tag_imagesize(filename_source)
-            filename_dest = os.path.join(ref_dir, filename) + ".*"
-            dwidth, dheight = get_tag_imagesize(get_file(filename_dest))
-            if swidth and dwidth:
-                targetsize_nm_xy = sourcesize_nm_xy * (swidth / dwidth + sheight / dheight) / 2
-            else:
-                print("Rescale error: no destination size for: " + filename_dest)
-
-        if sourcesize_nm_xy and targetsize_nm_xy:
-            scale_xy = sourcesize_nm_xy / targetsize_nm_xy
-        else:
-            scale_xy = 1
-
-        # TODO: if z scale is not target z scale, resample images in z direction
-        # scale_z = sourcesize_nm_z / targetsize_nm_z
-        scale_z = 1
-
-        if scale_xy:
-            scale_save_image(source_dir, target_dir, filename, scale_xy, scale_z, binary_format=binary_format, compress=compress)
+    run_items(rescale_file, os.listdir(source_dir),
+              (source_dir, target_dir, ref_dir, sourcesize_nm_xy0, targetsize_nm_xy0, binary_format, compress, codec),
+              item_size=lambda file: get_image_bytes(os.path.join(source_dir, file)), unit=' stacks')
 
 
 if __name__ == '__main__':
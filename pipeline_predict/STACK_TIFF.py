@@ -8,13 +8,13 @@ from src.image_processing import stack_images
 from src.param_parser import parse_params
 
 
-def create_tiff_stack(images_dir, stacks_dir, size_z, clear_existing=False, compress=False):
+def create_tiff_stack(images_dir, stacks_dir, size_z, clear_existing=False, compress=False, codec=None):
     if clear_existing and os.path.exists(stacks_dir):
         shutil.rmtree(stacks_dir)
     if not os.path.exists(stacks_dir):
         os.makedirs(stacks_dir)
 
-    return stack_images(images_dir, stacks_dir, size_z, compress=compress)
+    return stack_images(images_dir, stacks_dir, size_z, compress=compress, codec=codec)
 
 
 if __name__ == '__main__':
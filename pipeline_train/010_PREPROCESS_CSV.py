@@ -4,11 +4,15 @@
 The Zooniverse web system for producing machine learning annotations has a CSV output format. These
 CSVs can be very large and include a good deal of data which is not relevant for training a model.
 This file breaks the raw CSV down in to smaller CSVs on a per image basis, so that they easily fit
-in memory. It also filters data unnecessary for training.
+in memory. It also filters data unnecessary for training. Finally the annotations of every slice are
+collected in to a single columnar annotation store, which is what the later steps read, and indexed
+in a slice catalog for the steps which only need counts, resolutions or the nearest annotated slice.
 """
 import os
+from src.annotation_store import build_annotation_store, update_annotation_store
 from src.param_parser import parse_params
-from src.zooniverse import ZooniverseCSVParser
+from src.slice_catalog import build_slice_catalog, update_slice_catalog
+from src.zooniverse import ZooniverseCSVParser, CLASSIFICATIONS_FILENAME
 
 
 # problem if annotation has deviant resolution - a slice can only have one resolution
@@ -16,14 +20,32 @@ from src.zooniverse import ZooniverseCSVParser
 # TODO: handle these types of errors
 
 
-def preprocess_zooniverse_csv(output_dir, input_path, workflow):
+def preprocess_zooniverse_csv(output_dir, input_path, workflow, store_dir, catalog_path, workers=1, incremental=False):
     zoon_parser = ZooniverseCSVParser(output_dir=output_dir, workflow=workflow)
-    zoon_parser.convert(zooniverse_csv_path=input_path)
+    zoon_parser.convert(zooniverse_csv_path=input_path, workers=workers, incremental=incremental)
 
     print('Finished converting Zooniverse csv...')
     print(f'Total processed rows in workflow (including failures): {zoon_parser.processed}')
     print(f'Missing reference image failures: {zoon_parser.errors["missing_ref_image"]}')
     print(f'Invalid (annotation) format failures: {zoon_parser.errors["invalid_format"]}')
+    print(f'Subject data cache hits/misses: {zoon_parser.subject_cache["hits"]}/{zoon_parser.subject_cache["misses"]}')
+    print(f'Slices changed: {len(zoon_parser.changed_slices)} (ingested up to classification id {zoon_parser.watermark})')
+
+    classifications_csv_path = os.path.join(output_dir, CLASSIFICATIONS_FILENAME + '.csv')
+    # an incremental conversion (which had an earlier run to continue from) only changes the slices it lists
+    if incremental and zoon_parser.ingested_watermark >= 0:
+        changed_filenames = [filename for _, _, filename in zoon_parser.changed_slices]
+        print(f'Updating annotation store and slice catalog with {len(changed_filenames)} changed slices...')
+        nslices = update_annotation_store(output_dir, store_dir, changed_filenames)
+        update_slice_catalog(store_dir, classifications_csv_path, catalog_path, changed_filenames)
+        print(f'Slices in annotation store: {nslices}')
+    else:
+        print('Building annotation store...')
+        nslices = build_annotation_store(output_dir, store_dir)
+        print(f'Slices in annotation store: {nslices}')
+
+        print('Building slice catalog...')
+        build_slice_catalog(store_dir, classifications_csv_path, catalog_path)
 
 
 if __name__ == '__main__':
@@ -31,8 +53,13 @@ if __name__ == '__main__':
 
     csv_input_path = os.path.join('..', params['zooniverse_csv_file'])
     csv_output_dir = os.path.join('..', params['processed_csv_dir'])
+    annotation_store_dir = os.path.join('..', params['annotation_store_dir'])
+    slice_catalog_path = os.path.join('..', params['slice_catalog_path'])
 
     zooniverse_workflow = params['zooniverse_workflow']
+    workers = params['workers']
+    incremental = params['incremental_ingest']
 
-    preprocess_zooniverse_csv(csv_output_dir, csv_input_path, zooniverse_workflow)
+    preprocess_zooniverse_csv(csv_output_dir, csv_input_path, zooniverse_workflow, annotation_store_dir,
+                              slice_catalog_path, workers=workers, incremental=incremental)
 
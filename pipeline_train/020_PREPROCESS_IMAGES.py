@@ -7,15 +7,17 @@ containing it.
 """
 import os
 
+from src.image_codecs import get_stage_codec
 from src.image_processing import unstack_images
 from src.param_parser import parse_params
 
 
-def unstack(rawimage_dir, rawimagestack_dir, output_extension=".tiff", add_prefix_z=True, z_index_offset=0):
+def unstack(rawimage_dir, rawimagestack_dir, output_extension=".tiff", add_prefix_z=True, z_index_offset=0, codec=None):
     if not os.path.exists(rawimage_dir):
         os.makedirs(rawimage_dir)
 
-    nprocessed = unstack_images(rawimage_dir, rawimagestack_dir, output_extension, add_prefix_z, z_index_offset)
+    nprocessed = unstack_images(rawimage_dir, rawimagestack_dir, output_extension, add_prefix_z, z_index_offset,
+                                codec=codec)
 
     print(f'Processed image stacks: {nprocessed}')
     print('Finished processing images...')
@@ -28,4 +30,5 @@ if __name__ == '__main__':
     images_raw_stack_dir = os.path.join('..', params['images_raw_stack_dir'])
     ref_image_z_offset = params['ref_images']['z_offset']
 
-    unstack(images_raw_dir, images_raw_stack_dir, z_index_offset=ref_image_z_offset)
+    unstack(images_raw_dir, images_raw_stack_dir, z_index_offset=ref_image_z_offset,
+            codec=get_stage_codec(params, 'unstack'))
@@ -8,18 +8,21 @@ as to where in the image the feature of interest (for example nuclear membrane)
 """
 import os
 import numpy as np
-from skimage.io import imread
 from tqdm import tqdm
 import shutil
 
-from src.helpers import load_processed_csv, dpum_to_sizenm
-from src.image_processing import get_tag_resolution, save_image
-from src.interiors_probability import do_interiors_contours, get_annotation_points
+from src.annotation_store import AnnotationStore
+from src.contour_store import get_contours_path, save_contours
+from src.helpers import dpum_to_sizenm
+from src.image_codecs import get_stage_codec
+from src.image_processing import find_file, get_image_info, get_resolution, save_image, to_binary
+from src.interiors_probability import get_consensus_contours, get_interiors_counts, draw_contours2, MIN_BORDER_WIDTH
 from src.param_parser import parse_params
-from src.helpers import get_file
+from src.probability import probabilistic_aggregate_counts
+from src.slice_catalog import SliceCatalog, get_xy_scale
 
 
-def save_aggregations(output_filepath, aggregations, res_info):
+def save_aggregations(output_filepath, aggregations, res_info, codec=None):
     """
     Convert image matrix to 32 bit and save.
     """
@@ -30,35 +33,57 @@ def save_aggregations(output_filepath, aggregations, res_info):
 
             aggregation = aggregation.astype(np.float32)
             save_image(savepath, aggregation, resx=res_info[0], resy=res_info[1], size_z=res_info[2], res_unit=res_info[3],
-                       compress=True)
+                       compress=True, codec=codec)
     else:
         aggregations = aggregations.astype(np.float32)
         save_image(output_filepath, aggregations, resx=res_info[0], resy=res_info[1], size_z=res_info[2], res_unit=res_info[3],
-                   compress=True)
+                   compress=True, codec=codec)
 
 
-def aggregate(csv_dir, ref_images_dir, output_dir, border_width_nm, output_extension='.tiff',
-              method='probability', clear_existing=False, zoom_factor=1, correct_width=2000, correct_height=2000):
-    if clear_existing and os.path.exists(output_dir):
-        shutil.rmtree(output_dir)
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+def aggregate(annotation_store_dir, ref_images_dir, output_dir, border_width_nm, output_extension='.tiff',
+              method='probability', clear_existing=False, zoom_factor=1, correct_width=2000, correct_height=2000,
+              slices=None, codec=None, target_xy_nm=None, slice_catalog_path=None, contours_dir=None):
+    """
+    slices: only aggregate these slices (e.g. the ones changed by an incremental ingest), replacing any existing output
+    method: 'interiors-contours', the contour of the consensus interior drawn border_width_nm wide, or 'probability',
+    the probability (see probability.probabilistic_aggregate_counts) of each pixel being inside the annotations
+    codec: image_codecs spec to save the aggregations with (zlib level 6 by default)
+    target_xy_nm: aggregate straight at the pixel size step 040 scales the slices to, rather than at the resolution of
+    the reference images, and save binary labels the same size as 040's, so that the labels don't need downscaling.
+    The scale of each slice comes from the slice catalog at slice_catalog_path, as in 040.
+    contours_dir: also save the consensus contours of each slice here (see contour_store), which labels of another
+    border width or resolution can be drawn from without aggregating again
+    """
+    for aggregations_dir in (output_dir, contours_dir):
+        if aggregations_dir is None:
+            continue
+        if clear_existing and os.path.exists(aggregations_dir):
+            shutil.rmtree(aggregations_dir)
+        if not os.path.exists(aggregations_dir):
+            os.makedirs(aggregations_dir)
+
+    annotation_store = AnnotationStore(annotation_store_dir)
+    slice_catalog = SliceCatalog(slice_catalog_path) if target_xy_nm else None
 
     missing_ref_images = 0
-    for csv in tqdm(os.listdir(csv_dir)):
-        data_frame = load_processed_csv(csv_dir + csv)
-        filename, _ = os.path.splitext(csv)
-        input_filepath = get_file(os.path.join(ref_images_dir, filename+".*"))
+    missing_resolutions = 0
+    filenames = annotation_store.keys() if slices is None else [f for f in slices if f in annotation_store]
+    for filename in tqdm(filenames):
+        input_filepath = find_file(os.path.join(ref_images_dir, filename+".*"))
         output_filepath = os.path.join(output_dir, filename + output_extension)
+        # only interiors-contours has contours to save
+        contours_path = get_contours_path(contours_dir, filename) \
+            if contours_dir and method == 'interiors-contours' else None
         # avoid having to redo aggregations that are already done - delete dir if really need to restart
-        if not os.path.exists(output_filepath):
+        if slices is not None or not os.path.exists(output_filepath) \
+                or (contours_path and not os.path.exists(contours_path)):
             if not input_filepath:
                 missing_ref_images += 1
             else:
-                ref_image = imread(input_filepath)
-                height, width = ref_image.shape
+                # only the size and resolution of the reference image are needed, from the artifact catalog
+                height, width = get_image_info(input_filepath)[0]
 
-                res_info = get_tag_resolution(input_filepath)
+                res_info = get_resolution(input_filepath)
                 size_nm = dpum_to_sizenm(res_info[0])
                 border_width = round(border_width_nm / size_nm)
 
@@ -70,30 +95,71 @@ def aggregate(csv_dir, ref_images_dir, output_dir, border_width_nm, output_exten
                     zoom_factor_x = zoom_factor
                     zoom_factor_y = zoom_factor
 
-                # input: 'data_frame': csv annotations
+                offset_x = offset_y = 0
+                ref_shape = (height, width)
+                frame_scale = 1
+                if target_xy_nm:
+                    scale_xy = get_xy_scale(slice_catalog, filename, target_xy_nm)
+                    if scale_xy == 0:
+                        missing_resolutions += 1
+                        continue
+                    # the size 040 scales the slice to, and the scale it actually resizes by along each axis
+                    scaled_width = int(width * scale_xy + 0.5)
+                    scaled_height = int(height * scale_xy + 0.5)
+                    scale_x = scaled_width / width
+                    scale_y = scaled_height / height
+                    # points are mapped pixel centre to pixel centre as the resize does, (x + 0.5) * scale - 0.5, plus
+                    # 0.5 so that rasterizing, which truncates the points, rounds them to the nearest target pixel
+                    zoom_factor_x *= scale_x
+                    zoom_factor_y *= scale_y
+                    offset_x = 0.5 * scale_x
+                    offset_y = 0.5 * scale_y
+                    width, height = scaled_width, scaled_height
+                    res_info = (res_info[0] * scale_xy, res_info[1] * scale_xy) + tuple(res_info[2:])
+                    border_width = max(round(border_width_nm * scale_xy / size_nm), MIN_BORDER_WIDTH)
+                    frame_scale = scale_xy
+
+                # input: slice annotations from the store
                 # output: 'aggregation': (image) matrix
                 if method == 'interiors-contours':
-                    annotations = get_annotation_points(data_frame, zoom_factor_x, zoom_factor_y)
-                    aggregation = do_interiors_contours(annotations,
-                                                        width=width,
-                                                        height=height,
-                                                        border_width=border_width)
+                    annotations = annotation_store.get_annotation_points(filename, zoom_factor_x, zoom_factor_y,
+                                                                         offset_x, offset_y)
+                    contours = get_consensus_contours(annotations, width=width, height=height)
+                    aggregation = draw_contours2(contours, width=width, height=height, border_width=border_width)
+                    if contours_path:
+                        save_contours(contours_path, contours, (height, width), res_info, ref_shape=ref_shape,
+                                      scale_xy=frame_scale)
+                elif method == 'probability':
+                    # the occupancy of the annotation interiors is counted one annotation at a time, rather than
+                    # stacking a matrix per annotation
+                    annotations = annotation_store.get_annotation_points(filename, zoom_factor_x, zoom_factor_y,
+                                                                         offset_x, offset_y)
+                    counts = get_interiors_counts(annotations, width=width, height=height)
+                    aggregation = probabilistic_aggregate_counts(counts, len(annotations), threshold='otsu')
                 else:
                     raise ValueError(f'Invalid aggregation method: \'{method}\'.')
 
                 #illustrate_draw_annotations(output_dir + "/..", annotations, width, height, border_width, True)
                 #illustrate_area_annotations(output_dir + "/..", annotations, width, height)
 
-                save_aggregations(output_filepath, aggregation, res_info)
+                if target_xy_nm:
+                    # the binary labels 040 makes of the downscaled aggregations
+                    aggregation = to_binary(aggregation)
+
+                save_aggregations(output_filepath, aggregation, res_info, codec=codec)
     print(f"Aggregation failures because of a missing reference image: {missing_ref_images}")
+    if slice_catalog is not None:
+        slice_catalog.close()
+        print(f"Aggregation failures because of a missing slice resolution: {missing_resolutions}")
 
 
 if __name__ == '__main__':
     params = parse_params("Run step 030 to aggregate citizen science annotations.")
 
-    csv_dir = os.path.join('..', params['processed_csv_dir'])
+    annotation_store_dir = os.path.join('..', params['annotation_store_dir'])
     ref_images_dir = os.path.join('..', params['images_raw_dir'])
     labels_dir = os.path.join('..', params['images_raw_labels_dir'])
+    contours_dir = os.path.join('..', params['images_raw_contours_dir'])
 
     ref_image_zoom = params['ref_images']['zoom_factor']
     ref_image_target_width = params['ref_images']['target_width']
@@ -102,5 +168,6 @@ if __name__ == '__main__':
     aggregation_method = params['aggregation_method']
     border_width_nm = params['border_width_nm']
 
-    aggregate(csv_dir, ref_images_dir, labels_dir, border_width_nm=border_width_nm, method=aggregation_method,
-              zoom_factor=ref_image_zoom, correct_width=ref_image_target_width, correct_height=ref_image_target_height)
+    aggregate(annotation_store_dir, ref_images_dir, labels_dir, border_width_nm=border_width_nm, method=aggregation_method,
+              zoom_factor=ref_image_zoom, correct_width=ref_image_target_width, correct_height=ref_image_target_height,
+              codec=get_stage_codec(params, 'aggregate'), contours_dir=contours_dir)
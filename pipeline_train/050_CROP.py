@@ -10,8 +10,7 @@ as best as possible those parts from the training data.
 import os
 import shutil
 
-from tqdm import tqdm
-
+from src.executor import run_items
 from src.param_parser import parse_params
 from src.cropping import get_rois, crop_roi
 
@@ -30,9 +29,8 @@ def do_crops(image_folder, label_folder, cropped_image_folder, cropped_label_fol
 
     rois = get_rois(label_folder)
 
-    for roi in tqdm(rois):
-        crop_roi(roi, image_folder, label_folder, cropped_image_folder, cropped_label_folder,
-                 padding, patch_size)
+    run_items(crop_roi, rois, (image_folder, label_folder, cropped_image_folder, cropped_label_folder, padding, patch_size),
+              unit=' rois')
 
 
 if __name__ == '__main__':
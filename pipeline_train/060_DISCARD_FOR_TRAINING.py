@@ -9,11 +9,13 @@ import os
 
 from tqdm import tqdm
 
-from src.helpers import get_file, load_processed_csv
+from src.executor import run_items
+from src.helpers import get_file
 from src.param_parser import parse_params
+from src.slice_catalog import SliceCatalog
 
 
-def check_annotations(csv_dir, ref_images_dir, labels_dir, min_annotations=5):
+def check_annotations(slice_catalog_path, ref_images_dir, labels_dir, min_annotations=5):
     non_labelled = 0
     # simple file discard
     for filename in tqdm(os.listdir(ref_images_dir)):
@@ -25,53 +27,58 @@ def check_annotations(csv_dir, ref_images_dir, labels_dir, min_annotations=5):
 
     low_annotations = 0
     # check number of annotations
-    for csv in tqdm(os.listdir(csv_dir)):
-        data_frame = load_processed_csv(csv_dir + csv)
-        if len(data_frame) < min_annotations:
+    slice_catalog = SliceCatalog(slice_catalog_path)
+    for filename in tqdm(slice_catalog.keys()):
+        if slice_catalog.count_annotations(filename) < min_annotations:
             low_annotations += 1
 
     print(f"images with low annotations: {low_annotations}")
 
 
-def discard_ref_images(csv_dir, ref_images_dir, labels_dir, min_annotations=5):
-    ndiscarded = 0
-    # simple file discard
+def discard_unlabelled(filename, ref_images_dir, labels_dir):
+    image_filepath = ref_images_dir + filename
+    label_filepath = labels_dir + filename
+    if not os.path.exists(label_filepath):
+        os.remove(image_filepath)
+        return True
+    return False
+
+
+def discard_slice(filename, ref_images_dir, labels_dir):
+    image_filepath = get_file(ref_images_dir + filename + ".*")
+    label_filepath = get_file(labels_dir + filename + ".*")
+
+    if os.path.exists(image_filepath):
+        os.remove(image_filepath)
+    if os.path.exists(label_filepath):
+        os.remove(label_filepath)
+
+
+def discard_ref_images(slice_catalog_path, ref_images_dir, labels_dir, min_annotations=5):
+    # simple file discard, which only checks and removes files, so is run on the i/o threads
     print("Discarding non labelled source images")
-    for filename in tqdm(os.listdir(ref_images_dir)):
-        image_filepath = ref_images_dir + filename
-        label_filepath = labels_dir + filename
-        if not os.path.exists(label_filepath):
-            os.remove(image_filepath)
-            ndiscarded += 1
+    ndiscarded = sum(run_items(discard_unlabelled, os.listdir(ref_images_dir), (ref_images_dir, labels_dir), io=True))
 
     print(f'Discarded images: {ndiscarded}')
 
-    ndiscarded = 0
     # check number of annotations
     print("Discarding images with low annotations")
-    for csv in tqdm(os.listdir(csv_dir)):
-        data_frame = load_processed_csv(csv_dir + csv)
-        filename, _ = os.path.splitext(csv)
-        image_filepath = get_file(ref_images_dir + filename + ".*")
-        label_filepath = get_file(labels_dir + filename + ".*")
-
-        if len(data_frame) < min_annotations:
-            if os.path.exists(image_filepath):
-                os.remove(image_filepath)
-            if os.path.exists(label_filepath):
-                os.remove(label_filepath)
-            ndiscarded += 1
+    slice_catalog = SliceCatalog(slice_catalog_path)
+    low_annotations = [filename for filename in slice_catalog.keys()
+                       if slice_catalog.count_annotations(filename) < min_annotations]
+    slice_catalog.close()
+    run_items(discard_slice, low_annotations, (ref_images_dir, labels_dir), io=True)
 
-    print(f'Discarded images: {ndiscarded}')
+    print(f'Discarded images: {len(low_annotations)}')
 
 
 if __name__ == '__main__':
     params = parse_params("Run step 060 to remove slices with very few annotations.")
 
-    processed_csv_dir = os.path.join('..', params['processed_csv_dir'])
+    slice_catalog_path = os.path.join('..', params['slice_catalog_path'])
     cropped_images_dir = os.path.join('..', params['cropped_images_dir'])
     cropped_labels_dir = os.path.join('..', params['cropped_labels_dir'])
 
-    #check_annotations(processed_csv_dir, cropped_images_dir, cropped_labels_dir)
-    #discard_ref_images(processed_csv_dir, cropped_images_dir, cropped_labels_dir)
-    discard_ref_images(processed_csv_dir, "../projects/nuclear/resources/images/raw/", "../projects/nuclear/resources/images/raw-labels/")
+    #check_annotations(slice_catalog_path, cropped_images_dir, cropped_labels_dir)
+    #discard_ref_images(slice_catalog_path, cropped_images_dir, cropped_labels_dir)
+    discard_ref_images(slice_catalog_path, "../projects/nuclear/resources/images/raw/", "../projects/nuclear/resources/images/raw-labels/")
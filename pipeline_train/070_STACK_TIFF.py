@@ -7,16 +7,66 @@ input, so it is convenient to be able to load stacks rather than individual imag
 import os
 import shutil
 
-import numpy as np
-from skimage.io import imread, imsave
-from tqdm import tqdm
-
-from src.image_processing import get_stack_filenames, save_image, get_tag_resolution
+from src.executor import run_items
+from src.image_processing import get_slice_index, get_slice_range, get_image_info, get_resolution, write_stack_slice
+from src.image_codecs import get_stage_codec
 from src.param_parser import parse_params
+from src.stack_writer import open_stack_writer
+
+
+def write_stack(stack_filename, stack_path, shape, dtype, slices, image_range, resolution, size_z, compress=False,
+                codec=None):
+    """
+    Write the slices in image_range to a stack, blank where there is no slice. A stack which can't be written is
+    reported and skipped, without affecting the other stacks.
+    """
+    resx, resy, res_unit = resolution
+    depth = image_range[1] - image_range[0] + 1
+    try:
+        with open_stack_writer(stack_path, (depth,) + tuple(shape), dtype, compress=compress, codec=codec) as writer:
+            for i in range(image_range[0], image_range[1] + 1):
+                write_stack_slice(writer, slices, i)
+            writer.set_resolution(resx=resx, resy=resy, size_z=size_z, res_unit=res_unit)
+    except ValueError as error:
+        print("Stack error", stack_filename, error)
+
+
+def stack_matching(stack, source_stacks_dir, label_stacks_dir, size_z, compress=False, output_extension='.tiff',
+                   codec=None):
+    """
+    Stack the image and label slices of stack, given as (stack filename, source slices, label slices). Returns the
+    range of slices.
+    """
+    stack_filename, source_slices, label_slices = stack
+    image_range = get_slice_range(source_slices)
+
+    # shapes and resolutions come from the headers of the first slices, only the slices being stacked are decoded
+    source_filepath = next(iter(source_slices.values()))
+    source_shape, source_dtype = get_image_info(source_filepath)
+    resx_source, resy_source, _, res_unit_source = get_resolution(source_filepath)
+    if label_slices:
+        label_filepath = next(iter(label_slices.values()))
+        label_shape, label_dtype = get_image_info(label_filepath)
+        resx_label, resy_label, _, res_unit_label = get_resolution(label_filepath)
+    else:
+        label_shape, label_dtype = source_shape, source_dtype
+        resx_label, resy_label, res_unit_label = 1, 1, ""
+
+    # slices are written as they are read, so only one is held in memory at a time, and the image and label stacks
+    # are written independently, so that an error in one doesn't lose the other
+    write_stack(stack_filename, os.path.join(source_stacks_dir, stack_filename + output_extension), source_shape,
+                source_dtype, source_slices, image_range, (resx_source, resy_source, res_unit_source), size_z,
+                compress=compress, codec=codec)
+    write_stack(stack_filename, os.path.join(label_stacks_dir, stack_filename + output_extension), label_shape,
+                label_dtype, label_slices, image_range, (resx_label, resy_label, res_unit_label), size_z,
+                compress=compress, codec=codec)
+
+    return image_range
 
 
 def create_tiff_stack_matching(source_images_dir, source_stacks_dir,
-                               label_images_dir, label_stacks_dir, size_z, clear_existing=False, compress=False):
+                               label_images_dir, label_stacks_dir, size_z, clear_existing=False, compress=False,
+                               output_extension='.tiff', codec=None):
     if clear_existing and os.path.exists(source_stacks_dir):
         shutil.rmtree(source_stacks_dir)
     if clear_existing is True and os.path.exists(label_stacks_dir):
@@ -26,81 +76,15 @@ def create_tiff_stack_matching(source_images_dir, source_stacks_dir,
     if not os.path.exists(label_stacks_dir):
         os.makedirs(label_stacks_dir)
 
-    stack_filenames, filenames, input_extension = get_stack_filenames(source_images_dir)
-    image_range = []
-
-    for stack_filename in tqdm(stack_filenames):
-        image_stack = []
-        label_stack = []
-        source_image = []
-        label_image = []
-        mini = -1
-        maxi = -1
-        add_prefix_z = True
-        resx_source = 1
-        resy_source = 1
-        res_unit_source = ""
-        resx_label = 1
-        resy_label = 1
-        res_unit_label = ""
-
-        for filename in filenames:
-            file = filename.rsplit('_', 1)
-            # find matching files
-            if file[0] == stack_filename:
-                slice = file[1]
-                add_prefix_z = slice.lower().startswith("z")
-                if add_prefix_z:
-                    slice = slice[1:]
-                i = int(slice)
-                if i < mini or mini < 0:
-                    mini = i
-                if i > maxi:
-                    maxi = i
-                if len(source_image) == 0:
-                    source_image = imread(source_images_dir + filename + input_extension)
-                if len(label_image) == 0 and os.path.exists(label_images_dir + filename + input_extension):
-                    label_image = imread(label_images_dir + filename + input_extension)
-
-        image_range = [mini, maxi]
-
-        for i in range(mini, maxi + 1):
-            input_filename = stack_filename + '_'
-            if add_prefix_z:
-                input_filename += 'z'
-            input_filename += f"{i:04d}" + input_extension
-
-            input_path = source_images_dir + input_filename
-            if os.path.exists(input_path):
-                source_image = imread(input_path)
-                resx_source, resy_source, _, res_unit_source = get_tag_resolution(input_path)
-            else:
-                source_image = np.zeros_like(source_image)
-            image_stack.append(source_image)
-
-            input_path = label_images_dir + input_filename
-            if os.path.exists(input_path):
-                label_image = imread(input_path)
-                resx_label, resy_label, _, res_unit_label = get_tag_resolution(input_path)
-            else:
-                label_image = np.zeros_like(label_image)
-            label_stack.append(label_image)
-
-        np_stack = np.array(image_stack)
-        if np_stack.dtype.kind == "O":
-            print("Stack error", stack_filename, "Type:", np_stack.dtype, "Shape:", np_stack.shape)
-        else:
-            save_image(source_stacks_dir + stack_filename + '.tiff', np_stack, resx=resx_source, resy=resy_source, size_z=size_z,
-                       res_unit=res_unit_source, compress=compress)
-
-        np_stack = np.array(label_stack)
-        if np_stack.dtype.kind == "O":
-            print("Stack error", stack_filename, "Type:", np_stack.dtype, "Shape:", np_stack.shape)
-        else:
-            save_image(label_stacks_dir + stack_filename + '.tiff', np_stack, resx=resx_label, resy=resy_label, size_z=size_z,
-                       res_unit=res_unit_label, compress=compress)
+    source_index = get_slice_index(source_images_dir)
+    label_index = get_slice_index(label_images_dir) if os.path.isdir(label_images_dir) else {}
+    stacks = [(stack_filename, source_slices, label_index.get(stack_filename, {}))
+              for stack_filename, source_slices in source_index.items()]
 
-    return image_range
+    image_ranges = run_items(stack_matching, stacks,
+                             (source_stacks_dir, label_stacks_dir, size_z, compress, output_extension, codec),
+                             unit=' stacks')
+    return image_ranges[-1] if image_ranges else []
 
 
 if __name__ == '__main__':
@@ -125,4 +109,5 @@ if __name__ == '__main__':
     labels_stacks_dir = '../projects/nuclear/resources/images/raw-labels-stacks/'
     size_z = 0.05
 
-    create_tiff_stack_matching(images_dir, images_stacks_dir, labels_dir, labels_stacks_dir, size_z)
+    create_tiff_stack_matching(images_dir, images_stacks_dir, labels_dir, labels_stacks_dir, size_z,
+                               codec=get_stage_codec(params, 'stack'))
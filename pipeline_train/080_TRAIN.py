@@ -18,6 +18,7 @@ def train_model(params, model_images_dir, model_labels_dir, model_save_dir, aggr
 
     model, epoch = get_model(params, data_loader)
     model_train(model, params, data_loader, epoch)
+    data_loader.print_cache_stats()
 
 
 if __name__ == '__main__':
@@ -48,7 +48,7 @@ fi
 echo 'DONE'
 
 classificationsfilename="etch-a-cell-classifications-cleaned.csv"
-# check if we already have the classifications csv
+# check if we already have the classifications csv, extracted so that step 1 can convert it in parallel shards
 if [[ ! -f "projects/nuclear/resources/csv/$classificationsfilename" ]]
 then
   echo '> Retrieving Zooniverse CSV data...'
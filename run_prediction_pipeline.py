@@ -2,6 +2,10 @@ import argparse
 import json
 
 from pipeline_predict import PREDICT, RESCALE, STACK_TIFF, CONNECTED
+from src.executor import set_executor_options
+from src.image_codecs import check_stage_codecs, get_stage_codec
+from src.image_processing import set_artifact_catalog
+from src.pyramid import build_pyramids
 
 
 if __name__ == '__main__':
@@ -17,6 +21,10 @@ if __name__ == '__main__':
                         type=int,
                         help='Ignore specified pipeline steps.',
                         default=[])
+    parser.add_argument('--workers',
+                        type=int,
+                        help='Number of worker processes for the per-image steps (overrides the parameters file).',
+                        default=None)
     parser.add_argument('--restart',
                         type=bool,
                         help='Clears previous data while running the pipeline.',
@@ -51,35 +59,55 @@ if __name__ == '__main__':
     target_xy_nm = params['target_xy_nm']
     target_z_nm = params['target_z_nm']
     size_z_um = target_z_nm / 1000
+    workers = args.workers or params['workers']
+    pyramid_factors = params['pyramid_factors']
+    # an invalid codec, or one whose package isn't installed, fails here rather than part way through a stage
+    check_stage_codecs(params)
+    pyramid_codec = get_stage_codec(params, 'pyramid')
+
+    # the per-image steps run their images through the shared executor
+    set_executor_options(workers, params['io_workers'], params['memory_limit_mb'])
+
+    # image headers and directory listings are looked up in the artifact catalog, which persists between runs
+    set_artifact_catalog(params['artifact_catalog_path'])
 
     print('\n=====> PIPELINE STEP 1/5 --- Stacking source images')
     if 1 not in ignore_steps and "stack" not in source_dir:
-        STACK_TIFF.create_tiff_stack(source_dir, stack_dir, size_z_um, clear_existing=restart)
+        STACK_TIFF.create_tiff_stack(source_dir, stack_dir, size_z_um, clear_existing=restart,
+                                     codec=get_stage_codec(params, 'stack'))
     else:
         if "stack" in source_dir:
             stack_dir = source_dir
         print('...SKIPPED...')
+    # downsampled copies of the stacks for the viewers and figures, only rebuilt for stacks which have changed
+    build_pyramids(stack_dir, method='mean', factors=pyramid_factors, codec=pyramid_codec)
 
     print('\n=====> PIPELINE STEP 2/5 --- Downscaling source images')
     if 2 not in ignore_steps:
-        RESCALE.rescale(stack_dir, scaled_dir, "", 0, target_xy_nm, target_z_nm, clear_existing=restart)
+        RESCALE.rescale(stack_dir, scaled_dir, "", 0, target_xy_nm, target_z_nm, clear_existing=restart,
+                        codec=get_stage_codec(params, 'downsample'))
     else:
         print('...SKIPPED...')
 
     print('\n=====> PIPELINE STEP 3/5 --- Evaluating images on model')
     if 3 not in ignore_steps:
-        PREDICT.predict(params, scaled_dir, scaled_predictions_dir, model_dir, aggregation_method, target_xy_nm, target_z_nm, model_name=model_name, clear_existing=restart, tri_axis=tri_axis)
+        PREDICT.predict(params, scaled_dir, scaled_predictions_dir, model_dir, aggregation_method, target_xy_nm, target_z_nm, model_name=model_name, clear_existing=restart, tri_axis=tri_axis,
+                        codec=get_stage_codec(params, 'predict'))
     else:
         print('...SKIPPED...')
 
     print('\n=====> PIPELINE STEP 4/5 --- Removing oversegmentation artefacts')
     if 4 not in ignore_steps:
-        CONNECTED.remove_small_regions(scaled_predictions_dir, target_xy_nm, target_z_nm)
+        CONNECTED.remove_small_regions(scaled_predictions_dir, target_xy_nm, target_z_nm,
+                                       codec=get_stage_codec(params, 'connected'))
+        build_pyramids(scaled_predictions_dir, method='max', factors=pyramid_factors, codec=pyramid_codec)
     else:
         print('...SKIPPED...')
 
     print('\n=====> PIPELINE STEP 5/5 --- Upscaling label images')
     if 5 not in ignore_steps:
-        RESCALE.rescale(scaled_predictions_dir, predictions_dir, stack_dir, target_xy_nm, 0, target_z_nm, clear_existing=restart, binary_format=True, compress=True)
+        RESCALE.rescale(scaled_predictions_dir, predictions_dir, stack_dir, target_xy_nm, 0, target_z_nm, clear_existing=restart, binary_format=True, compress=True,
+                        codec=get_stage_codec(params, 'upscale'))
+        build_pyramids(predictions_dir, method='max', factors=pyramid_factors, codec=pyramid_codec)
     else:
         print('...SKIPPED...')
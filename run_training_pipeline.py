@@ -3,6 +3,14 @@ import argparse
 
 from importlib import import_module
 
+from src.executor import set_executor_options
+from src.image_codecs import check_stage_codecs, get_stage_codec
+from src.image_processing import set_artifact_catalog
+from src.pyramid import build_pyramids
+from src.training_data import build_training_stacks
+from src.volume_store import VOLUME_EXTENSION
+from src.zooniverse import load_changed_slices
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser("Run the training pipeline.")
@@ -14,6 +22,10 @@ if __name__ == '__main__':
                         type=int,
                         help='Ignore specified pipeline steps.',
                         default=[])
+    parser.add_argument('--workers',
+                        type=int,
+                        help='Number of worker processes for the per-image steps (overrides the parameters file).',
+                        default=None)
     parser.add_argument('--restart',
                         type=bool,
                         help='Clears previous pre-processing data while running the pipeline.',
@@ -36,10 +48,13 @@ if __name__ == '__main__':
 
     zooniverse_csv_file = params['zooniverse_csv_file']
     processed_csv_dir = params['processed_csv_dir']
+    annotation_store_dir = params['annotation_store_dir']
+    slice_catalog_path = params['slice_catalog_path']
 
     images_raw_dir = params['images_raw_dir']
     images_raw_stack_dir = params['images_raw_stack_dir']
     images_raw_labels_dir = params['images_raw_labels_dir']
+    images_raw_contours_dir = params['images_raw_contours_dir']
 
     scaled_images_dir = params['scaled_images_dir']
     scaled_labels_dir = params['scaled_labels_dir']
@@ -56,7 +71,9 @@ if __name__ == '__main__':
     model_save_dir = params['model']['save_dir']
 
     zooniverse_workflow = params['zooniverse_workflow']
+    incremental = params['incremental_ingest']
     aggregation_method = params['aggregation_method']
+    aggregate_at_target_resolution = params['aggregate_at_target_resolution']
     border_width_nm = params['border_width_nm']
 
     target_xy_nm = params['target_xy_nm']
@@ -68,38 +85,97 @@ if __name__ == '__main__':
     ref_image_target_width = params['ref_images']['target_width']
     ref_image_target_height = params['ref_images']['target_height']
 
+    stack_extension = params['stack_extension']
+
     padding = params['crop_padding']
+    min_annotations = params['min_annotations']
+    fused_training_data = params['fused_training_data']
+    debug_intermediate_files = params['debug_intermediate_files']
     patch_size = params['model']['patch_shape']
 
+    workers = args.workers or params['workers']
+    pyramid_factors = params['pyramid_factors']
+    # an invalid codec, or one whose package isn't installed, fails here rather than part way through a stage. The
+    # training stacks and their pyramids are volumes if stack_extension is, every other stage writes tiffs
+    check_stage_codecs(params, ('stack', 'pyramid') if stack_extension == VOLUME_EXTENSION else ())
+    pyramid_codec = get_stage_codec(params, 'pyramid')
+
+    # the per-image steps run their images through the shared executor
+    set_executor_options(workers, params['io_workers'], params['memory_limit_mb'])
+
+    # image headers and directory listings are looked up in the artifact catalog, which persists between runs
+    set_artifact_catalog(params['artifact_catalog_path'])
+
     print('\n=====> PIPELINE STEP 1/8 ---  Zooniverse CSV format conversion')
     if 1 not in ignore_steps:
         PREPROCESS.preprocess_zooniverse_csv(output_dir=processed_csv_dir, input_path=zooniverse_csv_file,
-                                             workflow=zooniverse_workflow)
+                                             workflow=zooniverse_workflow, store_dir=annotation_store_dir,
+                                             catalog_path=slice_catalog_path, workers=workers,
+                                             incremental=incremental)
     else:
         print('...SKIPPED...')
 
+    # after an incremental ingest only the slices with new classifications need aggregating and downscaling again,
+    # the manifest is only this run's if step 1 ran
+    changed_slices = load_changed_slices(processed_csv_dir) if incremental and 1 not in ignore_steps else None
+    if changed_slices is not None:
+        print(f'Limiting aggregation and downscaling to {len(changed_slices)} changed slices')
+    clear_unchanged = restart and changed_slices is None
+
     print('\n=====> PIPELINE STEP 2/8 --- Unstacking reference images')
     if 2 not in ignore_steps:
-        UNSTACK.unstack(images_raw_dir, images_raw_stack_dir, z_index_offset=ref_image_z_offset)
+        UNSTACK.unstack(images_raw_dir, images_raw_stack_dir, z_index_offset=ref_image_z_offset,
+                        codec=get_stage_codec(params, 'unstack'))
     else:
         print('...SKIPPED...')
 
+    # aggregating at the target resolution writes the labels step 4 would have downscaled them to
+    labels_dir = scaled_labels_dir if aggregate_at_target_resolution else images_raw_labels_dir
+
     print('\n=====> PIPELINE STEP 3/8 --- Aggregating the annotations')
     if 3 not in ignore_steps:
-        AGGREGATE.aggregate(processed_csv_dir, images_raw_dir, images_raw_labels_dir, border_width_nm=border_width_nm,
-                            method=aggregation_method, clear_existing=restart, zoom_factor=ref_image_zoom,
-                            correct_width=ref_image_target_width, correct_height=ref_image_target_height)
+        AGGREGATE.aggregate(annotation_store_dir, images_raw_dir, labels_dir, border_width_nm=border_width_nm,
+                            method=aggregation_method, clear_existing=clear_unchanged, zoom_factor=ref_image_zoom,
+                            correct_width=ref_image_target_width, correct_height=ref_image_target_height,
+                            slices=changed_slices, codec=get_stage_codec(params, 'aggregate'),
+                            target_xy_nm=target_xy_nm if aggregate_at_target_resolution else None,
+                            slice_catalog_path=slice_catalog_path, contours_dir=images_raw_contours_dir)
     else:
         print('...SKIPPED...')
 
+    if fused_training_data:
+        print('\n=====> PIPELINE STEPS 4-7/8 --- Building the training stacks (downscale, crop, discard and stack)')
+        if not {4, 5, 6, 7} <= set(ignore_steps):
+            changed_rois = None if changed_slices is None else {f.rsplit('_', 1)[0] for f in changed_slices}
+            debug_dirs = None
+            if debug_intermediate_files:
+                # labels aggregated at the target resolution are already in the scaled labels directory
+                debug_dirs = (scaled_images_dir, None if aggregate_at_target_resolution else scaled_labels_dir,
+                              cropped_images_dir, cropped_labels_dir)
+            build_training_stacks(slice_catalog_path, images_raw_dir, labels_dir, cropped_image_stacks_dir,
+                                  cropped_label_stacks_dir, target_xy_nm, size_z_um, padding, patch_size[1:],
+                                  min_annotations=min_annotations, output_extension=stack_extension,
+                                  clear_existing=clear_unchanged, rois=changed_rois,
+                                  codec=get_stage_codec(params, 'stack'), debug_dirs=debug_dirs,
+                                  labels_scaled=aggregate_at_target_resolution)
+            build_pyramids(cropped_image_stacks_dir, method='mean', factors=pyramid_factors, codec=pyramid_codec)
+            build_pyramids(cropped_label_stacks_dir, method='max', factors=pyramid_factors, codec=pyramid_codec)
+        else:
+            print('...SKIPPED...')
+        # the separate steps are replaced by the fused build
+        ignore_steps = ignore_steps + [4, 5, 6, 7]
+
     print('\n=====> PIPELINE STEP 4/8 --- Downscale labels and reference images')
     if 4 not in ignore_steps:
         print('Downscaling source images')
-        DOWNSAMPLE.rescale(processed_csv_dir, images_raw_dir, scaled_images_dir, target_xy_nm, target_z_nm,
-                           binary_format=False, clear_existing=restart)
-        print('Downscaling label images')
-        DOWNSAMPLE.rescale(processed_csv_dir, images_raw_labels_dir, scaled_labels_dir, target_xy_nm, target_z_nm,
-                           binary_format=True, clear_existing=restart)
+        DOWNSAMPLE.rescale(slice_catalog_path, images_raw_dir, scaled_images_dir, target_xy_nm, target_z_nm,
+                           binary_format=False, clear_existing=clear_unchanged, slices=changed_slices,
+                           codec=get_stage_codec(params, 'downsample'))
+        if not aggregate_at_target_resolution:
+            print('Downscaling label images')
+            DOWNSAMPLE.rescale(slice_catalog_path, images_raw_labels_dir, scaled_labels_dir, target_xy_nm, target_z_nm,
+                               binary_format=True, clear_existing=clear_unchanged, slices=changed_slices,
+                               codec=get_stage_codec(params, 'downsample'))
     else:
         print('...SKIPPED...')
 
@@ -112,16 +188,24 @@ if __name__ == '__main__':
 
     print('\n=====> PIPELINE STEP 6/8 --- Discarding slices with too few annotations')
     if 6 not in ignore_steps:
-        DISCARD.discard_ref_images(processed_csv_dir, cropped_images_dir, cropped_labels_dir)
+        DISCARD.discard_ref_images(slice_catalog_path, cropped_images_dir, cropped_labels_dir,
+                                   min_annotations=min_annotations)
     else:
         print('...SKIPPED...')
 
     print('\n=====> PIPELINE STEP 7/8 --- Creating tiff stacks')
     if 7 not in ignore_steps:
         STACKTIFF.create_tiff_stack_matching(scaled_images_dir, scaled_image_stacks_dir,
-                                             scaled_labels_dir, scaled_label_stacks_dir, size_z_um, clear_existing=restart)
+                                             scaled_labels_dir, scaled_label_stacks_dir, size_z_um, clear_existing=restart,
+                                             output_extension=stack_extension, codec=get_stage_codec(params, 'stack'))
         STACKTIFF.create_tiff_stack_matching(cropped_images_dir, cropped_image_stacks_dir,
-                                             cropped_labels_dir, cropped_label_stacks_dir, size_z_um, clear_existing=restart)
+                                             cropped_labels_dir, cropped_label_stacks_dir, size_z_um, clear_existing=restart,
+                                             output_extension=stack_extension, codec=get_stage_codec(params, 'stack'))
+        # downsampled copies of the stacks for the viewers and figures, labels keep their thin membranes by taking the max
+        for image_stacks_dir, label_stacks_dir in ((scaled_image_stacks_dir, scaled_label_stacks_dir),
+                                                   (cropped_image_stacks_dir, cropped_label_stacks_dir)):
+            build_pyramids(image_stacks_dir, method='mean', factors=pyramid_factors, codec=pyramid_codec)
+            build_pyramids(label_stacks_dir, method='max', factors=pyramid_factors, codec=pyramid_codec)
     else:
         print('...SKIPPED...')
 
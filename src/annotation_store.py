@@ -0,0 +1,263 @@
+"""
+A single columnar store for the annotations of every slice, so that later pipeline steps don't have to open
+thousands of small csvs. All points are kept in one flat float32 array, with offset arrays marking where each
+stroke, annotation (one classification of a slice) and slice begins:
+
+    points[stroke_offsets[s]:stroke_offsets[s + 1]]                 points of stroke s
+    stroke_offsets[annotation_offsets[a]:annotation_offsets[a + 1]] strokes of annotation a
+    annotation_offsets[slice_offsets[i]:slice_offsets[i + 1]]       annotations of slice i
+
+The arrays are stored as raw binary files which are memory mapped when read, and an index of the slices keyed by
+(ROI, slice z) allows random access. The index also gives the position i of each slice in the arrays, so that the
+slices changed by an incremental ingest can be appended to the store rather than rebuilding it.
+"""
+import os
+import json
+import shutil
+
+import numpy as np
+from tqdm import tqdm
+
+from src.helpers import read_processed_csv, parse_annotation_points
+
+
+INDEX_FILENAME = 'index.json'
+
+# name: dtype of every array in the store
+ARRAYS = {
+    'points': np.float32,
+    'stroke_offsets': np.int64,
+    'annotation_offsets': np.int64,
+    'slice_offsets': np.int64,
+    'classification_id': np.int64,
+    'raw_xy_res': np.float64,
+    'raw_z_res': np.float64,
+}
+
+# the csv column each per-annotation array is taken from
+ANNOTATION_COLUMNS = {
+    'classification_id': 'classification id',
+    'raw_xy_res': 'raw xy resolution (nm)',
+    'raw_z_res': 'raw z resolution (nm)',
+}
+
+
+def get_slice_index(slice_z):
+    return int(slice_z[1:]) if slice_z.lower().startswith('z') else int(slice_z)
+
+
+class AnnotationStoreWriter:
+    """
+    Appends slices to a new annotation store one at a time, so that building the store never needs more memory than
+    the annotations of a single slice.
+
+    append: add the slices to the end of an existing store instead. A slice which is already in the store is written
+    again and its entry in the index pointed at the new copy, the old copy is left in the arrays unused until the store
+    is next built from scratch.
+    """
+
+    def __init__(self, store_dir, append=False):
+        self.store_dir = store_dir
+        self.append = append
+        if append:
+            with open(os.path.join(store_dir, INDEX_FILENAME), 'r') as f:
+                index = json.load(f)
+            self.counts = index['counts']
+            self.slices = index['slices']
+            self.positions = index.get('positions', list(range(len(self.slices))))
+            self.nentries = index.get('entries', len(self.slices))
+            self.files = {name: open(os.path.join(store_dir, name + '.bin'), 'ab') for name in ARRAYS}
+        else:
+            if os.path.exists(store_dir):
+                shutil.rmtree(store_dir)
+            os.makedirs(store_dir)
+
+            self.files = {name: open(os.path.join(store_dir, name + '.bin'), 'wb') for name in ARRAYS}
+            self.counts = dict(points=0, strokes=0, annotations=0)
+            self.slices = []
+            self.positions = []
+            self.nentries = 0
+            for name in ['stroke_offsets', 'annotation_offsets', 'slice_offsets']:
+                self.write_array(name, [0])
+        self.by_filename = {filename: i for i, (_, _, filename) in enumerate(self.slices)}
+
+    def write_array(self, name, values):
+        self.files[name].write(np.asarray(values, dtype=ARRAYS[name]).tobytes())
+
+    def add_slice(self, roi, slice_z, filename, annotations, columns):
+        """
+        annotations: one list of strokes per annotation, each stroke a sequence of (x, y) points
+        columns: per-annotation values for each of ANNOTATION_COLUMNS
+        """
+        for strokes in annotations:
+            for stroke in strokes:
+                points = np.asarray(stroke, dtype=np.float32).reshape(-1, 2)
+                self.write_array('points', points)
+                self.counts['points'] += len(points)
+                self.write_array('stroke_offsets', [self.counts['points']])
+            self.counts['strokes'] += len(strokes)
+            self.write_array('annotation_offsets', [self.counts['strokes']])
+        self.counts['annotations'] += len(annotations)
+        self.write_array('slice_offsets', [self.counts['annotations']])
+
+        for name in ANNOTATION_COLUMNS:
+            self.write_array(name, columns[name])
+
+        if filename in self.by_filename:
+            self.positions[self.by_filename[filename]] = self.nentries
+        else:
+            self.by_filename[filename] = len(self.slices)
+            self.slices.append([roi, slice_z, filename])
+            self.positions.append(self.nentries)
+        self.nentries += 1
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        if self.append:
+            # new slices are kept in filename order with the rest, as a full build lists them
+            order = sorted(range(len(self.slices)), key=lambda i: self.slices[i][2])
+            self.slices = [self.slices[i] for i in order]
+            self.positions = [self.positions[i] for i in order]
+        with open(os.path.join(self.store_dir, INDEX_FILENAME), 'w') as f:
+            json.dump({'counts': self.counts, 'slices': self.slices, 'positions': self.positions,
+                       'entries': self.nentries}, f)
+
+
+class AnnotationStore:
+    """
+    Read access to an annotation store written by AnnotationStoreWriter.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, INDEX_FILENAME), 'r') as f:
+            index = json.load(f)
+        self.slices = [tuple(entry) for entry in index['slices']]
+        # where each slice is in the arrays, which is out of order once slices have been appended
+        self.positions = index.get('positions', list(range(len(self.slices))))
+        self.by_filename = {filename: i for i, (_, _, filename) in enumerate(self.slices)}
+        self.by_key = {(roi, slice_z): i for i, (roi, slice_z, _) in enumerate(self.slices)}
+        self.by_roi = dict()
+        for i, (roi, slice_z, _) in enumerate(self.slices):
+            self.by_roi.setdefault(roi, []).append((get_slice_index(slice_z), i))
+
+        self.arrays = dict()
+        for name, dtype in ARRAYS.items():
+            path = os.path.join(store_dir, name + '.bin')
+            if os.path.getsize(path) > 0:
+                self.arrays[name] = np.memmap(path, dtype=dtype, mode='r')
+            else:
+                self.arrays[name] = np.zeros(0, dtype=dtype)
+        self.arrays['points'] = self.arrays['points'].reshape(-1, 2)
+
+    def keys(self):
+        """
+        The filenames (without extension) of all slices in the store, which are the same as the processed csv names.
+        """
+        return [filename for _, _, filename in self.slices]
+
+    def __contains__(self, filename):
+        return filename in self.by_filename
+
+    def get_filename(self, roi, slice_z):
+        i = self.by_key.get((roi, slice_z))
+        return self.slices[i][2] if i is not None else None
+
+    def get_annotation_range(self, filename):
+        i = self.positions[self.by_filename[filename]]
+        slice_offsets = self.arrays['slice_offsets']
+        return slice_offsets[i], slice_offsets[i + 1]
+
+    def count_annotations(self, filename):
+        begin, end = self.get_annotation_range(filename)
+        return int(end - begin)
+
+    def get_column(self, filename, name):
+        begin, end = self.get_annotation_range(filename)
+        return np.asarray(self.arrays[name][begin:end])
+
+    def get_xy_resolution(self, filename):
+        """
+        Most frequent raw xy resolution of the annotations of a slice (there are occasional errors in the csv).
+        """
+        values, counts = np.unique(self.get_column(filename, 'raw_xy_res'), return_counts=True)
+        return values[np.argmax(counts)]
+
+    def get_annotations(self, filename):
+        """
+        Returns one list of strokes per annotation, each stroke an (n, 2) float32 array of points.
+        """
+        begin, end = self.get_annotation_range(filename)
+        annotation_offsets = self.arrays['annotation_offsets']
+        stroke_offsets = self.arrays['stroke_offsets']
+        points = self.arrays['points']
+
+        annotations = []
+        for a in range(begin, end):
+            strokes = []
+            for s in range(annotation_offsets[a], annotation_offsets[a + 1]):
+                strokes.append(points[stroke_offsets[s]:stroke_offsets[s + 1]])
+            annotations.append(strokes)
+        return annotations
+
+    def get_annotation_points(self, filename, zoom_factor_x, zoom_factor_y, offset_x=0, offset_y=0):
+        """
+        Same as interiors_probability.get_annotation_points, but read from the store rather than a csv. The offsets are
+        added to the points after zooming them.
+        """
+        zoom = np.array([zoom_factor_x, zoom_factor_y], dtype=np.float64)
+        offset = np.array([offset_x, offset_y], dtype=np.float64)
+        return [[stroke.astype(np.float64) * zoom + offset for stroke in strokes]
+                for strokes in self.get_annotations(filename)]
+
+    def nearest_slice(self, roi, slice_z, max_distance=500):
+        """
+        Filename of the annotated slice of a ROI closest to slice_z, preferring the later slice when two are equally
+        close. Returns None if there is none within max_distance.
+        """
+        z = get_slice_index(slice_z)
+        candidates = [(abs(index - z), -index, i) for index, i in self.by_roi.get(roi, [])
+                      if abs(index - z) <= max_distance]
+        if not candidates:
+            return None
+        return self.slices[min(candidates)[2]][2]
+
+
+def add_slice_csv(writer, csv_dir, filename):
+    processed_csv = read_processed_csv(os.path.join(csv_dir, filename + '.csv'))
+
+    annotations = [parse_annotation_points(row_annotations) for row_annotations in processed_csv['annotations']]
+    columns = {name: np.array([value if value else 'nan' for value in processed_csv[column]], dtype=np.float64)
+               for name, column in ANNOTATION_COLUMNS.items()}
+    roi, slice_z = filename.rsplit('_', 1)
+    writer.add_slice(roi, slice_z, filename, annotations, columns)
+
+
+def build_annotation_store(csv_dir, store_dir):
+    """
+    Collect the per-slice processed csvs in to one annotation store.
+    """
+    writer = AnnotationStoreWriter(store_dir)
+    for csv in tqdm(sorted(os.listdir(csv_dir))):
+        filename, ext = os.path.splitext(csv)
+        # hidden csvs (e.g. the classifications written alongside the slices) aren't slices
+        if ext != '.csv' or filename.startswith('.'):
+            continue
+        add_slice_csv(writer, csv_dir, filename)
+    writer.close()
+    return len(writer.slices)
+
+
+def update_annotation_store(csv_dir, store_dir, filenames):
+    """
+    Read only the processed csvs of the slices filenames (e.g. the ones changed by an incremental ingest) in to an
+    existing annotation store, or build the store from every csv if there isn't one yet.
+    """
+    if not os.path.exists(os.path.join(store_dir, INDEX_FILENAME)):
+        return build_annotation_store(csv_dir, store_dir)
+    writer = AnnotationStoreWriter(store_dir, append=True)
+    for filename in tqdm(sorted(filenames)):
+        add_slice_csv(writer, csv_dir, filename)
+    writer.close()
+    return len(writer.slices)
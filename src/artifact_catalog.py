@@ -0,0 +1,119 @@
+"""
+A persistent SQLite catalog of the images written by the pipeline, keyed by path, holding the shape, dtype and
+resolution read from their headers, and of the directory listings used to find an image by name. Entries are checked
+against the modification time (and size) of the file or directory on every lookup, and re-read when they are stale,
+so the catalog never has to be cleared by hand.
+
+Lookups cost a stat and an indexed query, rather than a glob of the directory or opening and parsing a tiff, which is
+what dominates the small-file steps on a network filesystem.
+"""
+import os
+import sqlite3
+from collections import namedtuple
+from glob import glob
+
+from src.volume_store import META_FILENAME
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS artifacts (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    shape TEXT NOT NULL,
+    dtype TEXT NOT NULL,
+    resx REAL,
+    resy REAL,
+    size_z REAL,
+    unit TEXT
+);
+
+CREATE TABLE IF NOT EXISTS directories (
+    directory TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS files (
+    directory TEXT NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (directory, name)
+);
+"""
+
+ArtifactInfo = namedtuple('ArtifactInfo', ['shape', 'dtype', 'resx', 'resy', 'size_z', 'unit'])
+
+
+def get_stat(path):
+    # a volume's metadata is rewritten in place, which doesn't change the modification time of its directory
+    if os.path.isdir(path):
+        path = os.path.join(path, META_FILENAME)
+    return os.stat(path)
+
+
+class ArtifactCatalog:
+    """
+    read_info(path) reads an ArtifactInfo from the file itself, for paths which aren't in the catalog (or have changed
+    since they were added).
+    """
+
+    def __init__(self, catalog_path, read_info):
+        self.catalog_path = catalog_path
+        self.read_info = read_info
+        # the process which opened the connection, sqlite connections can't be used after a fork
+        self.pid = os.getpid()
+        self.connection = sqlite3.connect(catalog_path, timeout=60)
+        # the catalog is only a cache, so a write lost in a crash costs no more than reading the header again
+        self.connection.execute('PRAGMA synchronous = OFF')
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def get_info(self, path):
+        key = os.path.abspath(path)
+        stat = get_stat(key)
+        row = self.connection.execute('SELECT mtime_ns, size, shape, dtype, resx, resy, size_z, unit FROM artifacts '
+                                      'WHERE path = ?', (key,)).fetchone()
+        if row is not None and row[0] == stat.st_mtime_ns and row[1] == stat.st_size:
+            shape = tuple(int(s) for s in row[2].split(',') if s)
+            return ArtifactInfo(shape, row[3], *row[4:])
+
+        info = self.read_info(path)
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                    (key, stat.st_mtime_ns, stat.st_size, ','.join(str(s) for s in info.shape),
+                                     str(info.dtype), info.resx, info.resy, info.size_z, info.unit))
+        return ArtifactInfo(tuple(info.shape), str(info.dtype), info.resx, info.resy, info.size_z, info.unit)
+
+    def update_listing(self, directory, mtime_ns):
+        with self.connection:
+            self.connection.execute('DELETE FROM files WHERE directory = ?', (directory,))
+            self.connection.executemany('INSERT INTO files VALUES (?, ?)',
+                                        [(directory, name) for name in os.listdir(directory)])
+            self.connection.execute('INSERT OR REPLACE INTO directories VALUES (?, ?)', (directory, mtime_ns))
+
+    def find_file(self, file_pattern):
+        """
+        As helpers.get_file, for patterns of the form <directory>/<name>.*, from the catalogued listing of directory.
+        Other patterns are globbed.
+        """
+        directory, name = os.path.split(file_pattern)
+        if not name.endswith('.*') or any(c in file_pattern[:-2] for c in '*?['):
+            filenames = glob(file_pattern)
+            return filenames[0] if filenames else ""
+
+        key = os.path.abspath(directory or '.')
+        try:
+            mtime_ns = os.stat(key).st_mtime_ns
+        except FileNotFoundError:
+            return ""
+        row = self.connection.execute('SELECT mtime_ns FROM directories WHERE directory = ?', (key,)).fetchone()
+        if row is None or row[0] != mtime_ns:
+            self.update_listing(key, mtime_ns)
+
+        # names starting with '<stem>.', as '/' sorts directly after '.'
+        stem = name[:-2]
+        row = self.connection.execute('SELECT name FROM files WHERE directory = ? AND name >= ? AND name < ? '
+                                      'ORDER BY name LIMIT 1', (key, stem + '.', stem + '/')).fetchone()
+        return os.path.join(directory, row[0]) if row is not None else ""
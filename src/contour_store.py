@@ -0,0 +1,184 @@
+"""
+The consensus contours of the aggregated slices (see interiors_probability.get_consensus_contours), kept as polylines
+rather than only as the labels drawn from them, so that labels of a different border width or resolution can be drawn
+again in a fraction of the time aggregating takes, without going back to the annotations.
+
+Each slice is kept in its own compressed npz, <contours dir>/<slice filename>.npz, holding:
+
+    points      the points of every contour, back to back, (n, 2) x, y in pixels of the aggregation frame
+    lengths     the number of points of each contour
+    shape       (height, width) of the aggregation frame
+    resolution  (resx, resy, size_z) of the aggregation frame, in the units of unit
+    unit        the resolution unit
+    ref_shape   (height, width) of the reference image the slice was aggregated for
+    scale       the scale of the aggregation frame to the reference image, 1 unless it was aggregated at a target
+                resolution (see 030 target_xy_nm)
+
+Label slices are drawn the size of the reference image or of 040's scaled images, uncropped. Label stacks lined up
+with the training image stacks are built by training_data.build_training_stacks from a contours_dir.
+"""
+import os
+import shutil
+
+import cv2
+import numpy as np
+
+from src.executor import run_items
+from src.helpers import dpum_to_sizenm
+from src.image_processing import save_image, to_binary
+from src.interiors_probability import draw_contours2, MIN_BORDER_WIDTH
+from src.slice_catalog import SliceCatalog, get_xy_scale
+
+
+CONTOURS_EXTENSION = '.npz'
+
+# fractional bits of the scaled points, cv2 draws them to 1/16 of a pixel
+SHIFT = 4
+
+
+def get_contours_path(contours_dir, filename):
+    return os.path.join(contours_dir, filename + CONTOURS_EXTENSION)
+
+
+def save_contours(filepath, contours, shape, res_info, ref_shape=None, scale_xy=1):
+    """
+    contours: as returned by cv2.findContours, a list of (n, 1, 2) arrays of points
+    res_info: (resx, resy, size_z, res_unit) of the aggregation frame
+    ref_shape, scale_xy: the shape of the reference image, and the scale of the aggregation frame to it
+    """
+    height, width = shape
+    # the points of a 2000x2000 frame fit in int16, for half the size on disk
+    dtype = np.int16 if max(height, width) <= np.iinfo(np.int16).max else np.int32
+    points = np.concatenate([np.reshape(contour, (-1, 2)) for contour in contours]) if contours \
+        else np.zeros((0, 2), dtype)
+    lengths = np.array([len(contour) for contour in contours], dtype=np.int64)
+    resx, resy, size_z, res_unit = res_info
+    with open(filepath, 'wb') as file:
+        np.savez_compressed(file, points=points.astype(dtype), lengths=lengths, shape=np.array(shape, dtype=np.int64),
+                            resolution=np.array([resx, resy, size_z or 1], dtype=np.float64),
+                            unit=np.array(res_unit or ''), ref_shape=np.array(ref_shape or shape, dtype=np.int64),
+                            scale=np.array(scale_xy, dtype=np.float64))
+
+
+def load_contours(filepath):
+    """
+    (contours, shape, res_info, ref_shape, scale_xy) of a slice, the contours as a list of (n, 1, 2) int32 arrays, as
+    cv2 returns them.
+    """
+    with np.load(filepath) as data:
+        points = data['points'].astype(np.int32)
+        lengths = data['lengths']
+        shape = tuple(int(n) for n in data['shape'])
+        resx, resy, size_z = (float(value) for value in data['resolution'])
+        res_unit = str(data['unit'])
+        ref_shape = tuple(int(n) for n in data['ref_shape'])
+        scale_xy = float(data['scale'])
+    contours = [contour.reshape(-1, 1, 2) for contour in np.split(points, np.cumsum(lengths)[:-1])] if len(lengths) \
+        else []
+    return contours, shape, (resx, resy, size_z, res_unit), ref_shape, scale_xy
+
+
+def get_border_width(border_width_nm, size_nm):
+    # the border_width of draw_contours2 for pixels of size_nm
+    return max(round(border_width_nm / size_nm), MIN_BORDER_WIDTH)
+
+
+def rasterize_contours(contours, shape, scaled_shape=None, border_width=MIN_BORDER_WIDTH):
+    """
+    The label image drawn from a slice's contours, scaled to scaled_shape. Unscaled, this is the image aggregation
+    draws. Scaled, the points are mapped pixel centre to pixel centre as the resize does, and drawn to a fraction of a
+    pixel rather than rounded.
+    """
+    height, width = shape
+    if scaled_shape is None or tuple(scaled_shape) == tuple(shape):
+        return draw_contours2(contours, width, height, border_width)
+
+    scaled_height, scaled_width = scaled_shape
+    scale = np.array([scaled_width / width, scaled_height / height])
+    scaled_contours = [np.rint(((contour + 0.5) * scale - 0.5) * (1 << SHIFT)).astype(np.int32)
+                       for contour in contours]
+    image = np.zeros((scaled_height, scaled_width), np.float32)
+    cv2.polylines(image, scaled_contours, False, 1, border_width - 1, lineType=cv2.LINE_AA, shift=SHIFT)
+    return image
+
+
+def get_slice_filename(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def rasterize_slice(filepath, border_width_nm, targetsize_nm_xy=None, slice_catalog=None):
+    """
+    (label image, res_info) of a slice's contours, with a border border_width_nm wide, at pixels of targetsize_nm_xy
+    or at the resolution they were aggregated at. The scale is taken from the slice catalog as step 040 does, if one
+    is given, so that the labels are the size of 040's scaled images.
+
+    Labels at a scale other than the reference image's are binary, as 040 makes them.
+    """
+    contours, shape, (resx, resy, size_z, res_unit), ref_shape, frame_scale = load_contours(filepath)
+    # the pixel size of the reference image, which the scales are relative to
+    ref_size_nm = dpum_to_sizenm(resx / frame_scale)
+    scale_xy = frame_scale
+    if targetsize_nm_xy:
+        if slice_catalog is not None:
+            scale_xy = get_xy_scale(slice_catalog, get_slice_filename(filepath), targetsize_nm_xy)
+            if scale_xy == 0:
+                raise ValueError(f'No resolution for slice {get_slice_filename(filepath)} in the slice catalog.')
+        else:
+            scale_xy = ref_size_nm / targetsize_nm_xy
+    scaled_shape = shape if scale_xy == frame_scale else tuple(int(n * scale_xy + 0.5) for n in ref_shape)
+
+    border_width = get_border_width(border_width_nm, ref_size_nm / scale_xy)
+    image = rasterize_contours(contours, shape, scaled_shape, border_width)
+    if scale_xy != 1:
+        image = to_binary(image)
+    return image, (resx / frame_scale * scale_xy, resy / frame_scale * scale_xy, size_z, res_unit)
+
+
+def rasterize_file(filename, contours_dir, output_dir, border_width_nm, targetsize_nm_xy, slice_catalog_path,
+                   output_extension, codec):
+    slice_catalog = SliceCatalog(slice_catalog_path) if slice_catalog_path else None
+    try:
+        image, (resx, resy, size_z, res_unit) = rasterize_slice(os.path.join(contours_dir, filename), border_width_nm,
+                                                                targetsize_nm_xy, slice_catalog)
+    finally:
+        if slice_catalog is not None:
+            slice_catalog.close()
+    output_filepath = os.path.join(output_dir, os.path.splitext(filename)[0] + output_extension)
+    save_image(output_filepath, image, resx=resx, resy=resy, size_z=size_z, res_unit=res_unit, compress=True,
+               codec=codec)
+
+
+def list_contours(contours_dir):
+    return sorted(f for f in os.listdir(contours_dir) if f.endswith(CONTOURS_EXTENSION))
+
+
+def rasterize_contour_slices(contours_dir, output_dir, border_width_nm, targetsize_nm_xy=None,
+                             slice_catalog_path=None, output_extension='.tiff', clear_existing=False, codec=None):
+    """
+    Draw an uncropped label image for every slice in contours_dir (see rasterize_slice), in place of aggregating (step
+    030), or of aggregating and downscaling (steps 030 and 040) if targetsize_nm_xy is given.
+    """
+    if clear_existing and os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    filenames = list_contours(contours_dir)
+    run_items(rasterize_file, filenames, (contours_dir, output_dir, border_width_nm, targetsize_nm_xy,
+                                          slice_catalog_path, output_extension, codec))
+    print(f'Rasterized label slices: {len(filenames)}')
+    return len(filenames)
+
+
+def get_contour_index(contours_dir):
+    """
+    The contour files in contours_dir by stack, as image_processing.get_slice_index: {stack: {slice number: path}}.
+    """
+    index = {}
+    for file in list_contours(contours_dir):
+        parts = os.path.splitext(file)[0].rsplit('_', 1)
+        if len(parts) == 2:
+            slicei = parts[1][1:] if parts[1].lower().startswith('z') else parts[1]
+            if slicei.isdigit():
+                index.setdefault(parts[0], {})[int(slicei)] = os.path.join(contours_dir, file)
+    return {stack: dict(sorted(slices.items())) for stack, slices in index.items()}
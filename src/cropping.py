@@ -31,25 +31,40 @@ def get_annotation_mins_and_maxes_for_roi(roi, label_folder):
             z_slice = os.path.basename(label_filename).split('_', 2)[2].rsplit('.', 1)[0]
 
         label = imread(label_filename)
-        label = rescale_intensity(label, (0, 1))
 
         if z_slice not in label_groups:
             label_groups[z_slice] = [label]
         else:
             label_groups[z_slice].append(label)
 
+    return get_mins_and_maxes(label_groups.values())
+
+
+def get_label_bounds(labels):
+    """
+    The (x_min, x_max, y_min, y_max) of the segmentation in the labels of one slice, or None if there is none.
+    """
+    labels = np.array([rescale_intensity(label, (0, 1)) for label in labels])
+    locations = np.argwhere(labels != 0)
+    if locations.shape[0] == 0:
+        return None
+    return (np.min(locations[:, 2]), np.max(locations[:, 2]),
+            np.min(locations[:, 1]), np.max(locations[:, 1]))
+
+
+def get_mins_and_maxes(label_groups):
+    """
+    The bounds of the segmentation of each group of labels (one per slice), as lists of x mins, x maxes, y mins and y
+    maxes for get_crop_shape.
+    """
     x_mins, x_maxes, y_mins, y_maxes = [], [], [], []
-    for z_slice, label_group in label_groups.items():
-        labels = np.array(label_group)
-        locations = np.argwhere(labels != 0)
-
-        if locations.shape[0] != 0:
-            x_min, x_max = np.min(locations[:, 2]), np.max(locations[:, 2])
-            y_min, y_max = np.min(locations[:, 1]), np.max(locations[:, 1])
-            x_mins.append(x_min)
-            x_maxes.append(x_max)
-            y_mins.append(y_min)
-            y_maxes.append(y_max)
+    for label_group in label_groups:
+        bounds = get_label_bounds(label_group)
+        if bounds is not None:
+            x_mins.append(bounds[0])
+            x_maxes.append(bounds[1])
+            y_mins.append(bounds[2])
+            y_maxes.append(bounds[3])
     return x_mins, x_maxes, y_mins, y_maxes
 
 
@@ -0,0 +1,106 @@
+import io
+import os
+
+
+# how many bytes to read at a time while looking for record boundaries
+BLOCK_SIZE = 16 * 1024 * 1024
+
+
+def find_shards(csv_path, n_shards, block_size=BLOCK_SIZE):
+    """
+    Split a csv file in to roughly equal byte ranges which start and end on record boundaries, so that each range can
+    be parsed on its own. Fields may be quoted and contain newlines, so a newline only ends a record when we aren't
+    inside quotes. Escaped quotes come in pairs, which means counting quotes is enough to keep track of that.
+
+    Returns the header line and a list of (start, end) byte offsets.
+    """
+    size = os.path.getsize(csv_path)
+    with open(csv_path, 'rb') as f:
+        header = f.readline()
+        start = f.tell()
+        targets = [start + (size - start) * i // n_shards for i in range(1, n_shards)]
+
+        boundaries = [start]
+        position = start
+        in_quotes = False
+        for target in targets:
+            if target <= boundaries[-1]:
+                continue
+
+            # skip ahead to the target offset, keeping track of whether we are inside quotes
+            while position < target:
+                block = f.read(min(block_size, target - position))
+                if not block:
+                    break
+                in_quotes ^= block.count(b'"') % 2 == 1
+                position += len(block)
+
+            # the next newline outside of quotes is where the shard ends
+            boundary = None
+            while boundary is None:
+                block = f.read(block_size)
+                if not block:
+                    break
+                index = 0
+                while True:
+                    newline = block.find(b'\n', index)
+                    if newline < 0:
+                        in_quotes ^= block.count(b'"', index) % 2 == 1
+                        break
+                    in_quotes ^= block.count(b'"', index, newline) % 2 == 1
+                    if not in_quotes:
+                        boundary = position + newline + 1
+                        break
+                    index = newline + 1
+                position += len(block)
+
+            if boundary is None or boundary >= size:
+                break
+            boundaries.append(boundary)
+            position = boundary
+            in_quotes = False
+            f.seek(boundary)
+
+    boundaries.append(size)
+    shards = [(begin, end) for begin, end in zip(boundaries[:-1], boundaries[1:]) if end > begin]
+    return header, shards
+
+
+class CSVShardReader(io.RawIOBase):
+    """
+    A read only file object which returns the csv header followed by the bytes of one shard, so a shard can be passed
+    to anything that reads a csv file.
+    """
+
+    def __init__(self, csv_path, header, start, end):
+        super().__init__()
+        self.f = open(csv_path, 'rb')
+        self.f.seek(start)
+        self.header = header
+        self.remaining = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.header:
+            n = min(len(buffer), len(self.header))
+            buffer[:n] = self.header[:n]
+            self.header = self.header[n:]
+            return n
+
+        if self.remaining <= 0:
+            return 0
+        data = self.f.read(min(len(buffer), self.remaining))
+        n = len(data)
+        buffer[:n] = data
+        self.remaining -= n
+        return n
+
+    def close(self):
+        self.f.close()
+        super().close()
+
+
+def open_shard(csv_path, header, start, end):
+    return io.BufferedReader(CSVShardReader(csv_path, header, start, end))
@@ -0,0 +1,117 @@
+"""
+The executor which the per-item stages of the pipelines (a slice, a stack or a ROI at a time) run their items through.
+Items are independent, so they are spread over a pool of worker processes, or a pool of threads for the stages which
+mostly wait on the filesystem. The results come back, and the progress bar moves, in the order of the items.
+
+A worker which raises doesn't stop the others: its error is kept, and all of them are reported (and a TaskError
+raised) once every item has been run. The items in flight are capped by an estimate of their size in memory, so that a
+few large stacks can't take more memory than the machine has however many workers there are.
+
+The number of workers is set once by the pipeline runners (--workers, or 'workers' in the parameters file) with
+set_executor_options. Until then items are run one at a time in the calling process, as they always were.
+"""
+import traceback
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from tqdm import tqdm
+
+
+# see set_executor_options
+workers = 1
+io_workers = 1
+memory_limit = None
+
+# items submitted ahead of the one being waited on, per worker, so that no worker sits idle
+QUEUE_DEPTH = 2
+
+
+class TaskError(Exception):
+    """
+    Raised once all the items of a stage have been run, if any of them failed. errors is a list of (item, traceback).
+    """
+
+    def __init__(self, errors):
+        super().__init__(f'{len(errors)} item(s) failed, the first: {errors[0][0]}\n{errors[0][1]}')
+        self.errors = errors
+
+
+def set_executor_options(nworkers=1, nio_workers=None, memory_limit_mb=None):
+    """
+    nworkers: worker processes for the stages which decode, compute and encode images
+    nio_workers: threads for the stages which only move or remove files (by default the same number)
+    memory_limit_mb: cap on the estimated size of the items in flight, or None for no cap
+    """
+    global workers, io_workers, memory_limit
+    workers = max(1, nworkers or 1)
+    io_workers = max(1, nio_workers or workers)
+    memory_limit = memory_limit_mb * 1024 * 1024 if memory_limit_mb else None
+
+
+def run_task(function, item, args):
+    # the traceback is returned as text, as not every exception can be pickled back from a worker process
+    try:
+        return True, function(item, *args)
+    except Exception:
+        return False, traceback.format_exc()
+
+
+def map_items(function, items, args=(), io=False, item_size=None, unit=' files'):
+    """
+    Run function(item, *args) for every item, in worker processes (or threads if io is set), yielding (item, result)
+    in the order of the items for the ones which succeeded. function has to be defined at the top level of a module, so
+    that it can be sent to a worker process.
+
+    item_size(item): an estimate of the memory (in bytes) running item takes, checked against the memory limit before
+    it is submitted. A single item is always let through, however large.
+    """
+    items = list(items)
+    sizes = [item_size(item) if item_size is not None and memory_limit else 0 for item in items]
+    nworkers = io_workers if io else workers
+    errors = []
+
+    with tqdm(total=len(items), unit=unit) as progress:
+        if nworkers == 1:
+            for item in items:
+                succeeded, result = run_task(function, item, args)
+                progress.update()
+                if succeeded:
+                    yield item, result
+                else:
+                    errors.append((item, result))
+        else:
+            pool_class = ThreadPoolExecutor if io else ProcessPoolExecutor
+            with pool_class(max_workers=nworkers) as pool:
+                pending = deque()
+                in_flight = 0
+                next_index = 0
+                while next_index < len(items) or pending:
+                    while next_index < len(items) and len(pending) < nworkers * QUEUE_DEPTH:
+                        size = sizes[next_index]
+                        if pending and memory_limit and in_flight + size > memory_limit:
+                            break
+                        pending.append((items[next_index], size,
+                                        pool.submit(run_task, function, items[next_index], args)))
+                        in_flight += size
+                        next_index += 1
+
+                    item, size, future = pending.popleft()
+                    succeeded, result = future.result()
+                    in_flight -= size
+                    progress.update()
+                    if succeeded:
+                        yield item, result
+                    else:
+                        errors.append((item, result))
+
+    if errors:
+        for item, error in errors:
+            print(f'Error processing {item}:\n{error}')
+        raise TaskError(errors)
+
+
+def run_items(function, items, args=(), io=False, item_size=None, unit=' files'):
+    """
+    map_items, returning the results in a list.
+    """
+    return [result for _, result in map_items(function, items, args, io=io, item_size=item_size, unit=unit)]
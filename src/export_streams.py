@@ -0,0 +1,149 @@
+"""
+Opens the zooniverse csv for reading however it is stored, so a compressed export never needs unpacking to disk:
+
+    export.csv                          read as it is
+    export.csv.gz, export.csv.zst       decompressed while reading (zst needs the zstandard package)
+    export.tar.gz, export.tgz, ...      the first csv in the archive
+    export.tar.gz::path/in/archive.csv  a named member of the archive
+
+Decompression runs on a background thread, so it overlaps with parsing.
+"""
+import io
+import gzip
+import queue
+import tarfile
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# separates the path of a tar archive from the path of the member to read from it
+TAR_MEMBER_SEPARATOR = '::'
+
+# bytes decompressed at a time, and how many of those blocks may be waiting to be parsed
+READ_SIZE = 4 * 1024 * 1024
+PREFETCH_BLOCKS = 8
+
+
+def split_export_path(path):
+    archive_path, _, member = path.partition(TAR_MEMBER_SEPARATOR)
+    return archive_path, member or None
+
+
+def is_tar(path):
+    archive_path, _ = split_export_path(path)
+    return archive_path.endswith(('.tar', '.tgz', '.tar.gz', '.tar.zst'))
+
+
+def is_compressed(path):
+    """
+    Whether the export has to be streamed through open_export rather than read (and seeked in) as a plain file.
+    """
+    archive_path, _ = split_export_path(path)
+    return is_tar(path) or archive_path.endswith(('.gz', '.zst'))
+
+
+def open_decompressed(path):
+    if path.endswith(('.gz', '.tgz')):
+        return gzip.open(path, 'rb')
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise ImportError(f'Reading {path} needs the zstandard package.')
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+    return open(path, 'rb')
+
+
+def open_tar_member(stream, member_name):
+    """
+    Read through a tar archive as a stream, without seeking, until the wanted member (or the first csv).
+    """
+    archive = tarfile.open(fileobj=stream, mode='r|')
+    for member in archive:
+        if not member.isfile():
+            continue
+        if member.name == member_name or (member_name is None and member.name.endswith('.csv')):
+            return archive, archive.extractfile(member)
+    archive.close()
+    raise FileNotFoundError(f'No {member_name or "csv file"} in the tar archive.')
+
+
+class PrefetchReader(io.RawIOBase):
+    """
+    Reads a stream on a background thread in to a bounded queue of blocks, so that reading and decompressing the
+    next blocks happens while the current one is parsed.
+    """
+
+    def __init__(self, stream, closers=(), read_size=READ_SIZE, prefetch_blocks=PREFETCH_BLOCKS):
+        super().__init__()
+        self.stream = stream
+        self.closers = list(closers)
+        self.blocks = queue.Queue(maxsize=prefetch_blocks)
+        self.block = b''
+        self.offset = 0
+        self.eof = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.prefetch, args=(read_size,), daemon=True)
+        self.thread.start()
+
+    def prefetch(self, read_size):
+        try:
+            while not self.stopped.is_set():
+                block = self.stream.read(read_size)
+                self.put(block)
+                if not block:
+                    break
+        except Exception as e:
+            self.put(e)
+
+    def put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self.offset >= len(self.block):
+            if self.eof:
+                return 0
+            item = self.blocks.get()
+            if isinstance(item, Exception):
+                raise item
+            self.block = item
+            self.offset = 0
+            self.eof = not item
+
+        n = min(len(buffer), len(self.block) - self.offset)
+        buffer[:n] = self.block[self.offset:self.offset + n]
+        self.offset += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.stopped.set()
+            self.thread.join()
+            self.stream.close()
+            for closer in self.closers:
+                closer.close()
+        super().close()
+
+
+def open_export(path):
+    """
+    Open the export as a buffered binary stream, which pandas (or anything else reading a csv) can consume.
+    """
+    archive_path, member_name = split_export_path(path)
+    stream = open_decompressed(archive_path)
+    closers = []
+    if is_tar(path):
+        archive, member = open_tar_member(stream, member_name)
+        closers = [archive, stream]
+        stream = member
+    return io.BufferedReader(PrefetchReader(stream, closers), buffer_size=READ_SIZE)
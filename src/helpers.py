@@ -1,10 +1,16 @@
 from glob import glob
+import re
 import csv
 import matplotlib
 import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
 
 
+# a number inside an annotations string, as written by python's str() of an int or float
+NUMBER_PATTERN = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+
+
 def set_pandas_config():
     pd.set_option('display.max_columns', 30)
     pd.set_option('display.max_rows', 2500)
@@ -20,6 +26,38 @@ def load_processed_csv(path):
                        error_bad_lines=False)
 
 
+def read_processed_csv(path):
+    """
+    Reads a processed csv in to a dictionary of column name -> list of values (as strings), without the overhead of
+    pandas for files which hold a few dozen rows. As with load_processed_csv, lines with too many fields are skipped
+    and lines with too few are padded.
+    """
+    csv.field_size_limit(2**30)
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        columns = {name: [] for name in header}
+        for row in reader:
+            if len(row) > len(header):
+                continue
+            row += [''] * (len(header) - len(row))
+            for name, value in zip(header, row):
+                columns[name].append(value)
+    return columns
+
+
+def parse_annotation_points(annotations):
+    """
+    Parse the annotations string of a processed csv row, e.g. "[[(1.5, 2), (3, 4.5)], [(5, 6)]]", in to one (n, 2)
+    float array per stroke. The numbers are read directly rather than evaluating the string as python.
+    """
+    points = np.array(NUMBER_PATTERN.findall(annotations), dtype=np.float64).reshape(-1, 2)
+    # every stroke ends in a ']', apart from the outermost one, and every point begins with a '('
+    strokes = annotations.strip()[1:-1].split(']')[:-1]
+    ends = np.cumsum([stroke.count('(') for stroke in strokes], dtype=np.int64)
+    return np.split(points, ends[:-1]) if len(strokes) else []
+
+
 def pad(string):
     string = str(string)
     for i in range(max(0, 4 - len(string))):
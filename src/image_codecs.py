@@ -0,0 +1,207 @@
+"""
+Compression codecs for the images and stacks the pipeline writes, named by a spec string:
+
+    none                    uncompressed
+    deflate, deflate:1-9    zlib (the default level is 6, what compress=True has always meant)
+    lzw                     tiff LZW (needs the imagecodecs package)
+    zstd, zstd:1-22         zstandard (needs the zstandard or imagecodecs package, and imagecodecs for tiffs)
+
+Any codec can be followed by '+predictor', which differences neighbouring pixels before compressing. Integer images
+use the tiff horizontal differencing predictor and float images the tiff floating point predictor, which shuffles the
+bytes of each row in to planes (all the most significant bytes, then the next...) before differencing them. This
+usually helps a lot on smooth float label and prediction stacks.
+
+tifffile reads zstd tiffs through imagecodecs, which imagecodecs-lite doesn't stand in for, so without it zstd can
+only be used for volumes (see src/volume_store.py), which decode their own chunks. See check_tiff_codec.
+
+Which codec each stage writes with is set by 'codecs' in the parameters file, see get_stage_codec, and
+src/standalone/codec_benchmark.py measures them on real stacks.
+"""
+import zlib
+from collections import namedtuple
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import imagecodecs
+except ImportError:
+    imagecodecs = None
+
+
+PREDICTOR_SUFFIX = '+predictor'
+DEFAULT_LEVELS = {'none': None, 'deflate': 6, 'lzw': None, 'zstd': 3}
+
+# tiff Compression and Predictor tag values
+TIFF_COMPRESSION = {'none': 1, 'lzw': 5, 'deflate': 8, 'zstd': 50000}
+TIFF_HORIZONTAL_PREDICTOR = 2
+TIFF_FLOAT_PREDICTOR = 3
+
+Codec = namedtuple('Codec', ['name', 'level', 'predictor'])
+
+
+def check_codec_available(name):
+    """
+    Raise an ImportError if the package a codec needs isn't installed, so that a bad choice of codec fails when it is
+    parsed rather than part way through writing a stage.
+    """
+    if name == 'zstd' and zstandard is None and imagecodecs is None:
+        raise ImportError('The zstd codec needs the zstandard or imagecodecs package.')
+    if name == 'lzw' and imagecodecs is None:
+        # imagecodecs-lite installs as imagecodecs_lite, which can't encode lzw
+        raise ImportError('The lzw codec needs the imagecodecs package.')
+
+
+def check_tiff_codec(codec):
+    """
+    Raise an ImportError if tifffile couldn't read back a tiff written with codec.
+    """
+    if parse_codec(codec).name == 'zstd' and imagecodecs is None:
+        raise ImportError('Reading zstd tiffs needs the imagecodecs package, without it zstd can only be used for '
+                          'volumes.')
+
+
+def parse_codec(spec):
+    """
+    A Codec from a spec string such as 'zstd:5+predictor'. A Codec is passed through as it is.
+    """
+    if isinstance(spec, Codec):
+        return spec
+    spec = spec.strip().lower()
+    predictor = spec.endswith(PREDICTOR_SUFFIX)
+    if predictor:
+        spec = spec[:-len(PREDICTOR_SUFFIX)]
+    name, _, level = spec.partition(':')
+    if name not in DEFAULT_LEVELS:
+        raise ValueError(f'Invalid codec: \'{spec}\', expected one of {", ".join(DEFAULT_LEVELS)}.')
+    if level and DEFAULT_LEVELS[name] is None:
+        raise ValueError(f'Codec \'{name}\' has no compression level.')
+    if name == 'none' and predictor:
+        raise ValueError('A predictor needs a compressing codec.')
+    check_codec_available(name)
+    return Codec(name, int(level) if level else DEFAULT_LEVELS[name], predictor)
+
+
+def format_codec(codec):
+    spec = codec.name if codec.level is None else f'{codec.name}:{codec.level}'
+    return spec + PREDICTOR_SUFFIX if codec.predictor else spec
+
+
+def resolve_codec(codec=None, compress=False):
+    """
+    The codec to write with: codec if one is given, otherwise the deflate or no compression that the compress flag has
+    always chosen.
+    """
+    if codec is not None:
+        return parse_codec(codec)
+    return parse_codec('deflate' if compress else 'none')
+
+
+def get_stage_codec(params, stage):
+    """
+    The codec spec for a pipeline stage from the 'codecs' of the parameters, or None to use the stage's default.
+    """
+    return params.get('codecs', {}).get(stage)
+
+
+def check_stage_codecs(params, volume_stages=()):
+    """
+    Parse the codec of every stage in the parameters, raising before any stage runs if one is invalid or needs a
+    package which isn't installed. The stages which don't write volume_stages write tiffs, so their codecs have to be
+    readable from a tiff too.
+    """
+    for stage, spec in params.get('codecs', {}).items():
+        if spec is not None:
+            codec = parse_codec(spec)
+            if stage not in volume_stages:
+                check_tiff_codec(codec)
+
+
+def is_compressed(codec):
+    return parse_codec(codec).name != 'none'
+
+
+def compress_bytes(codec, data):
+    if codec.name == 'none':
+        return data
+    if codec.name == 'deflate':
+        return zlib.compress(data, codec.level)
+    if codec.name == 'zstd':
+        if zstandard is not None:
+            return zstandard.ZstdCompressor(level=codec.level).compress(data)
+        if imagecodecs is not None:
+            return imagecodecs.zstd_encode(data, level=codec.level)
+        raise ImportError('The zstd codec needs the zstandard or imagecodecs package.')
+    if imagecodecs is None:
+        raise ImportError('The lzw codec needs the imagecodecs package.')
+    return imagecodecs.lzw_encode(data)
+
+
+def decompress_bytes(codec, data):
+    if codec.name == 'none':
+        return data
+    if codec.name == 'deflate':
+        return zlib.decompress(data)
+    if codec.name == 'zstd':
+        if zstandard is not None:
+            return zstandard.ZstdDecompressor().decompress(data)
+        if imagecodecs is not None:
+            return imagecodecs.zstd_decode(data)
+        raise ImportError('The zstd codec needs the zstandard or imagecodecs package.')
+    if imagecodecs is None:
+        raise ImportError('The lzw codec needs the imagecodecs package.')
+    return imagecodecs.lzw_decode(data)
+
+
+def get_tiff_predictor(dtype):
+    return TIFF_FLOAT_PREDICTOR if np.dtype(dtype).kind == 'f' else TIFF_HORIZONTAL_PREDICTOR
+
+
+def apply_predictor(array, dtype):
+    """
+    The tiff predictor of array (of dtype, in little endian byte order) along its rows, as the bytes to compress.
+    """
+    rows = np.ascontiguousarray(array, dtype=dtype).reshape(-1, array.shape[-1])
+    if dtype.kind == 'f':
+        # byte planes of each row, most significant first
+        rows = rows.astype(dtype.newbyteorder('>')).view(np.uint8)
+        rows = rows.reshape(len(rows), -1, dtype.itemsize).transpose(0, 2, 1).reshape(len(rows), -1)
+    differences = rows.copy()
+    differences[:, 1:] -= rows[:, :-1]
+    return differences.tobytes()
+
+
+def undo_predictor(data, shape, dtype):
+    width = shape[-1]
+    if dtype.kind == 'f':
+        planes = np.frombuffer(data, dtype=np.uint8).reshape(-1, width * dtype.itemsize)
+        planes = np.cumsum(planes, axis=1, dtype=np.uint8)
+        rows = planes.reshape(len(planes), dtype.itemsize, width).transpose(0, 2, 1)
+        rows = np.ascontiguousarray(rows).view(dtype.newbyteorder('>')).astype(dtype)
+    else:
+        rows = np.cumsum(np.frombuffer(data, dtype=dtype).reshape(-1, width), axis=1, dtype=dtype)
+    return rows.reshape(shape)
+
+
+def encode(codec, array, dtype=None):
+    """
+    The compressed bytes of array, as dtype (the array's own by default) in little endian byte order.
+    """
+    dtype = np.dtype(dtype or array.dtype).newbyteorder('<')
+    if codec.predictor:
+        data = apply_predictor(array, dtype)
+    else:
+        data = np.ascontiguousarray(array, dtype=dtype).tobytes()
+    return compress_bytes(codec, data)
+
+
+def decode(codec, data, shape, dtype):
+    dtype = np.dtype(dtype).newbyteorder('<')
+    data = decompress_bytes(codec, data)
+    if codec.predictor:
+        return undo_predictor(data, shape, dtype)
+    return np.frombuffer(data, dtype=dtype).reshape(shape)
@@ -1,12 +1,23 @@
 import os
-import glob
+import threading
 import numpy as np
 from skimage.io import imsave, imread
+import tifffile
 from tifffile import TiffFile
-from tqdm import tqdm
 from PIL import Image
 
-from src.helpers import get_file
+from src.artifact_catalog import ArtifactCatalog, ArtifactInfo
+from src.executor import map_items
+from src.volume_store import (VOLUME_EXTENSION, COMPRESSION_LEVEL, FAST_COMPRESSION_LEVEL, is_volume, open_volume,
+                               save_volume)
+from src.image_codecs import parse_codec
+from src.stack_writer import open_stack_writer
+
+
+# the file of the catalog of image headers and directory listings, see set_artifact_catalog
+artifact_catalog_path = ':memory:'
+# sqlite connections can't be shared between threads, or used after a fork, so each thread of each process has its own
+artifact_catalogs = threading.local()
 
 
 def get_dict(dict, key):
@@ -44,6 +55,106 @@ def get_tag_resolution(filename):
     return xres, yres, size_z, unit
 
 
+def is_image_file(path):
+    return os.path.isfile(path) or is_volume(path)
+
+
+def read_image(filename):
+    """
+    imread, which can also read a volume from the volume store.
+    """
+    if is_volume(filename):
+        return open_volume(filename)[...]
+    return imread(filename)
+
+
+def open_stack(filename):
+    """
+    Open an image stack without decoding it, where possible, so that windows of it can be read cheaply: volumes are
+    read a chunk at a time and uncompressed tiffs are memory mapped. Anything else (e.g. a compressed tiff) is read in
+    full.
+    """
+    if is_volume(filename):
+        return open_volume(filename)
+    try:
+        stack = tifffile.memmap(filename, mode='r')
+    except ValueError:
+        return imread(filename)
+    # the imagej channel axis save_image adds to stacks
+    if stack.ndim == 4 and stack.shape[1] == 1:
+        stack = stack[:, 0]
+    return stack
+
+
+def read_image_info(filename):
+    """
+    The shape, dtype and resolution of an image (or the first page of a stack), read from the tiff header or volume
+    metadata without decoding any pixels.
+    """
+    if is_volume(filename):
+        volume = open_volume(filename)
+        return ArtifactInfo(volume.shape, volume.dtype, *volume.resolution)
+    with TiffFile(filename) as tif:
+        page = tif.pages[0]
+        shape, dtype = page.shape, page.dtype
+    return ArtifactInfo(shape, dtype, *get_tag_resolution(filename))
+
+
+def set_artifact_catalog(catalog_path):
+    """
+    Keep the artifact catalog in the file catalog_path, so that it lasts between runs. Until this is called the catalog
+    is kept in memory.
+    """
+    global artifact_catalog_path
+    if catalog_path != ':memory:' and os.path.dirname(catalog_path):
+        os.makedirs(os.path.dirname(catalog_path), exist_ok=True)
+    artifact_catalog_path = catalog_path
+    catalog = getattr(artifact_catalogs, 'catalog', None)
+    if catalog is not None and catalog.pid == os.getpid():
+        catalog.close()
+    artifact_catalogs.catalog = ArtifactCatalog(catalog_path, read_image_info)
+
+
+def get_artifact_catalog():
+    # worker processes and threads open their own connection to the catalog
+    catalog = getattr(artifact_catalogs, 'catalog', None)
+    if catalog is None or catalog.pid != os.getpid() or catalog.catalog_path != artifact_catalog_path:
+        catalog = artifact_catalogs.catalog = ArtifactCatalog(artifact_catalog_path, read_image_info)
+    return catalog
+
+
+def find_file(file_pattern):
+    """
+    helpers.get_file, looked up in the artifact catalog.
+    """
+    return get_artifact_catalog().find_file(file_pattern)
+
+
+def get_image_info(filename):
+    """
+    The shape and dtype of an image (or the first page of a stack), from the artifact catalog.
+    """
+    info = get_artifact_catalog().get_info(filename)
+    return info.shape, np.dtype(info.dtype)
+
+
+def get_image_size(filename):
+    """
+    get_tag_imagesize, from the artifact catalog.
+    """
+    shape = get_artifact_catalog().get_info(filename).shape
+    return shape[-1], shape[-2]
+
+
+def get_resolution(filename):
+    """
+    get_tag_resolution, from the artifact catalog, which can also read the resolution of a volume from the volume
+    store.
+    """
+    info = get_artifact_catalog().get_info(filename)
+    return info.resx, info.resy, info.size_z, info.unit
+
+
 def get_tag_imagesize(filename):
     width = 0
     height = 0
@@ -54,11 +165,48 @@ def get_tag_imagesize(filename):
     return width, height
 
 
-def save_image(filepath, image, resx=1, resy=1, size_z=1, res_unit="", compress=False):
+def get_image_bytes(filename):
+    """
+    An estimate of the memory an image or stack takes once decoded, for capping the items the executor has in flight:
+    the size of a volume's pixels, and for a tiff the larger of its first page and the file itself (which is exact for
+    an uncompressed stack).
+    """
+    shape, dtype = get_image_info(filename)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    if is_volume(filename):
+        return nbytes
+    return max(nbytes, os.path.getsize(filename))
+
+
+def save_image(filepath, image, resx=1, resy=1, size_z=1, res_unit="", compress=False, codec=None):
+    """
+    codec: an image_codecs spec (e.g. 'zstd:3+predictor') to compress with, in place of the zlib level 6 (compress=True)
+    or no compression that compress chooses between. Tiffs with no compression or plain deflate are written by tifffile
+    as before, only the codecs it can't write go through the stack writer.
+    """
     # https://pypi.org/project/tifffile/
     # https://scikit-image.org/docs/0.13.x/api/skimage.external.tifffile.html#imsave
     # https://stackoverflow.com/questions/20529187/what-is-the-best-way-to-save-image-metadata-alongside-a-tif
     # imageJ format: dimensions in TZCYXS order
+    if filepath.endswith(VOLUME_EXTENSION):
+        level = COMPRESSION_LEVEL if compress else FAST_COMPRESSION_LEVEL
+        save_volume(filepath, image, resolution=(resx, resy, size_z, res_unit), level=level, codec=codec)
+        return
+
+    level = 6 if compress else None
+    if codec is not None:
+        codec = parse_codec(codec)
+        if codec.name in ('none', 'deflate') and not codec.predictor:
+            level, codec = codec.level, None
+    if codec is not None:
+        # tifffile can't write the other codecs, the stack writer encodes the pages itself
+        pages = image.reshape((-1,) + image.shape[-2:])
+        with open_stack_writer(filepath, pages.shape, image.dtype, codec=codec) as writer:
+            for page in pages:
+                writer.write(page)
+            writer.set_resolution(resx=resx, resy=resy, size_z=size_z, res_unit=res_unit)
+        return
+
     metadata = {}
     image2 = image
     if len(image.shape) > 2:
@@ -70,102 +218,108 @@ def save_image(filepath, image, resx=1, resy=1, size_z=1, res_unit="", compress=
             metadata['spacing'] = size_z
     if res_unit:
         metadata['unit'] = res_unit
-    if compress:
-        imsave(filepath, image2, check_contrast=False, imagej=True, resolution=[resx, resy], metadata=metadata, compress=6)
+    if level:
+        imsave(filepath, image2, check_contrast=False, imagej=True, resolution=[resx, resy], metadata=metadata,
+               compress=level)
     else:
         imsave(filepath, image2, check_contrast=False, imagej=True, resolution=[resx, resy], metadata=metadata)
 
 
-def unstack_images(image_dir, imagestack_dir, output_extension=".tiff", add_prefix_z=True, z_index_offset=0, compress=False):
-    nprocessed = 0
+def unstack_image(stack_filepath, image_dir, output_extension=".tiff", add_prefix_z=True, z_index_offset=0,
+                  compress=False, codec=None):
+    filetitle, _ = os.path.splitext(os.path.basename(stack_filepath))
+    # a volume is read one layer of chunks at a time as we go
+    image_array = open_volume(stack_filepath) if is_volume(stack_filepath) else imread(stack_filepath)
+    resx, resy, size_z, res_unit = get_resolution(stack_filepath)
+    index = 0
+    for image in image_array:
+        image_filename = filetitle + "_"
+        if add_prefix_z:
+            image_filename += "z"
+        image_filename += f"{z_index_offset + index:04d}" + output_extension
+        save_image(os.path.join(image_dir, image_filename), image, resx=resx, resy=resy, size_z=size_z, res_unit=res_unit,
+                   compress=compress, codec=codec)
+        index += 1
+
+
+def unstack_images(image_dir, imagestack_dir, output_extension=".tiff", add_prefix_z=True, z_index_offset=0, compress=False,
+                   codec=None):
+    stack_filepaths = [os.path.join(imagestack_dir, stack_filename) for stack_filename in os.listdir(imagestack_dir)]
+    stack_filepaths = [stack_filepath for stack_filepath in stack_filepaths if is_image_file(stack_filepath)]
 
-    for stack_filename in tqdm(os.listdir(imagestack_dir)):
-        stack_filepath = os.path.join(imagestack_dir, stack_filename)
-        if os.path.isfile(stack_filepath):
-            filetitle, _ = os.path.splitext(stack_filename)
-            image_array = imread(stack_filepath)
-            resx, resy, size_z, res_unit = get_tag_resolution(stack_filepath)
-            index = 0
-            for image in image_array:
-                image_filename = filetitle + "_"
-                if add_prefix_z:
-                    image_filename += "z"
-                image_filename += f"{z_index_offset + index:04d}" + output_extension
-                save_image(os.path.join(image_dir, image_filename), image, resx=resx, resy=resy, size_z=size_z, res_unit=res_unit,
-                           compress=compress)
-                index += 1
-            nprocessed += 1
+    nprocessed = 0
+    for _ in map_items(unstack_image, stack_filepaths,
+                       (image_dir, output_extension, add_prefix_z, z_index_offset, compress, codec),
+                       item_size=get_image_bytes, unit=' stacks'):
+        nprocessed += 1
 
     return nprocessed
 
 
-def get_stack_filenames(image_dir):
-    stack_filenames = set()
-    filenames = []
-    input_extension = "tiff"
-
+def get_slice_index(image_dir):
+    """
+    Group the slice images in image_dir, named <stack>_[z]<slice number>.<extension>, by stack in a single scan of the
+    directory: {stack: {slice number: path}}, with the slices of each stack in order.
+    """
+    index = {}
     for file in os.listdir(image_dir):
-        if os.path.isfile(os.path.join(image_dir, file)):
-            filename, ext = os.path.splitext(file)
-            input_extension = ext
-            filenames.append(filename)
-            filebase = filename.rsplit('_', 1)[0]
-            stack_filenames.add(filebase)
-    return stack_filenames, filenames, input_extension
+        path = os.path.join(image_dir, file)
+        filename, _ = os.path.splitext(file)
+        parts = filename.rsplit('_', 1)
+        if len(parts) == 2 and is_image_file(path):
+            slicei = parts[1][1:] if parts[1].lower().startswith('z') else parts[1]
+            if slicei.isdigit():
+                index.setdefault(parts[0], {})[int(slicei)] = path
+    return {stack: dict(sorted(slices.items())) for stack, slices in index.items()}
+
+
+def get_slice_range(slices):
+    return [min(slices), max(slices)]
+
+
+def write_stack_slice(writer, slices, i):
+    """
+    Write slice number i to a stack writer, or a blank page if there is no image for it.
+    """
+    if i in slices:
+        writer.write(read_image(slices[i]))
+    else:
+        writer.write_blank()
+
+
+def stack_slices(stack, imagestack_dir, size_z, overwrite=False, compress=False, output_extension='.tiff',
+                 codec=None):
+    """
+    Stack the slices ({slice number: path}) of stack, given as (stack filename, slices). Returns the range of slices.
+    """
+    stack_filename, slices = stack
+    output_filepath = os.path.join(imagestack_dir, stack_filename + output_extension)
+    if not overwrite and os.path.exists(output_filepath):
+        return []
+    image_range = get_slice_range(slices)
+    first_filepath = next(iter(slices.values()))
+    shape, dtype = get_image_info(first_filepath)
+    resx, resy, _, res_unit = get_resolution(first_filepath)
+
+    # slices are written as they are read, so only one is held in memory at a time
+    try:
+        with open_stack_writer(output_filepath, (image_range[1] - image_range[0] + 1,) + tuple(shape), dtype,
+                               compress=compress, codec=codec) as writer:
+            for i in range(image_range[0], image_range[1] + 1):
+                write_stack_slice(writer, slices, i)
+            writer.set_resolution(resx=resx, resy=resy, size_z=size_z, res_unit=res_unit)
+    except ValueError as error:
+        print("Stack error", stack_filename, error)
+    return image_range
 
 
-def get_filenames(filebase):
-    image_range = []
-    z_prefix = False
-    filenames = sorted(glob.glob(filebase + "*"))
-    if len(filenames):
-        slicei = os.path.splitext(filenames[0])[0].rsplit('_', 1)[1]
-        z_prefix = slicei.lower().startswith("z")
-        if z_prefix:
-            slicei = slicei[1:]
-        mini = int(slicei)
-        slicei = os.path.splitext(filenames[-1])[0].rsplit('_', 1)[1]
-        if z_prefix:
-            slicei = slicei[1:]
-        maxi = int(slicei)
-        image_range = [mini, maxi]
-
-    return filenames, image_range, z_prefix
-
-
-def stack_images(image_dir, imagestack_dir, size_z, overwrite=False, compress=False):
-    stack_filenames, filenames, input_extension = get_stack_filenames(image_dir)
+def stack_images(image_dir, imagestack_dir, size_z, overwrite=False, compress=False, output_extension='.tiff', codec=None):
     image_range = []
-
-    for stack_filename in tqdm(stack_filenames):
-        if overwrite or not os.path.exists(os.path.join(imagestack_dir, stack_filename + '.tiff')):
-            image_stack = []
-            resx = 1
-            resy = 1
-            res_unit = ""
-
-            filenames, image_range, z_prefix = get_filenames(os.path.join(image_dir, stack_filename))
-            source_image = imread(filenames[0])
-
-            for i in range(image_range[0], image_range[1] + 1):
-                input_filename = stack_filename + '_'
-                if z_prefix:
-                    input_filename += 'z'
-                input_filename += f"{i:04d}" + input_extension
-                input_filepath = os.path.join(image_dir, input_filename)
-                if os.path.exists(input_filepath):
-                    source_image = imread(input_filepath)
-                    resx, resy, _, res_unit = get_tag_resolution(input_filepath)
-                else:
-                    source_image = np.zeros_like(source_image)
-                image_stack.append(source_image)
-
-            np_stack = np.array(image_stack)
-            if np_stack.dtype.kind == "O":
-                print("Stack error", stack_filename, "Type:", np_stack.dtype, "Shape:", np_stack.shape)
-            else:
-                save_image(os.path.join(imagestack_dir, stack_filename + '.tiff'), np_stack, resx=resx, resy=resy, size_z=size_z,
-                           res_unit=res_unit, compress=compress)
+    for _, stack_range in map_items(stack_slices, get_slice_index(image_dir).items(),
+                                    (imagestack_dir, size_z, overwrite, compress, output_extension, codec),
+                                    unit=' stacks'):
+        if stack_range:
+            image_range = stack_range
 
     return image_range
 
@@ -199,31 +353,40 @@ def to_int(image):
     return image2
 
 
-def scale_save_image(input_dir, output_dir, filename, scale_xy, scale_z, binary_format=False, compress=False):
+def rescale_image(raw_image, scale_xy, binary_format=False):
+    """
+    An image, or each image of a stack, scaled by scale_xy in x and y.
+    """
+    height, width = raw_image.shape[-2:]
+    new_width = int(width * scale_xy + 0.5)
+    new_height = int(height * scale_xy + 0.5)
+    if len(raw_image.shape) > 2:
+        # image stack
+        scaled_image = []
+        for image_layer in raw_image:
+            scaled_image.append(scale_image(image_layer, new_width, new_height))
+        scaled_image = np.array(scaled_image)
+    else:
+        scaled_image = scale_image(raw_image, new_width, new_height)
+    if binary_format:
+        scaled_image = to_binary(scaled_image)
+    return scaled_image
+
+
+def scale_save_image(input_dir, output_dir, filename, scale_xy, scale_z, binary_format=False, compress=False, codec=None):
     overwrite = True
 
     # TODO: if z scale is not 1, resample images in z direction
 
-    input_filepath = get_file(os.path.join(input_dir, filename + ".*"))
+    input_filepath = find_file(os.path.join(input_dir, filename + ".*"))
     if input_filepath:
         file_extension = "." + input_filepath.rsplit(".")[-1]
         output_filepath = os.path.join(output_dir, filename + file_extension)
         if overwrite or not os.path.exists(output_filepath):
-            raw_image = imread(input_filepath)
-            resx, resy, size_z, res_unit = get_tag_resolution(input_filepath)
+            raw_image = read_image(input_filepath)
+            resx, resy, size_z, res_unit = get_resolution(input_filepath)
             resx *= scale_xy
             resy *= scale_xy
-            height, width = raw_image.shape[-2:]
-            new_width = int(width * scale_xy + 0.5)
-            new_height = int(height * scale_xy + 0.5)
-            if len(raw_image.shape) > 2:
-                # image stack
-                scaled_image = []
-                for image_layer in raw_image:
-                    scaled_image.append(scale_image(image_layer, new_width, new_height))
-                scaled_image = np.array(scaled_image)
-            else:
-                scaled_image = scale_image(raw_image, new_width, new_height)
-            if binary_format:
-                scaled_image = to_binary(scaled_image)
-            save_image(output_filepath, scaled_image, resx=resx, resy=resy, size_z=size_z, res_unit=res_unit, compress=compress)
+            scaled_image = rescale_image(raw_image, scale_xy, binary_format=binary_format)
+            save_image(output_filepath, scaled_image, resx=resx, resy=resy, size_z=size_z, res_unit=res_unit, compress=compress,
+                       codec=codec)
@@ -5,18 +5,35 @@ import math
 import cv2
 from PIL import Image, ImageDraw
 
+from src.helpers import read_processed_csv, parse_annotation_points
+
+
+def zoom_annotation_points(row_annotations, zoom_factor_x, zoom_factor_y):
+    """
+    Parse one row's annotations string and apply the zoom factors to all of its points in a single multiply.
+    """
+    strokes = parse_annotation_points(row_annotations)
+    if not strokes:
+        return strokes
+    lengths = [len(stroke) for stroke in strokes]
+    points = np.concatenate(strokes) * np.array([zoom_factor_x, zoom_factor_y], dtype=np.float64)
+    return np.split(points, np.cumsum(lengths)[:-1])
+
 
 def get_annotation_points(annotation_data, zoom_factor_x, zoom_factor_y):
-    annotations = []
-    for index, row in annotation_data.iterrows():
-        row_annotations = []
-        for annotation in eval(row.annotations):
-            annotation_points = []
-            for point in annotation:
-                annotation_points.append([point[0] * zoom_factor_x, point[1] * zoom_factor_y])
-            row_annotations.append(annotation_points)
-        annotations.append(row_annotations)
-    return annotations
+    """
+    Returns a list of strokes per row of a processed csv data frame, each stroke an (n, 2) array of points.
+    """
+    return [zoom_annotation_points(row_annotations, zoom_factor_x, zoom_factor_y)
+            for row_annotations in annotation_data['annotations']]
+
+
+def load_processed_annotations(path, zoom_factor_x, zoom_factor_y):
+    """
+    Same as get_annotation_points, reading a processed csv straight from disk.
+    """
+    return [zoom_annotation_points(row_annotations, zoom_factor_x, zoom_factor_y)
+            for row_annotations in read_processed_csv(path)['annotations']]
 
 
 def get_distance(p1, p2):
@@ -32,75 +49,84 @@ def encode_point(segmenti, dir):
     return s
 
 
+def get_endpoint_matches(annotation):
+    """
+    Pair up the stroke endpoints, closest first, each endpoint being used once. An endpoint can be paired with the
+    other end of its own stroke, which closes the stroke on its own.
+
+    Returns the pairs as [from stroke, from end, to stroke, to end, distance], ends being -1 for the last point and 0
+    for the first, in the order they were chosen. Each pair is given from the endpoint of the earlier stroke (or from
+    the last point, for a stroke joined to itself).
+    """
+    l = len(annotation)
+    # endpoint 2i is the last point of stroke i, 2i + 1 its first point
+    endpoints = np.array([stroke[end] for stroke in annotation for end in (-1, 0)], dtype=np.float64).reshape(-1, 2)
+    n = len(endpoints)
+    from_index, to_index = np.triu_indices(n, k=1)
+    differences = endpoints[from_index] - endpoints[to_index]
+    distances = np.sqrt(differences[:, 0] * differences[:, 0] + differences[:, 1] * differences[:, 1])
+    # ties are broken in the order the pairs used to be listed in: by from stroke, to stroke, from end, to end
+    order = np.lexsort((to_index % 2, from_index % 2, to_index // 2, from_index // 2, distances))
+
+    used = np.zeros(n, dtype=bool)
+    matches = []
+    for k in order:
+        f = from_index[k]
+        t = to_index[k]
+        if not used[f] and not used[t]:
+            used[f] = used[t] = True
+            matches.append([int(f // 2), int(f % 2) - 1, int(t // 2), int(t % 2) - 1, float(distances[k])])
+            if len(matches) == l:
+                break
+    return matches
+
+
 def get_closed_points(annotation):
-    segment_distances = []
-    final_segment_distances = []
-    pointdir_done = []
+    """
+    Join the strokes of an annotation in to closed loops, joining the closest endpoints first. Returns a list of
+    points per loop.
+    """
+    final_segment_distances = get_endpoint_matches(annotation)
     l = len(annotation)
 
-    for f in range(l):
-        for t in range(l):
-            for fdir in range(-1, 1):   # last, first element
-                for tdir in range(-1, 1):   # last, first element
-                    if f is not t or fdir is not tdir:
-                        segment_distances.append([f, fdir, t, tdir, get_distance(annotation[f][fdir], annotation[t][tdir])])
-
-    segment_distances = sorted(segment_distances, key=lambda x: x[-1])
-
-    for segment in segment_distances:
-        f = segment[0]
-        t = segment[2]
-        fpdir = encode_point(segment[0], segment[1])
-        tpdir = encode_point(segment[2], segment[3])
-        if fpdir not in pointdir_done and tpdir not in pointdir_done:
-            pointdir_done.append(fpdir)
-            pointdir_done.append(tpdir)
-            final_segment_distances.append(segment)
-
-    #for segment_distance in final_segment_distances:
-    #    print(encode_point(segment_distance[0], segment_distance[1]) +
-    #          " <-> " + encode_point(segment_distance[2], segment_distance[3]) +
-    #          " (" + str(segment_distance[-1]) + ")")
-
-    dsegmenti_done = []
+    # the matches at each stroke, every stroke has two (or one which joins it to itself)
+    stroke_matches = [[] for _ in range(l)]
+    for i, (f, _, t, _, _) in enumerate(final_segment_distances):
+        stroke_matches[f].append(i)
+        if t != f:
+            stroke_matches[t].append(i)
+
+    dsegmenti_done = np.zeros(len(final_segment_distances), dtype=bool)
+    next_start = 0
     segmenti = -1
     endsegmenti = -1
     pointslists = []
     points = []
-    while len(dsegmenti_done) != l:
+    for _ in range(l):
         if segmenti >= 0:
-            i = 0
-            for segment_distance in final_segment_distances:
-                if i not in dsegmenti_done:
-                    if segment_distance[0] == segmenti or segment_distance[2] == segmenti:
-                        dsegmenti = i
-                        dsegment = final_segment_distances[dsegmenti]
-                        if segment_distance[0] == segmenti:
-                            segmenti = segment_distance[2]
-                        else:
-                            segmenti = segment_distance[0]
-                        break
-                i += 1
+            # follow the other match of the current stroke to the next stroke of the loop
+            dsegmenti = next(i for i in stroke_matches[segmenti] if not dsegmenti_done[i])
+            dsegment = final_segment_distances[dsegmenti]
+            segmenti = dsegment[2] if dsegment[0] == segmenti else dsegment[0]
         else:
-            i = 0
-            for segment_distance in final_segment_distances:
-                if i not in dsegmenti_done:
-                    dsegmenti = i
-                    break
-                i += 1
+            # start a new loop from the first match not in one yet
+            while dsegmenti_done[next_start]:
+                next_start += 1
+            dsegmenti = next_start
             dsegment = final_segment_distances[dsegmenti]
             segmenti = dsegment[0]
             endsegmenti = dsegment[2]
 
-        dsegmenti_done.append(dsegmenti)
+        dsegmenti_done[dsegmenti] = True
 
-        segment = annotation[segmenti].copy()
+        # slicing reverses both lists and arrays of points, without modifying the annotation
+        segment = annotation[segmenti]
         if dsegment[0] == segmenti:
             if dsegment[1] == -1:
-                segment.reverse()
+                segment = segment[::-1]
         else:
             if dsegment[3] == -1:
-                segment.reverse()
+                segment = segment[::-1]
         points.extend(segment)
 
         if segmenti == endsegmenti:
@@ -130,13 +156,40 @@ def get_internal_area(annotation, width, height):
     return mat
 
 
-def get_interiors_matrix(annotations, width, height):
-    merged = np.zeros((height, width), np.float32)
+def add_internal_area(counts, annotation):
+    """
+    Add one to counts inside the closed areas of an annotation, only filling the bounding box of the areas rather than
+    a canvas the size of the whole frame.
+    """
+    cv_contours = to_cv_contours(annotation)
+    if not cv_contours:
+        return
+    points = np.concatenate(cv_contours)
+    height, width = counts.shape
+    x_min = max(int(points[:, 0].min()), 0)
+    x_max = min(int(points[:, 0].max()) + 1, width)
+    y_min = max(int(points[:, 1].min()), 0)
+    y_max = min(int(points[:, 1].max()) + 1, height)
+    if x_min >= x_max or y_min >= y_max:
+        return
+    mat = np.zeros((y_max - y_min, x_max - x_min), np.uint8)
+    cv2.fillPoly(mat, cv_contours, 1, offset=(-x_min, -y_min))
+    counts[y_min:y_max, x_min:x_max] += mat
+
+
+def get_interiors_counts(annotations, width, height):
+    """
+    The number of annotations each pixel is inside of.
+    """
+    dtype = np.uint16 if len(annotations) <= np.iinfo(np.uint16).max else np.uint32
+    counts = np.zeros((height, width), dtype)
     for annotation in annotations:
-        closed_areas = get_closed_points(annotation)
-        mat = get_internal_area(closed_areas, width, height)
-        merged += mat
-    return merged / len(annotations)
+        add_internal_area(counts, get_closed_points(annotation))
+    return counts
+
+
+def get_interiors_matrix(annotations, width, height):
+    return get_interiors_counts(annotations, width, height).astype(np.float32) / len(annotations)
 
 
 def threshold(mat):
@@ -144,6 +197,11 @@ def threshold(mat):
     return boolmat
 
 
+def threshold_counts(counts, nannotations):
+    # the same as threshold(counts / nannotations), without dividing
+    return counts >= (nannotations + 1) // 2
+
+
 def getContour(boolmat):
     mat = np.array(boolmat, np.uint8)
     contours, h = cv2.findContours(mat, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)
@@ -165,16 +223,27 @@ def draw_contours(contours, width, height, border_width):
     return np.asarray(img)
 
 
+# draw_contours2 draws the border border_width - 1 wide, which has to be at least a pixel
+MIN_BORDER_WIDTH = 2
+
+
 def draw_contours2(contours, width, height, border_width):
     image = np.zeros((height, width), np.float32)
     cv2.polylines(image, contours, False, 1, border_width - 1, lineType=cv2.LINE_AA)
     return image
 
 
+def get_consensus_contours(annotations, width, height):
+    """
+    The contours of the area inside of at least half of the annotations, which do_interiors_contours draws.
+    """
+    counts = get_interiors_counts(annotations, width, height)
+    finalboolmat = threshold_counts(counts, len(annotations))
+    return getContour(finalboolmat)
+
+
 def do_interiors_contours(annotations, width, height, border_width):
-    mat = get_interiors_matrix(annotations, width, height)
-    finalboolmat = threshold(mat)
-    contours = getContour(finalboolmat)
+    contours = get_consensus_contours(annotations, width, height)
     final = draw_contours2(contours, width, height, border_width)
     return final
 
@@ -1,18 +1,11 @@
 import numpy as np
 import random
 import os
-from glob import glob
-from skimage.io import imread
 import matplotlib.pyplot as plt
 
+from src.image_processing import open_stack, find_file
 from src.ml.augmentation import normalize_batch, augment_and_normalize_batch
-
-
-def get_file(file_pattern):
-    filenames = glob(file_pattern)
-    if len(filenames) != 0:
-        return filenames[0]
-    return ""
+from src.ml.stack_cache import StackCache
 
 
 def get_random_range(begin, end):
@@ -29,21 +22,35 @@ def get_image_patch(image, patch_shape, corner_coordinate):
     return patch
 
 
+def get_label_patch(label, patch_shape, corner_coordinate):
+    # binary conversion by round-off, done per patch as the label stack is only read a window at a time
+    return np.where(np.asarray(get_image_patch(label, patch_shape, corner_coordinate)) >= 0.5, 1, 0)
+
+
+def get_rotated_patch_shape(patch_shape, rotation):
+    """
+    The shape of the window which becomes patch_shape after rotating it by rotation * 90 degrees in y/x.
+    """
+    if rotation % 2 == 0:
+        return list(patch_shape)
+    return [patch_shape[0], patch_shape[2], patch_shape[1]]
+
+
 def get_train_generator(data_loader, batch_size):
     while True:
         image, label = data_loader.get_random_training_stack()
         rand_rot = random.randint(0, 3)
-        image = np.rot90(image, k=rand_rot, axes=(1, 2))  #  randomly rotate 90
-        label = np.rot90(label, k=rand_rot, axes=(1, 2))
+        # randomly rotate 90, rotating just the patches rather than the whole stacks
+        patch_shape = get_rotated_patch_shape(data_loader.patch_shape, rand_rot)
         S = image.shape
         region = (0, S[0], 0, S[1], 0, S[2])
-        corner_coords = data_loader.get_random_batch_corner_coordinates(batch_size, region)
+        corner_coords = data_loader.get_random_batch_corner_coordinates(batch_size, region, patch_shape)
         image_patches = []
         label_patches = []
         for corner in corner_coords:
-            image_patch = get_image_patch(image, data_loader.patch_shape, corner)
+            image_patch = np.rot90(get_image_patch(image, patch_shape, corner), k=rand_rot, axes=(1, 2))
             image_patches.append(image_patch)
-            label_patch = get_image_patch(label, data_loader.patch_shape, corner)
+            label_patch = np.rot90(get_label_patch(label, patch_shape, corner), k=rand_rot, axes=(1, 2))
             label_patches.append(label_patch)
 
         image_patches = np.moveaxis(np.array(image_patches), 1, 3)  # tf --> (N, W, H, D)
@@ -68,7 +75,7 @@ def get_validation_data(data_loader):
         for corner in corner_coords:
             x_patch = get_image_patch(validation_x, data_loader.patch_shape, corner)
             validation_x_patches.append(x_patch)
-            y_patch = get_image_patch(validation_y, data_loader.patch_shape, corner)
+            y_patch = get_label_patch(validation_y, data_loader.patch_shape, corner)
             validation_y_patches.append(y_patch)
 
     validation_x_patches = np.moveaxis(np.array(validation_x_patches), 1, 3)
@@ -96,6 +103,10 @@ class DataLoader:
         self.holdout_rois = data_params['holdout_rois']
         self.training_rois = data_params['training_rois']
 
+        # a budget of 0 turns the cache off, and stacks are then read from disk a patch at a time
+        stack_cache_bytes = data_params.get('stack_cache_mb', 0) * 2 ** 20
+        self.stack_cache = StackCache(stack_cache_bytes) if stack_cache_bytes > 0 else None
+
         self.images_dir = images_dir
         self.labels_dir = labels_dir
         self.save_dir = save_dir
@@ -117,18 +128,35 @@ class DataLoader:
                                   and roi not in self.holdout_rois]
 
     def load_stack_pair(self, roi):
-        image = imread(get_file(self.images_dir + roi + ".*"))
-        label = np.where(imread(get_file(self.labels_dir + roi + ".*")) >= 0.5, 1, 0)   # binary conversion by round-off
+        """
+        Opens the image and label stacks of a roi, without reading them in to memory where the format allows. Patches
+        are read with get_image_patch, and label patches with get_label_patch which also binarizes them.
+        """
+        image = open_stack(find_file(self.images_dir + roi + ".*"))
+        label = open_stack(find_file(self.labels_dir + roi + ".*"))
         return [image, label]
 
+    def get_stack_pair(self, roi):
+        """
+        The stack pair of a roi, from the stack cache (as in-memory arrays, with the label already binarized) if it is
+        enabled.
+        """
+        if self.stack_cache is None:
+            return self.load_stack_pair(roi)
+        return self.stack_cache.get(roi, self.load_stack_pair)
+
     def get_name(self):
         return os.path.join(self.checkpoint_folder, 'model')
 
     def get_random_training_stack(self):
-        return self.load_stack_pair(random.choice(self.training_rois))
+        return self.get_stack_pair(random.choice(self.training_rois))
 
     def get_random_validation_stack(self):
-        return self.load_stack_pair(random.choice(self.validation_rois))
+        return self.get_stack_pair(random.choice(self.validation_rois))
+
+    def print_cache_stats(self):
+        if self.stack_cache is not None:
+            self.stack_cache.print_stats()
 
     def check_data(self):
         print("Training sets")
@@ -141,13 +169,16 @@ class DataLoader:
             pair = self.load_stack_pair(roi)
             print(roi, pair[0].shape, pair[1].shape)
 
-    def get_random_batch_corner_coordinates(self, batch_size, region):
+    def get_random_batch_corner_coordinates(self, batch_size, region, patch_shape=None):
         """ @param region: (Z0, Z1, Y0, Y1, X0, X1) return coordniates in high/low range given
+            @param patch_shape: shape of the patches, if not the model's patch shape
             @return: (batch_size, 3) stacks of random (Z, Y, X) coordinates
         """
-        r = np.array([[get_random_range(region[0], region[1] - self.patch_shape[0]),
-                       get_random_range(region[2], region[3] - self.patch_shape[1]),
-                       get_random_range(region[4], region[5] - self.patch_shape[2])
+        if patch_shape is None:
+            patch_shape = self.patch_shape
+        r = np.array([[get_random_range(region[0], region[1] - patch_shape[0]),
+                       get_random_range(region[2], region[3] - patch_shape[1]),
+                       get_random_range(region[4], region[5] - patch_shape[2])
                        ] for _ in range(batch_size)])
         return r
 
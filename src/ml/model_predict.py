@@ -6,7 +6,7 @@ from skimage.io import imsave, imread
 from tqdm import tqdm
 
 from src.helpers import sizenm_to_dpum
-from src.image_processing import save_image, to_binary
+from src.image_processing import save_image, to_binary, read_image
 from src.ml.DataLoader import get_image_patch
 from src.ml.augmentation import normalize_batch
 
@@ -129,13 +129,13 @@ def evaluate(model, volume):
     return result_volume
 
 
-def model_predict(model, source_dir, predictions_dir, model_size_xy_nm, model_size_z_nm, tri_axis=False):
+def model_predict(model, source_dir, predictions_dir, model_size_xy_nm, model_size_z_nm, tri_axis=False, codec=None):
     resxy = sizenm_to_dpum(model_size_xy_nm)
     size_z_um = model_size_z_nm / 1000
     res_unit = "micron"
     for filename in tqdm(os.listdir(source_dir)):
         input_path = os.path.join(source_dir, filename)
-        input_image = imread(input_path)
+        input_image = read_image(input_path)
 
         output_label = evaluate(model, input_image)
         if tri_axis:
@@ -158,11 +158,14 @@ def model_predict(model, source_dir, predictions_dir, model_size_xy_nm, model_si
                 y_switch_label = y_switch_label[:z_depth, :, :]
 
             z_output_path = os.path.join(split_output_dir, 'z_'+filename)
-            save_image(z_output_path, output_label, resx=resxy, resy=resxy, size_z=size_z_um, res_unit=res_unit, compress=True)
+            save_image(z_output_path, output_label, resx=resxy, resy=resxy, size_z=size_z_um, res_unit=res_unit, compress=True,
+                       codec=codec)
             x_output_path = os.path.join(split_output_dir, 'x_'+filename)
-            save_image(x_output_path, x_switch_label, resx=resxy, resy=resxy, size_z=size_z_um, res_unit=res_unit, compress=True)
+            save_image(x_output_path, x_switch_label, resx=resxy, resy=resxy, size_z=size_z_um, res_unit=res_unit, compress=True,
+                       codec=codec)
             y_output_path = os.path.join(split_output_dir, 'y_'+filename)
-            save_image(y_output_path, y_switch_label, resx=resxy, resy=resxy, size_z=size_z_um, res_unit=res_unit, compress=True)
+            save_image(y_output_path, y_switch_label, resx=resxy, resy=resxy, size_z=size_z_um, res_unit=res_unit, compress=True,
+                       codec=codec)
 
             # gather and threshold
             #output_label = output_label/3 + x_switch_label/3 + y_switch_label/3  # averaging version
@@ -173,4 +176,5 @@ def model_predict(model, source_dir, predictions_dir, model_size_xy_nm, model_si
             output_label = to_binary(output_label)
 
         output_path = os.path.join(predictions_dir, filename)
-        save_image(output_path, output_label, resx=resxy, resy=resxy, size_z=size_z_um, res_unit=res_unit, compress=True)
+        save_image(output_path, output_label, resx=resxy, resy=resxy, size_z=size_z_um, res_unit=res_unit, compress=True,
+                   codec=codec)
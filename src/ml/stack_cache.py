@@ -0,0 +1,66 @@
+"""
+An in-memory cache of decoded image/label stack pairs, keyed by ROI. The training set is small enough that most (or
+all) of it fits in memory, so a stack only needs decoding from disk the first time it is used. The least recently
+used pairs are evicted when the cache grows past its byte budget.
+"""
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class StackCache:
+    """
+    LRU cache of (image, label) pairs holding at most max_bytes. Labels are stored binarized as uint8, so they take a
+    quarter (or less) of the memory of the float label stacks.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.stats = dict(hits=0, misses=0, evictions=0, decode_seconds=0.0)
+
+    def __contains__(self, roi):
+        return roi in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, roi, load):
+        """
+        The (image, label) pair of roi, calling load(roi) to read it from disk if it isn't cached.
+        """
+        if roi in self.entries:
+            self.entries.move_to_end(roi)
+            self.stats['hits'] += 1
+            return self.entries[roi]
+
+        self.stats['misses'] += 1
+        start = time.time()
+        image, label = load(roi)
+        image = np.array(image)
+        label = (np.asarray(label) >= 0.5).astype(np.uint8)
+        self.stats['decode_seconds'] += time.time() - start
+
+        self.put(roi, image, label)
+        return image, label
+
+    def put(self, roi, image, label):
+        size = image.nbytes + label.nbytes
+        if size > self.max_bytes:
+            # would evict everything else and still not fit
+            return
+        while self.entries and self.bytes + size > self.max_bytes:
+            _, (old_image, old_label) = self.entries.popitem(last=False)
+            self.bytes -= old_image.nbytes + old_label.nbytes
+            self.stats['evictions'] += 1
+        self.entries[roi] = (image, label)
+        self.bytes += size
+
+    def print_stats(self):
+        requests = self.stats['hits'] + self.stats['misses']
+        hit_rate = self.stats['hits'] / requests if requests else 0
+        print(f"Stack cache: {len(self.entries)} ROIs, {self.bytes / 2 ** 20:.0f} of {self.max_bytes / 2 ** 20:.0f} MB, "
+              f"{self.stats['hits']} hits, {self.stats['misses']} misses ({hit_rate:.1%} hit rate), "
+              f"{self.stats['evictions']} evictions, {self.stats['decode_seconds']:.1f}s decoding")
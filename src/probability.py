@@ -40,6 +40,60 @@ def probabilistic_aggregate_1x1(matrices, threshold=0.05, target_ratio=0.5, T=0.
     return prob
 
 
+def threshold_otsu_levels(levels, weights, nbins=256):
+    """
+    filters.threshold_otsu of an image in which each of the values levels occurs weights times, from a histogram of
+    the levels rather than of the image itself.
+    """
+    present = weights > 0
+    levels = levels[present]
+    weights = weights[present].astype(float)
+    if levels.min() == levels.max():
+        return levels.min()
+    hist, bin_edges = np.histogram(levels, bins=nbins, range=(levels.min(), levels.max()), weights=weights)
+    bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2
+
+    # class probabilities and means for all possible thresholds, as threshold_otsu computes them
+    weight1 = np.cumsum(hist)
+    weight2 = np.cumsum(hist[::-1])[::-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean1 = np.cumsum(hist * bin_centers) / weight1
+        mean2 = (np.cumsum((hist * bin_centers)[::-1]) / weight2[::-1])[::-1]
+    variance12 = weight1[:-1] * weight2[1:] * (mean1[:-1] - mean2[1:]) ** 2
+    return bin_centers[:-1][np.nanargmax(variance12)]
+
+
+def probabilistic_aggregate_counts(counts, groups, threshold=0.05, target_ratio=0.5, T=0.125):
+    """
+    probabilistic_aggregate_1x1 of groups matrices given by their occupancy counts (the number of matrices which
+    believe each pixel is part of the segmentation). The counts only take groups + 1 values, so P() and the threshold
+    are worked out once per count rather than once per pixel, and the probabilities are float32.
+    """
+    occupancy = np.arange(groups + 1)
+    prob_levels = P(target_ratio - occupancy / groups, T=T)
+
+    if threshold is None or threshold == 'otsu':
+        threshold = threshold_otsu_levels(prob_levels, np.bincount(counts.ravel(), minlength=groups + 1))
+    prob_levels[prob_levels < threshold] = 0
+
+    return prob_levels.astype(np.float32)[counts]
+
+
+def probabilistic_aggregate_streaming(matrices, shape, threshold=0.05, target_ratio=0.5, T=0.125):
+    """
+    probabilistic_aggregate_1x1 of an iterable of matrices of shape (rows, cols), which are added to the occupancy
+    counts one at a time rather than stacked in to a (groups, rows, cols) array.
+    """
+    counts = np.zeros(shape, np.uint16)
+    groups = 0
+    for matrix in matrices:
+        if groups == np.iinfo(counts.dtype).max:
+            counts = counts.astype(np.uint32)
+        counts += matrix.astype(bool)
+        groups += 1
+    return probabilistic_aggregate_counts(counts, groups, threshold=threshold, target_ratio=target_ratio, T=T)
+
+
 def plot_probability_matrix(probability_matrix, title='', image=None, alpha=0.3):
     if image is not None:
         plt.imshow(image, cmap='gray', vmin=0, vmax=255)
@@ -0,0 +1,152 @@
+"""
+Multiscale pyramids of image stacks: copies of a stack downsampled 2x, 4x and 8x in x and y (every slice is kept), for
+the viewers, figures and coarse analyses which only need a thumbnail of a stack rather than the whole of it.
+
+The levels of the stacks in a directory are kept beside it, in <directory>-pyramid/<factor>x/, under the same
+filename as the stack, so that the stages which list the stack directory never see them. A level is rebuilt when its
+stack has changed since it was written.
+
+Images are downsampled by the mean of each 2x2 block. Labels and predictions are downsampled by the max (the OR of a
+mask), so that a thin membrane still shows up at the coarsest level rather than being averaged away.
+"""
+import os
+from contextlib import ExitStack
+
+import numpy as np
+
+from src.artifact_catalog import get_stat
+from src.executor import run_items
+from src.helpers import dpum_to_sizenm
+from src.image_processing import open_stack, get_resolution, is_image_file, get_image_bytes
+from src.stack_writer import open_stack_writer
+
+
+PYRAMID_FACTORS = (2, 4, 8)
+PYRAMID_SUFFIX = '-pyramid'
+
+DOWNSAMPLE_METHODS = ('mean', 'max')
+
+
+def get_pyramid_dir(stacks_dir):
+    return os.path.normpath(stacks_dir) + PYRAMID_SUFFIX
+
+
+def get_level_path(stack_path, factor):
+    stacks_dir, filename = os.path.split(os.path.normpath(stack_path))
+    return os.path.join(get_pyramid_dir(stacks_dir), f'{factor}x', filename)
+
+
+def is_level_current(level_path, stack_path):
+    return is_image_file(level_path) and get_stat(level_path).st_mtime_ns >= get_stat(stack_path).st_mtime_ns
+
+
+def downsample_page(page, method='mean'):
+    """
+    An image halved in x and y, by the mean or max of each 2x2 block. Odd edges are padded by repeating them.
+    """
+    height, width = page.shape
+    if height % 2 or width % 2:
+        page = np.pad(page, ((0, height % 2), (0, width % 2)), mode='edge')
+    blocks = page.reshape(page.shape[0] // 2, 2, page.shape[1] // 2, 2)
+    if method == 'max':
+        return blocks.max(axis=(1, 3))
+    mean = blocks.mean(axis=(1, 3))
+    if page.dtype.kind in 'ui':
+        mean = np.rint(mean)
+    return mean.astype(page.dtype)
+
+
+def build_pyramid(stack_path, method='mean', factors=PYRAMID_FACTORS, codec=None, overwrite=False):
+    """
+    Write the levels of a stack, in a single pass over its slices, each level being downsampled from the one before.
+    Returns the number of levels written, none if they were all up to date.
+    """
+    if method not in DOWNSAMPLE_METHODS:
+        raise ValueError(f'Invalid downsample method: \'{method}\', expected one of {", ".join(DOWNSAMPLE_METHODS)}.')
+    if any(factor < 2 or factor & (factor - 1) for factor in factors):
+        raise ValueError(f'Pyramid factors have to be powers of 2: {factors}')
+    factors = sorted(factors)
+    level_paths = [get_level_path(stack_path, factor) for factor in factors]
+    if not overwrite and all(is_level_current(level_path, stack_path) for level_path in level_paths):
+        return 0
+
+    stack = open_stack(stack_path)
+    pages = [stack] if stack.ndim == 2 else stack
+    resx, resy, size_z, res_unit = get_resolution(stack_path)
+    page_shape = tuple(stack.shape[-2:])
+    depth = 1 if stack.ndim == 2 else stack.shape[0]
+
+    # the levels are finished together when the block ends, or all removed if it raised
+    with ExitStack() as level_writers:
+        writers = []
+        for factor, level_path in zip(factors, level_paths):
+            os.makedirs(os.path.dirname(level_path), exist_ok=True)
+            level_shape = tuple(-(-n // factor) for n in page_shape)
+            writer = level_writers.enter_context(open_stack_writer(level_path, (depth,) + level_shape, stack.dtype,
+                                                                   codec=codec))
+            writer.set_resolution(resx=resx / factor, resy=resy / factor, size_z=size_z, res_unit=res_unit)
+            writers.append((factor, writer))
+
+        for page in pages:
+            page = np.asarray(page)
+            scale = 1
+            for factor, writer in writers:
+                while scale < factor:
+                    page = downsample_page(page, method)
+                    scale *= 2
+                writer.write(page)
+    return len(writers)
+
+
+def build_pyramids(stacks_dir, method='mean', factors=PYRAMID_FACTORS, codec=None, overwrite=False):
+    """
+    Build (or bring up to date) the pyramids of every stack in stacks_dir.
+    """
+    if not factors or not os.path.isdir(stacks_dir):
+        return 0
+    stack_paths = [os.path.join(stacks_dir, filename) for filename in sorted(os.listdir(stacks_dir))]
+    stack_paths = [stack_path for stack_path in stack_paths if is_image_file(stack_path)]
+    nlevels = run_items(build_pyramid, stack_paths, (method, factors, codec, overwrite), item_size=get_image_bytes,
+                        unit=' stacks')
+    print(f'Pyramid levels written: {sum(nlevels)}')
+    return sum(nlevels)
+
+
+def get_pyramid_levels(stack_path):
+    """
+    The (factor, path) of the stack itself and of each of its pyramid levels which is up to date, finest first.
+    """
+    levels = [(1, stack_path)]
+    pyramid_dir = get_pyramid_dir(os.path.dirname(os.path.normpath(stack_path)))
+    if os.path.isdir(pyramid_dir):
+        for level_dir in os.listdir(pyramid_dir):
+            factor = level_dir[:-1]
+            if level_dir.endswith('x') and factor.isdigit():
+                level_path = get_level_path(stack_path, int(factor))
+                if is_level_current(level_path, stack_path):
+                    levels.append((int(factor), level_path))
+    return sorted(levels)
+
+
+def select_pyramid_level(stack_path, pixel_size_nm):
+    """
+    The (factor, path) of the coarsest level of a stack whose pixels are no bigger than pixel_size_nm, which is the
+    stack itself if it has no pyramid (or no resolution to compare with).
+    """
+    resx, _, _, _ = get_resolution(stack_path)
+    if not resx or resx == 1:
+        return 1, stack_path
+    stack_pixel_size_nm = dpum_to_sizenm(resx)
+    selected = (1, stack_path)
+    for factor, level_path in get_pyramid_levels(stack_path):
+        if stack_pixel_size_nm * factor <= pixel_size_nm:
+            selected = (factor, level_path)
+    return selected
+
+
+def open_pyramid_level(stack_path, pixel_size_nm):
+    """
+    open_stack of the coarsest level of a stack which still has pixels of pixel_size_nm or smaller.
+    """
+    _, level_path = select_pyramid_level(stack_path, pixel_size_nm)
+    return open_stack(level_path)
@@ -0,0 +1,228 @@
+"""
+An indexed SQLite catalog of the ingested annotations, with a row per slice, per annotation (one classification of a
+slice), per classification and per user. Steps that only need a count, a resolution or the nearest annotated slice
+can ask the catalog rather than loading annotations.
+"""
+import os
+import sqlite3
+
+from tqdm import tqdm
+
+from src.annotation_store import AnnotationStore, get_slice_index
+from src.helpers import read_processed_csv
+
+
+SCHEMA = """
+CREATE TABLE slices (
+    filename TEXT PRIMARY KEY,
+    roi TEXT NOT NULL,
+    slice_z TEXT NOT NULL,
+    z INTEGER NOT NULL,
+    annotations INTEGER NOT NULL,
+    xy_res REAL,
+    z_res REAL
+);
+CREATE INDEX slices_roi_z ON slices (roi, z);
+
+CREATE TABLE annotations (
+    filename TEXT NOT NULL,
+    classification_id INTEGER NOT NULL,
+    xy_res REAL,
+    z_res REAL
+);
+CREATE INDEX annotations_filename ON annotations (filename);
+CREATE INDEX annotations_classification ON annotations (classification_id);
+
+CREATE TABLE classifications (
+    classification_id INTEGER PRIMARY KEY,
+    user_name TEXT,
+    subject_id TEXT,
+    expert INTEGER
+);
+CREATE INDEX classifications_user ON classifications (user_name);
+
+CREATE TABLE users (
+    user_name TEXT PRIMARY KEY,
+    classifications INTEGER NOT NULL,
+    annotations INTEGER NOT NULL
+);
+"""
+
+
+def most_frequent(values):
+    """
+    Most frequent of the (non nan) values, taking the smallest on ties, or None if there are none.
+    """
+    counts = dict()
+    for value in values:
+        if value == value:
+            counts[value] = counts.get(value, 0) + 1
+    if not counts:
+        return None
+    return min(counts.items(), key=lambda item: (-item[1], item[0]))[0]
+
+
+class SliceCatalog:
+    """
+    Read access to a catalog written by build_slice_catalog.
+    """
+
+    def __init__(self, catalog_path):
+        self.connection = sqlite3.connect(catalog_path)
+
+    def close(self):
+        self.connection.close()
+
+    def query_one(self, sql, parameters=()):
+        row = self.connection.execute(sql, parameters).fetchone()
+        return row[0] if row is not None else None
+
+    def keys(self):
+        return [filename for filename, in self.connection.execute('SELECT filename FROM slices ORDER BY filename')]
+
+    def __contains__(self, filename):
+        return self.query_one('SELECT 1 FROM slices WHERE filename = ?', (filename,)) is not None
+
+    def count_annotations(self, filename):
+        """
+        Number of annotations of a slice, 0 if it has none.
+        """
+        return self.query_one('SELECT annotations FROM slices WHERE filename = ?', (filename,)) or 0
+
+    def get_xy_resolution(self, filename):
+        """
+        Most frequent raw xy resolution of the annotations of a slice (there are occasional errors in the csv).
+        """
+        return self.query_one('SELECT xy_res FROM slices WHERE filename = ?', (filename,))
+
+    def get_z_resolution(self, filename):
+        return self.query_one('SELECT z_res FROM slices WHERE filename = ?', (filename,))
+
+    def nearest_slice(self, roi, slice_z, max_distance=500):
+        """
+        Filename of the annotated slice of a ROI closest to slice_z, preferring the later slice when two are equally
+        close. Returns None if there is none within max_distance.
+        """
+        z = get_slice_index(slice_z)
+        return self.query_one('SELECT filename FROM slices WHERE roi = ? AND z BETWEEN ? AND ? '
+                              'ORDER BY ABS(z - ?), z DESC LIMIT 1', (roi, z - max_distance, z + max_distance, z))
+
+    def get_annotators(self, filename):
+        """
+        Names of the users who annotated a slice, in order of classification.
+        """
+        return [user_name for user_name, in self.connection.execute(
+            'SELECT c.user_name FROM annotations a JOIN classifications c USING (classification_id) '
+            'WHERE a.filename = ? ORDER BY a.classification_id', (filename,))]
+
+    def get_users(self):
+        """
+        (user name, classifications, annotations) for every user, most active first.
+        """
+        return self.connection.execute('SELECT user_name, classifications, annotations FROM users '
+                                       'ORDER BY annotations DESC, user_name').fetchall()
+
+
+def get_xy_scale(slice_catalog, filename, targetsize_nm_xy):
+    # assumption: all annotations for the same slice have the same physical resolution... this should be the case
+
+    if filename not in slice_catalog:
+        # no annotations for this slice, find nearest
+        roi, slice_z = filename.rsplit('_', 1)
+        filename = slice_catalog.nearest_slice(roi, slice_z)
+        if filename is None:
+            return 0
+
+    # take most frequent reference value (there are occasional errors in the csv)
+    res_nm_xy = slice_catalog.get_xy_resolution(filename)
+    if res_nm_xy is None:
+        # no valid resolution in any of the slice's annotations
+        return 0
+    scale_xy = res_nm_xy / targetsize_nm_xy
+
+    # TODO: if z scale is not target z scale, 'skip' or interpolate images somehow?
+    # res_nm_z = csv_file['raw z resolution (nm)'][0]
+    # scale_z = res_nm_z / targetsize_nm_z
+
+    return scale_xy
+
+
+def insert_slice(connection, annotation_store, roi, slice_z, filename):
+    classification_ids = annotation_store.get_column(filename, 'classification_id').tolist()
+    xy_res = annotation_store.get_column(filename, 'raw_xy_res').tolist()
+    z_res = annotation_store.get_column(filename, 'raw_z_res').tolist()
+
+    connection.execute('INSERT INTO slices VALUES (?, ?, ?, ?, ?, ?, ?)',
+                       (filename, roi, slice_z, get_slice_index(slice_z), len(classification_ids),
+                        most_frequent(xy_res), most_frequent(z_res)))
+    connection.executemany('INSERT INTO annotations VALUES (?, ?, ?, ?)',
+                           [(filename, classification_id, xy if xy == xy else None, z if z == z else None)
+                            for classification_id, xy, z in zip(classification_ids, xy_res, z_res)])
+
+
+def insert_classifications(connection, classifications_csv_path, after_id=None):
+    """
+    Insert the classifications of the per-classification csv, only the ones with an id above after_id if given, and
+    count the classifications and annotations of every user again.
+    """
+    if os.path.exists(classifications_csv_path):
+        classifications = read_processed_csv(classifications_csv_path)
+        rows = zip([int(c) for c in classifications['classification id']],
+                   classifications['user name'],
+                   classifications['subject id'],
+                   [expert == 'True' for expert in classifications['expert']])
+        if after_id is not None:
+            rows = (row for row in rows if row[0] > after_id)
+        connection.executemany('INSERT OR REPLACE INTO classifications VALUES (?, ?, ?, ?)', rows)
+
+    connection.execute('DELETE FROM users')
+    connection.execute('INSERT INTO users SELECT c.user_name, COUNT(DISTINCT c.classification_id), '
+                       'COUNT(a.classification_id) FROM classifications c '
+                       'LEFT JOIN annotations a USING (classification_id) GROUP BY c.user_name')
+
+
+def build_slice_catalog(store_dir, classifications_csv_path, catalog_path):
+    """
+    Build the catalog from the annotation store and the per-classification csv written while converting the
+    zooniverse csv.
+    """
+    if os.path.exists(catalog_path):
+        os.remove(catalog_path)
+
+    annotation_store = AnnotationStore(store_dir)
+    connection = sqlite3.connect(catalog_path)
+    with connection:
+        connection.executescript(SCHEMA)
+
+        for roi, slice_z, filename in tqdm(annotation_store.slices):
+            insert_slice(connection, annotation_store, roi, slice_z, filename)
+
+        insert_classifications(connection, classifications_csv_path)
+    connection.close()
+
+    return len(annotation_store.slices)
+
+
+def update_slice_catalog(store_dir, classifications_csv_path, catalog_path, filenames):
+    """
+    Replace only the rows of the slices filenames (e.g. the ones changed by an incremental ingest) in an existing
+    catalog, adding the classifications newer than any already in it, or build the catalog if there isn't one yet.
+    """
+    if not os.path.exists(catalog_path):
+        return build_slice_catalog(store_dir, classifications_csv_path, catalog_path)
+
+    annotation_store = AnnotationStore(store_dir)
+    connection = sqlite3.connect(catalog_path)
+    with connection:
+        for filename in tqdm(sorted(filenames)):
+            connection.execute('DELETE FROM slices WHERE filename = ?', (filename,))
+            connection.execute('DELETE FROM annotations WHERE filename = ?', (filename,))
+            if filename in annotation_store:
+                roi, slice_z, _ = annotation_store.slices[annotation_store.by_filename[filename]]
+                insert_slice(connection, annotation_store, roi, slice_z, filename)
+
+        last_id = connection.execute('SELECT MAX(classification_id) FROM classifications').fetchone()[0]
+        insert_classifications(connection, classifications_csv_path, after_id=last_id)
+    connection.close()
+
+    return len(annotation_store.slices)
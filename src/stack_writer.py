@@ -0,0 +1,285 @@
+"""
+Writers which build an image stack one slice at a time, so that stacking a directory of images only ever holds about
+one slice in memory, however deep the stack is.
+
+TiffStackWriter writes an ImageJ compatible tiff: the page data is appended as slices arrive, back to back so that an
+uncompressed stack can still be memory mapped, and the page directories and the ImageJ metadata (spacing, unit) are
+written after the last page, when the stack is closed. A stack past the 4 GiB of a classic tiff is written as a
+BigTIFF instead, which tifffile reads but ImageJ only opens through Bio-Formats. VolumeStackWriter does the same for the volume store, a layer
+of chunks at a time.
+"""
+import os
+import shutil
+import struct
+from fractions import Fraction
+
+import numpy as np
+
+from src.image_codecs import TIFF_COMPRESSION, check_tiff_codec, encode, get_tiff_predictor, resolve_codec
+from src.volume_store import VOLUME_EXTENSION, COMPRESSION_LEVEL, FAST_COMPRESSION_LEVEL, create_volume
+
+
+IMAGEJ_VERSION = '1.11a'
+
+# tiff field types
+ASCII = 2
+SHORT = 3
+LONG = 4
+RATIONAL = 5
+LONG8 = 16
+
+TIFF_MINISBLACK = 1
+TIFF_NO_RESOLUTION_UNIT = 1
+TIFF_SAMPLE_FORMATS = {'u': 1, 'i': 2, 'f': 3}
+
+# ImageJ can't read BigTIFF, so stacks are classic tiffs as long as they fit in its 32 bit offsets
+MAX_TIFF_SIZE = 2 ** 32
+
+# room for the header of either, the header of a classic tiff is padded to the size of a BigTIFF's
+HEADER_SIZE = 16
+
+
+def rational(value, max_denominator=1000000):
+    fraction = Fraction(float(value)).limit_denominator(max_denominator)
+    return fraction.numerator, fraction.denominator
+
+
+def imagej_description(nimages, size_z=1, unit=''):
+    description = f'ImageJ={IMAGEJ_VERSION}\n'
+    if nimages > 1:
+        description += f'images={nimages}\nslices={nimages}\nloop=false\n'
+    if unit:
+        description += f'unit={unit}\n'
+    if nimages > 1 and size_z and size_z != 1:
+        description += f'spacing={size_z}\n'
+    return description
+
+
+class StackWriter:
+    """
+    Base of the stack writers. Used as a context manager, the stack is finished on leaving the block, or removed if
+    the block raised.
+    """
+
+    def __init__(self, path, shape, dtype):
+        self.path = path
+        self.page_shape = tuple(shape[-2:])
+        self.dtype = np.dtype(np.uint8) if np.dtype(dtype).kind == 'b' else np.dtype(dtype)
+        self.resolution = (1, 1, 1, '')
+
+    def set_resolution(self, resx=1, resy=1, size_z=1, res_unit=''):
+        self.resolution = (resx, resy, size_z, res_unit)
+
+    def check_page(self, image):
+        image = np.asarray(image)
+        if image.shape != self.page_shape:
+            raise ValueError(f'Slice shape {image.shape} does not match the stack slice shape {self.page_shape}.')
+        if not np.can_cast(image.dtype, self.dtype):
+            raise ValueError(f'Slice type {image.dtype} does not fit in the stack type {self.dtype}.')
+        return image
+
+    def write(self, image):
+        raise NotImplementedError
+
+    def write_blank(self):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    def abort(self):
+        raise NotImplementedError
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+class TiffStackWriter(StackWriter):
+
+    def __init__(self, path, shape, dtype, codec):
+        super().__init__(path, shape, dtype)
+        if self.dtype.kind not in TIFF_SAMPLE_FORMATS:
+            raise ValueError(f'Can not write {self.dtype} images to a tiff stack.')
+        check_tiff_codec(codec)
+        self.dtype = self.dtype.newbyteorder('<')
+        self.codec = codec
+        self.offsets = []
+        self.bytecounts = []
+        self.blank = None
+        self.file = open(path, 'wb')
+        # the header is written on close, when it is known whether the stack fits in a classic tiff
+        self.file.write(b'\0' * HEADER_SIZE)
+
+    def write_data(self, data):
+        offset = self.file.tell()
+        self.file.write(data)
+        self.offsets.append(offset)
+        self.bytecounts.append(len(data))
+
+    def write(self, image):
+        self.write_data(encode(self.codec, self.check_page(image), self.dtype))
+
+    def write_blank(self):
+        if self.blank is None:
+            self.blank = encode(self.codec, np.zeros(self.page_shape, dtype=self.dtype))
+        self.write_data(self.blank)
+
+    def get_directory(self, index, offset, description, bigtiff=False):
+        """
+        The directory of page index, to be written at offset, followed by the values which don't fit in its entries.
+        """
+        resx, resy, _, _ = self.resolution
+        height, width = self.page_shape
+        tags = [(254, LONG, 1, 0),
+                (256, LONG, 1, width),
+                (257, LONG, 1, height),
+                (258, SHORT, 1, self.dtype.itemsize * 8),
+                (259, SHORT, 1, TIFF_COMPRESSION[self.codec.name]),
+                (262, SHORT, 1, TIFF_MINISBLACK)]
+        if index == 0:
+            # ImageJ only reads the description of the first page
+            tags.append((270, ASCII, len(description), description))
+        tags += [(273, LONG8 if bigtiff else LONG, 1, self.offsets[index]),
+                 (277, SHORT, 1, 1),
+                 (278, LONG, 1, height),
+                 (279, LONG8 if bigtiff else LONG, 1, self.bytecounts[index]),
+                 (282, RATIONAL, 1, struct.pack('<2I', *rational(resx))),
+                 (283, RATIONAL, 1, struct.pack('<2I', *rational(resy))),
+                 (296, SHORT, 1, TIFF_NO_RESOLUTION_UNIT)]
+        if self.codec.predictor:
+            tags.append((317, SHORT, 1, get_tiff_predictor(self.dtype)))
+        tags.append((339, SHORT, 1, TIFF_SAMPLE_FORMATS[self.dtype.kind]))
+
+        if bigtiff:
+            # 8 byte counts and offsets, and values of up to 8 bytes are kept in the entry
+            values_offset = offset + 8 + 20 * len(tags) + 8
+            entries = struct.pack('<Q', len(tags))
+            entry_format, value_size = '<HHQ', 8
+        else:
+            values_offset = offset + 2 + 12 * len(tags) + 4
+            entries = struct.pack('<H', len(tags))
+            entry_format, value_size = '<HHI', 4
+        values = b''
+        for code, field_type, count, value in tags:
+            entries += struct.pack(entry_format, code, field_type, count)
+            if field_type == SHORT:
+                value = struct.pack('<H', value)
+            elif field_type == LONG:
+                value = struct.pack('<I', value)
+            elif field_type == LONG8:
+                value = struct.pack('<Q', value)
+            if len(value) <= value_size:
+                entries += value + b'\0' * (value_size - len(value))
+            else:
+                entries += struct.pack('<Q' if bigtiff else '<I', values_offset + len(values))
+                values += value + b'\0' * (len(value) % 2)
+        return entries, values
+
+    def write_directories(self, first_offset, description, bigtiff):
+        """
+        Write the page directories from first_offset on. Returns False, having written nothing, if they don't fit in a
+        classic tiff.
+        """
+        offset = first_offset
+        directories = []
+        for index in range(len(self.offsets)):
+            entries, values = self.get_directory(index, offset, description, bigtiff)
+            next_offset = offset + len(entries) + (8 if bigtiff else 4) + len(values)
+            if not bigtiff and next_offset >= MAX_TIFF_SIZE:
+                return False
+            last = index == len(self.offsets) - 1
+            directories.append(entries + struct.pack('<Q' if bigtiff else '<I', 0 if last else next_offset) + values)
+            offset = next_offset
+        self.file.seek(first_offset)
+        self.file.writelines(directories)
+        return True
+
+    def close(self):
+        if self.file is None:
+            return
+        if not self.offsets:
+            self.abort()
+            raise ValueError(f'Stack {self.path} has no slices.')
+        resx, resy, size_z, res_unit = self.resolution
+        description = imagej_description(len(self.offsets), size_z, res_unit).encode('ascii') + b'\0'
+
+        # directories have to start on a word boundary
+        if self.file.tell() % 2:
+            self.file.write(b'\0')
+        first_offset = self.file.tell()
+        bigtiff = first_offset >= MAX_TIFF_SIZE or not self.write_directories(first_offset, description, False)
+        if bigtiff:
+            self.write_directories(first_offset, description, True)
+
+        self.file.seek(0)
+        if bigtiff:
+            self.file.write(b'II' + struct.pack('<HHHQ', 43, 8, 0, first_offset))
+        else:
+            self.file.write(b'II' + struct.pack('<HI', 42, first_offset))
+        self.file.close()
+        self.file = None
+
+    def abort(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class VolumeStackWriter(StackWriter):
+
+    def __init__(self, path, shape, dtype, codec=None, compress=False):
+        super().__init__(path, shape, dtype)
+        level = COMPRESSION_LEVEL if compress else FAST_COMPRESSION_LEVEL
+        self.volume = create_volume(path, shape, self.dtype, level=level, codec=codec)
+        self.layer = np.zeros((self.volume.chunks[0],) + self.page_shape, dtype=self.dtype)
+        self.start = 0
+        self.nlayer = 0
+
+    def add(self, image):
+        if self.start + self.nlayer >= self.volume.shape[0]:
+            raise ValueError(f'Stack {self.path} only has {self.volume.shape[0]} slices.')
+        self.layer[self.nlayer] = image
+        self.nlayer += 1
+        if self.nlayer == len(self.layer):
+            self.flush()
+
+    def write(self, image):
+        self.add(self.check_page(image))
+
+    def write_blank(self):
+        self.add(0)
+
+    def flush(self):
+        if self.nlayer:
+            height, width = self.page_shape
+            self.volume.write_window([(self.start, self.start + self.nlayer), (0, height), (0, width)],
+                                     self.layer[:self.nlayer])
+            self.start += self.nlayer
+            self.nlayer = 0
+
+    def close(self):
+        self.flush()
+        self.volume.set_resolution(self.resolution)
+
+    def abort(self):
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+
+
+def open_stack_writer(filepath, shape, dtype, compress=False, codec=None):
+    """
+    A stack writer for a stack of shape (slices, y, x), in the volume store if filepath ends in VOLUME_EXTENSION and
+    as a tiff otherwise. codec (see image_codecs) takes precedence over compress.
+    """
+    if filepath.endswith(VOLUME_EXTENSION):
+        return VolumeStackWriter(filepath, shape, dtype, codec=codec, compress=compress)
+    return TiffStackWriter(filepath, shape, dtype, resolve_codec(codec, compress))
@@ -0,0 +1,123 @@
+"""
+Measures the image codecs (see src/image_codecs.py) on a sample of real stacks, page by page as the tiff writer
+compresses them, and reports the compression ratio and encode / decode throughput of each, per directory. Each
+codec's stacks are also written as tiffs by the stack writer and read back with tifffile, as the next stage would read
+them, and a codec tifffile can't read is reported as only usable for volumes. Use it to
+choose the 'codecs' of each stage in the parameters file, e.g. on the training stacks and the prediction pipeline's
+scaled predictions:
+
+    python codec_benchmark.py --dirs projects/nuclear/resources/images/cropped-labels-stacks \
+                                     projects/nuclear/resources/images/scaled-predictions-stacks --samples 3
+"""
+import os
+import time
+import random
+import argparse
+import tempfile
+
+import numpy as np
+import tifffile
+
+from src.image_codecs import parse_codec, format_codec, encode, decode, check_tiff_codec
+from src.image_processing import read_image, is_image_file
+from src.stack_writer import open_stack_writer
+
+
+DEFAULT_CODECS = ['none', 'deflate:1', 'deflate:6', 'deflate:9', 'deflate:6+predictor', 'lzw', 'lzw+predictor',
+                  'zstd:1', 'zstd:3', 'zstd:9', 'zstd:3+predictor']
+
+
+def sample_stacks(stacks_dir, nsamples, seed=0):
+    filenames = sorted(f for f in os.listdir(stacks_dir) if is_image_file(os.path.join(stacks_dir, f)))
+    filenames = random.Random(seed).sample(filenames, min(nsamples, len(filenames)))
+    return [(filename, read_image(os.path.join(stacks_dir, filename))) for filename in filenames]
+
+
+def benchmark_codec(codec, stacks):
+    """
+    (raw bytes, compressed bytes, encode seconds, decode seconds) of compressing every page of the stacks.
+    """
+    raw_bytes = 0
+    compressed_bytes = 0
+    encode_seconds = 0.0
+    decode_seconds = 0.0
+    for filename, stack in stacks:
+        for page in stack.reshape((-1,) + stack.shape[-2:]):
+            start = time.perf_counter()
+            data = encode(codec, page)
+            encode_seconds += time.perf_counter() - start
+
+            start = time.perf_counter()
+            decoded = decode(codec, data, page.shape, page.dtype)
+            decode_seconds += time.perf_counter() - start
+
+            # compared as bytes, so that nans compare equal
+            if decoded.tobytes() != np.ascontiguousarray(page, dtype=decoded.dtype).tobytes():
+                raise ValueError(f'Codec {format_codec(codec)} did not decode a page of {filename} to the original.')
+            raw_bytes += page.nbytes
+            compressed_bytes += len(data)
+    return raw_bytes, compressed_bytes, encode_seconds, decode_seconds
+
+
+def check_tiff_round_trip(codec, stacks, tiff_dir):
+    """
+    Write the stacks as tiffs with codec and read them back with tifffile. Returns False if tifffile can't read the
+    codec, so that it can only be used for volumes.
+    """
+    try:
+        check_tiff_codec(codec)
+    except ImportError:
+        return False
+    for filename, stack in stacks:
+        pages = stack.reshape((-1,) + stack.shape[-2:])
+        tiff_path = os.path.join(tiff_dir, 'stack.tiff')
+        with open_stack_writer(tiff_path, pages.shape, pages.dtype, codec=codec) as writer:
+            for page in pages:
+                writer.write(page)
+        decoded = tifffile.imread(tiff_path).reshape(pages.shape)
+        if decoded.tobytes() != np.ascontiguousarray(pages, dtype=decoded.dtype).tobytes():
+            raise ValueError(f'Codec {format_codec(codec)} did not read back {filename} from a tiff as the original.')
+    return True
+
+
+def print_benchmark(stacks_dir, stacks, codecs):
+    dtypes = sorted(set(str(stack.dtype) for _, stack in stacks))
+    print(f'\n{stacks_dir}: {len(stacks)} stacks ({", ".join(dtypes)})')
+    print(f'{"codec":<22}{"ratio":>8}{"size MB":>10}{"encode MB/s":>14}{"decode MB/s":>14}  tiff')
+    with tempfile.TemporaryDirectory() as tiff_dir:
+        for codec in codecs:
+            raw_bytes, compressed_bytes, encode_seconds, decode_seconds = benchmark_codec(codec, stacks)
+            tiff = 'ok' if check_tiff_round_trip(codec, stacks, tiff_dir) else 'volumes only'
+            megabytes = raw_bytes / 1e6
+            print(f'{format_codec(codec):<22}{raw_bytes / max(compressed_bytes, 1):>8.2f}'
+                  f'{compressed_bytes / 1e6:>10.1f}{megabytes / max(encode_seconds, 1e-9):>14.1f}'
+                  f'{megabytes / max(decode_seconds, 1e-9):>14.1f}  {tiff}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("Benchmark the image codecs on a sample of stacks.")
+    parser.add_argument('--dirs',
+                        nargs='+',
+                        help='Directories of stacks to sample, relative to the project root.',
+                        default=['projects/nuclear/resources/images/cropped-stacks',
+                                 'projects/nuclear/resources/images/cropped-labels-stacks'])
+    parser.add_argument('--samples',
+                        type=int,
+                        help='Number of stacks to sample from each directory.',
+                        default=3)
+    parser.add_argument('--codecs',
+                        nargs='+',
+                        help='Codec specs to measure.',
+                        default=DEFAULT_CODECS)
+    args = parser.parse_args()
+
+    # codecs whose package isn't installed are left out
+    codecs = []
+    for spec in args.codecs:
+        try:
+            codecs.append(parse_codec(spec))
+        except ImportError as error:
+            print(f'{spec:<22}skipped: {error}')
+    for stacks_dir in args.dirs:
+        stacks_dir = os.path.join('../..', stacks_dir)
+        print_benchmark(stacks_dir, sample_stacks(stacks_dir, args.samples), codecs)
@@ -13,6 +13,9 @@ from src.helpers import *
 import numpy as np
 from skimage.io import imread
 
+from src.image_processing import open_stack
+from src.pyramid import get_level_path, select_pyramid_level
+
 
 mpl.rcParams['figure.dpi'] = 320
 
@@ -20,7 +23,7 @@ label_intensity = 0.5
 
 
 class ImageExtractor:
-    def __init__(self, image_dir, label_dir, save_dir, roi, use_stacks, start=0):
+    def __init__(self, image_dir, label_dir, save_dir, roi, use_stacks, start=0, pixel_size_nm=None):
         self.image_dir = image_dir
         self.label_dir = label_dir
         self.save_dir = save_dir
@@ -28,6 +31,8 @@ class ImageExtractor:
         self.use_stacks = use_stacks
         self.index = start
         self.len = 0
+        # show the stacks at the coarsest pyramid level that is at least this fine, rather than at full resolution
+        self.pixel_size_nm = pixel_size_nm
         self.init()
 
     def next(self):
@@ -44,18 +49,32 @@ class ImageExtractor:
             self.index = self.len - 1
         return self.index
 
+    def get_stack_factor(self, filepaths):
+        # the image and label stack are shown at the same level, so that they still overlay
+        if not self.pixel_size_nm:
+            return 1
+        return min(select_pyramid_level(filepath, self.pixel_size_nm)[0] for filepath in filepaths if filepath)
+
+    def read_stack(self, filepath, factor):
+        if factor > 1:
+            return np.asarray(open_stack(get_level_path(filepath, factor)))
+        return imread(filepath)
+
     def init(self):
         print("Reading images...")
         if use_stacks:
-            filepath = get_file(self.image_dir + self.roi + ".*")
+            image_filepath = get_file(self.image_dir + self.roi + ".*")
+            label_filepath = get_file(self.label_dir + self.roi + ".*")
+            factor = self.get_stack_factor([image_filepath, label_filepath])
+            filepath = image_filepath
             if filepath:
-                self.image_stack = imread(filepath)
+                self.image_stack = self.read_stack(filepath, factor)
                 self.len = len(self.image_stack)
             else:
                 print("No source image found")
-            filepath = get_file(self.label_dir + self.roi + ".*")
+            filepath = label_filepath
             if filepath:
-                self.label_stack = imread(filepath) > 0.5
+                self.label_stack = self.read_stack(filepath, factor) > 0.5
                 self.len = len(self.label_stack)
             else:
                 print("No label image found")
@@ -200,8 +219,8 @@ class ImageViewer(tk.Frame):
         self.next()
 
 
-def view_images(image_dir, label_dir, save_dir, roi, use_stacks, start_index=0):
-    extractor = ImageExtractor(image_dir, label_dir, save_dir, roi, use_stacks, start_index)
+def view_images(image_dir, label_dir, save_dir, roi, use_stacks, start_index=0, pixel_size_nm=None):
+    extractor = ImageExtractor(image_dir, label_dir, save_dir, roi, use_stacks, start_index, pixel_size_nm)
     root = tk.Tk()
     viewer = ImageViewer(extractor, master=root)
     viewer.mainloop()
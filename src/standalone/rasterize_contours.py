@@ -0,0 +1,74 @@
+"""
+Draws labels from the consensus contours step 030 saved (see src/contour_store.py), at another border width or
+resolution, without aggregating the annotations again.
+
+By default the training stacks are built, as the pipeline builds cropped-stacks and cropped-labels-stacks, with the
+labels drawn from the contours. build_training_stacks crops each ROI to the extent of its labels, so the image stacks
+are written again alongside the label stacks, cropped and ranged to match them, e.g.
+
+    python rasterize_contours.py --border-width-nm 50 --target-xy-nm 40 \
+                                 --output projects/nuclear/resources/images/cropped-labels-stacks-40nm \
+                                 --images-output projects/nuclear/resources/images/cropped-stacks-40nm
+
+With --slices an uncropped label image is drawn per slice instead, as step 030 (or 040, with --target-xy-nm) writes
+them.
+"""
+import os
+import json
+import argparse
+
+from src.contour_store import rasterize_contour_slices
+from src.executor import set_executor_options
+from src.image_codecs import get_stage_codec
+from src.training_data import build_training_stacks
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("Draw label slices or stacks from the saved consensus contours.")
+    parser.add_argument('--params',
+                        help='The location of the parameters file.',
+                        default='../../projects/nuclear/nuclear.json')
+    parser.add_argument('--output',
+                        help='Directory to write the labels to, relative to the project root.',
+                        required=True)
+    parser.add_argument('--images-output',
+                        help='Directory to write the matching image stacks to, relative to the project root, by '
+                             'default the output directory with an -images suffix.')
+    parser.add_argument('--border-width-nm',
+                        type=float,
+                        help='Width of the drawn border, by default border_width_nm of the parameters file.')
+    parser.add_argument('--target-xy-nm',
+                        type=float,
+                        help='Pixel size to draw at, by default target_xy_nm of the parameters file for stacks, and '
+                             'the resolution the contours were aggregated at for slices.')
+    parser.add_argument('--slices',
+                        action='store_true',
+                        help='Draw an uncropped label image per slice rather than the training label stacks.')
+    parser.add_argument('--workers',
+                        type=int,
+                        help='Number of worker processes, by default workers of the parameters file.')
+    args = parser.parse_args()
+
+    with open(args.params, 'r') as f:
+        params = json.load(f)
+    set_executor_options(args.workers or params['workers'], params['io_workers'], params['memory_limit_mb'])
+
+    contours_dir = os.path.join('../..', params['images_raw_contours_dir'])
+    output_dir = os.path.join('../..', args.output)
+    slice_catalog_path = os.path.join('../..', params['slice_catalog_path'])
+    border_width_nm = args.border_width_nm or params['border_width_nm']
+
+    if args.slices:
+        rasterize_contour_slices(contours_dir, output_dir, border_width_nm, targetsize_nm_xy=args.target_xy_nm,
+                                 slice_catalog_path=slice_catalog_path, output_extension=params['raw_image_extension'],
+                                 codec=get_stage_codec(params, 'aggregate'))
+    else:
+        images_dir = os.path.join('../..', params['images_raw_dir'])
+        image_stacks_dir = os.path.join('../..', args.images_output) if args.images_output \
+            else os.path.normpath(output_dir) + '-images'
+        build_training_stacks(slice_catalog_path, images_dir, None, image_stacks_dir, output_dir,
+                              args.target_xy_nm or params['target_xy_nm'], params['target_z_nm'] / 1000,
+                              params['crop_padding'], params['model']['patch_shape'][1:],
+                              min_annotations=params['min_annotations'], output_extension=params['stack_extension'],
+                              codec=get_stage_codec(params, 'stack'), contours_dir=contours_dir,
+                              border_width_nm=border_width_nm)
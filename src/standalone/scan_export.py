@@ -0,0 +1,29 @@
+import os
+from src.param_parser import parse_params
+from src.stats.table1 import Table1Sink, calculate_stats_from_rois, write_stats_to_csv
+from src.zooniverse import ZooniverseCSVParser, ExportScan, ConversionSink, CensorSink
+
+
+if __name__ == '__main__':
+    # converts the zooniverse csv, writes the censored copy and gathers the table 1 statistics in one pass over the csv
+    params = parse_params("Convert, censor and gather statistics from the zooniverse csv in one pass.",
+                          parameter_file='../../projects/nuclear/nuclear.json')
+
+    csv_input_path = os.path.join('../..', params['zooniverse_csv_file'])
+    csv_processed_dir = os.path.join('../..', params['processed_csv_dir'])
+    csv_censored_filename = os.path.join(csv_processed_dir, '..', 'censored.csv')
+
+    zooniverse_workflow = params['zooniverse_workflow']
+
+    zoon_parser = ZooniverseCSVParser(output_dir=csv_processed_dir, workflow=zooniverse_workflow)
+    previous_slices = zoon_parser.prepare_conversion(incremental=params['incremental_ingest'])
+
+    # the censored copy is written from whole chunks, so it keeps every workflow
+    scan = ExportScan(workflow=zooniverse_workflow, subjects=zoon_parser.subjects)
+    scan.register(CensorSink(csv_censored_filename))
+    scan.register(ConversionSink(zoon_parser))
+    table1 = scan.register(Table1Sink())
+    scan.run(csv_input_path)
+
+    zoon_parser.save_ingest_state(previous_slices)
+    write_stats_to_csv(calculate_stats_from_rois(table1.rois))
@@ -1,15 +1,13 @@
-import os
-
 import numpy as np
 import matplotlib.pyplot as plt
-import pandas as pd
 from skimage.io import imread
 import matplotlib as mpl
 import cv2
 from PIL import Image, ImageDraw
 from tqdm import tqdm
 
-from src.interiors_probability import get_annotation_points, draw_contours, draw_contours2
+from src.annotation_store import AnnotationStore
+from src.interiors_probability import draw_contours, draw_contours2
 from src.helpers import pad
 from src.helpers import sizenm_to_dpum
 from src.image_processing import save_image, to_binary
@@ -23,15 +21,16 @@ if __name__ == '__main__':
     raw_stack_location = f"../../projects/nuclear/resources/images/backup-stacks/{roi}.tiff"
     out_filename = f"../../projects/nuclear/resources/all_aggregations_{roi}.tiff"
 
+    annotation_store = AnnotationStore("../../projects/nuclear/resources/csv/annotation-store/")
+
     raw_stack = imread(raw_stack_location)
     out_stack = np.zeros(raw_stack.shape, dtype=np.float32)
 
     for idx in tqdm(range(raw_stack.shape[0])):
-        csv_filename = f"../../projects/nuclear/resources/csv/processed/{roi}_z{pad(str(idx))}.csv"
+        slice_filename = f"{roi}_z{pad(str(idx))}"
 
-        if os.path.exists(csv_filename):
-            df = pd.read_csv(csv_filename)
-            annotations = get_annotation_points(df, 2, 2)
+        if slice_filename in annotation_store:
+            annotations = annotation_store.get_annotation_points(slice_filename, 2, 2)
 
             img = Image.new('F', (raw_stack.shape[2], raw_stack.shape[1]), 0)
             draw = ImageDraw.Draw(img)
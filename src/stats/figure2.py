@@ -2,14 +2,13 @@ import os
 
 import numpy as np
 import matplotlib.pyplot as plt
-import pandas as pd
 from skimage.io import imread, imsave
 from skimage.transform import resize
 from PIL import Image, ImageDraw
 import matplotlib as mpl
 
+from src.annotation_store import AnnotationStore
 from src.helpers import pad
-from src.interiors_probability import get_annotation_points
 
 
 mpl.rcParams['figure.dpi'] = 500
@@ -18,9 +17,8 @@ roi = "ROI_1656-6756-329"
 Z_SLICE = 70
 
 
-def load_annotations_as_images(csv_filename):
-    df = pd.read_csv(csv_filename)
-    annotations = get_annotation_points(df, 2, 2)
+def load_annotations_as_images(annotation_store, slice_filename):
+    annotations = annotation_store.get_annotation_points(slice_filename, 2, 2)
 
     annotation_images = []
     for annotation in annotations:
@@ -38,9 +36,8 @@ def load_annotations_as_images(csv_filename):
     return annotation_images
 
 
-def load_annotations_as_lists(csv_filename):
-    df = pd.read_csv(csv_filename)
-    annotations = get_annotation_points(df, 2, 2)
+def load_annotations_as_lists(annotation_store, slice_filename):
+    annotations = annotation_store.get_annotation_points(slice_filename, 2, 2)
     return annotations
 
 
@@ -54,7 +51,8 @@ if __name__ == '__main__':
         os.makedirs(WRITE_FOLDER)
 
     raw_stack_location = f"../../projects/nuclear/resources/images/backup-stacks/{roi}.tiff"
-    csv_location = f"../../projects/nuclear/resources/csv/processed/{roi}_z{pad(str(Z_SLICE))}.csv"
+    annotation_store = AnnotationStore("../../projects/nuclear/resources/csv/annotation-store/")
+    slice_filename = f"{roi}_z{pad(str(Z_SLICE))}"
 
     raw_stack = imread(raw_stack_location)
 
@@ -68,7 +66,7 @@ if __name__ == '__main__':
     plt.savefig(frame1_fn, bbox_inches='tight')
     plt.cla()
 
-    annotations_lists = load_annotations_as_lists(csv_location)
+    annotations_lists = load_annotations_as_lists(annotation_store, slice_filename)
     # 2) all aggregations on top of raw image (with color)
     plt.imshow(raw_image, cmap='gray')
     for i, annotation_list in enumerate(annotations_lists):
@@ -81,7 +79,7 @@ if __name__ == '__main__':
     plt.cla()
 
     # 3) zoomed in all aggregations (not greyscale heatmap as in existing image..)
-    # annotations_images = load_annotations_as_images(csv_location)
+    # annotations_images = load_annotations_as_images(annotation_store, slice_filename)
     # heatmap = np.mean(annotations_images, axis=0)
     # #heatmap = np.logical_or.reduce(annotations_images, axis=0)
     # plt.imshow(heatmap, cmap='gray')
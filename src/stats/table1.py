@@ -2,25 +2,24 @@
 Script for producing the statistics in Table 1 of the paper.
 """
 import os
-import csv
-import sys
-import json
-import dateutil
+import dateutil.parser
 
 import numpy as np
-import pandas as pd
-from tqdm import tqdm
 
+from src.zooniverse import ExportScan, ScanSink
 
-CHUNK_SIZE = 100
+
+# a compressed export (.csv.gz, .csv.zst or a tar archive) works too, see src/export_streams.py
 PATH = "../../projects/nuclear/resources/backup/etch-a-cell-classifications.csv"
 OUT_PATH = "../../projects/nuclear/resources/backup/stats.csv"
 WORKFLOW = "Going Nuclear"
 MAX_CLASSIFICATION_TIME = 2*3600
 
 
-def read_relevant_data_from_dataframe_chunks(csv_chunks):
+class Table1Sink(ScanSink):
     """
+    Collects the data the statistics are calculated from, during a scan of the zooniverse csv.
+
     format...
 
     rois = {
@@ -32,54 +31,51 @@ def read_relevant_data_from_dataframe_chunks(csv_chunks):
         }
     }
     """
-    rois = {}
-
-    for chunk in tqdm(csv_chunks):
-        for _, entry in chunk.iterrows():
-
-            if entry['workflow_name'] == WORKFLOW:
-
-                metadata = json.loads(entry['metadata'])
-                subject_data = json.loads(entry['subject_data'])[str(entry['subject_ids'])]
-                annotations = json.loads(entry['annotations'])[0]['value']
-
-                started_at = dateutil.parser.parse(metadata['started_at']).timestamp()
-                created_at = dateutil.parser.parse(metadata['finished_at']).timestamp()
-                timedelta = created_at - started_at
-
-                # note: batches of 5 have the same timestamp (though usually only the central one is actually annotated)
-                # frames = {}
-                # for annotation in annotations:
-                #     frame = annotation['frame']
-                #     if frame not in frames.keys():
-                #         frames[frame] = 1
-                
-                # it was decided to just use the central frame for these statistics
-                frames = {'2': 1}
-
-                for frame, frame_val in frames.items():
-                    if f'Image {frame}' in subject_data:
-                        filename, ext = os.path.splitext(subject_data[f'Image {frame}'])
-                        roi = filename.rsplit('_', 1)[0]
-
-                        if roi not in rois.keys():
-                            rois[roi] = {
-                                'images': {},
-                                'users': {}
-                            }
-
-                        if filename not in rois[roi]['images']:
-                            rois[roi]['images'][filename] = [timedelta]
-                        else:
-                            rois[roi]['images'][filename].append(timedelta)
-                        user_name = entry['user_name']
-                        if user_name not in rois[roi]['users']:
-                            rois[roi]['users'][user_name] = 1
-
+    columns = ['user_name', 'metadata', 'subject_data', 'subject_ids']
+
+    def __init__(self):
+        self.rois = {}
+
+    def process(self, chunk, rows):
+        for entry in rows:
+            metadata = entry.decoded_metadata
+            _, subject_images = entry.subject
+
+            started_at = dateutil.parser.parse(metadata['started_at']).timestamp()
+            created_at = dateutil.parser.parse(metadata['finished_at']).timestamp()
+            timedelta = created_at - started_at
+
+            # note: batches of 5 have the same timestamp (though usually only the central one is actually annotated)
+            # frames = {}
+            # for annotation in entry.decoded_annotations[0]['value']:
+            #     frame = annotation['frame']
+            #     if frame not in frames.keys():
+            #         frames[frame] = 1
+
+            # it was decided to just use the central frame for these statistics
+            frames = {'2': 1}
+
+            for frame, frame_val in frames.items():
+                if f'Image {frame}' in subject_images:
+                    filename, ext = os.path.splitext(subject_images[f'Image {frame}'])
+                    roi = filename.rsplit('_', 1)[0]
+
+                    if roi not in self.rois.keys():
+                        self.rois[roi] = {
+                            'images': {},
+                            'users': {}
+                        }
+
+                    if filename not in self.rois[roi]['images']:
+                        self.rois[roi]['images'][filename] = [timedelta]
                     else:
-                        print('failure')
+                        self.rois[roi]['images'][filename].append(timedelta)
+                    user_name = entry.user_name
+                    if user_name not in self.rois[roi]['users']:
+                        self.rois[roi]['users'][user_name] = 1
 
-    return rois
+                else:
+                    print('failure')
 
 
 def calculate_stats_from_rois(rois):
@@ -140,13 +136,12 @@ def write_stats_to_csv(stats):
 
 
 if __name__ == '__main__':
-    csv.field_size_limit(sys.maxsize)
-    zooniverse_csv_chunks = pd.read_csv(PATH,
-                                        engine='c',
-                                        error_bad_lines=False,
-                                        chunksize=CHUNK_SIZE)
+    # the scan can feed other sinks at the same time, e.g. a ConversionSink or CensorSink from src.zooniverse
+    scan = ExportScan(workflow=WORKFLOW)
+    table1 = scan.register(Table1Sink())
+    scan.run(PATH)
 
-    rois = read_relevant_data_from_dataframe_chunks(zooniverse_csv_chunks)
+    rois = table1.rois
 
     stats = calculate_stats_from_rois(rois)
 
@@ -0,0 +1,161 @@
+"""
+Builds the training stacks (cropped-stacks and cropped-labels-stacks) straight from the raw slices and their
+aggregations, one ROI at a time in memory. It does what steps 040 (downsample), 050 (crop), 060 (discard) and 070
+(stack) do in turn, without writing a directory of per-slice tiffs at each step for the next to read back.
+
+The scaled labels of a ROI are kept in memory to find its crop window, and the images are scaled, cropped and written
+to the stack one slice at a time.
+"""
+import os
+import shutil
+
+from src.contour_store import get_contour_index, rasterize_slice
+from src.cropping import get_crop_shape, get_mins_and_maxes
+from src.executor import run_items
+from src.image_processing import get_slice_index, get_image_info, get_resolution, read_image, rescale_image, save_image
+from src.slice_catalog import SliceCatalog, get_xy_scale
+from src.stack_writer import open_stack_writer
+
+
+def get_slice_filename(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def save_debug_image(debug_dir, path, image, resx, resy, res_unit):
+    if debug_dir is not None:
+        save_image(os.path.join(debug_dir, os.path.basename(path)), image, resx=resx, resy=resy, res_unit=res_unit)
+
+
+def build_roi_stacks(image_slices, label_slices, slice_catalog, targetsize_nm_xy, padding, patch_size, min_annotations,
+                     size_z, image_stack_path, label_stack_path, codec=None, debug_dirs=None, labels_scaled=False,
+                     border_width_nm=None):
+    """
+    Build the image and label stacks of one ROI from its slices ({slice number: path}). Returns the range of slices
+    stacked, or None if no slice was kept.
+
+    labels_scaled: the labels were aggregated at the target resolution already (see 030 target_xy_nm), and are used
+    as they are.
+    border_width_nm: the label slices are consensus contours (see contour_store), drawn at the target resolution with
+    a border this wide.
+
+    debug_dirs: (scaled images, scaled labels, cropped images, cropped labels) directories to also save the per-slice
+    images of steps 040 and 050 in (any of which can be None), or None.
+    """
+    scaled_images_dir, scaled_labels_dir, cropped_images_dir, cropped_labels_dir = debug_dirs or (None,) * 4
+
+    # 040: downscale the labels, every one of which is used to find the crop window
+    scales = dict()
+    labels = dict()
+    for i, label_path in label_slices.items():
+        scale_xy = get_xy_scale(slice_catalog, get_slice_filename(label_path), targetsize_nm_xy)
+        if scale_xy != 0:
+            scales[i] = scale_xy
+            if border_width_nm is not None:
+                labels[i] = rasterize_slice(label_path, border_width_nm, targetsize_nm_xy, slice_catalog)[0]
+                continue
+            label = read_image(label_path)
+            labels[i] = label if labels_scaled else rescale_image(label, scale_xy, binary_format=True)
+
+    # 060: only slices with an image, a label and enough annotations are trained on
+    kept = [i for i in sorted(labels)
+            if i in image_slices
+            and slice_catalog.count_annotations(get_slice_filename(image_slices[i])) >= min_annotations]
+    if not kept:
+        return None
+
+    # 050: crop to the median extent of the labels
+    first_path = image_slices[kept[0]]
+    shape, dtype = get_image_info(first_path)
+    image_shape = [int(n * scales[kept[0]] + 0.5) for n in shape[-2:]]
+    y_min, y_max, x_min, x_max = get_crop_shape(get_mins_and_maxes([label] for label in labels.values()),
+                                                image_shape, padding, patch_size)
+    crop_shape = (y_max - y_min, x_max - x_min)
+
+    resx, resy, _, res_unit = get_resolution(first_path)
+    resx *= scales[kept[0]]
+    resy *= scales[kept[0]]
+    label_dtype = labels[kept[0]].dtype
+
+    # 070: stack the kept slices, with blank pages for the rest of the range
+    image_range = [kept[0], kept[-1]]
+    depth = image_range[1] - image_range[0] + 1
+    with open_stack_writer(image_stack_path, (depth,) + crop_shape, dtype, codec=codec) as image_writer, \
+            open_stack_writer(label_stack_path, (depth,) + crop_shape, label_dtype, codec=codec) as label_writer:
+        kept = set(kept)
+        for i in range(image_range[0], image_range[1] + 1):
+            if i not in kept:
+                image_writer.write_blank()
+                label_writer.write_blank()
+                continue
+            image = rescale_image(read_image(image_slices[i]), scales[i])
+            image_writer.write(image[y_min:y_max, x_min:x_max])
+            label_writer.write(labels[i][y_min:y_max, x_min:x_max])
+
+            # the debug labels are named after the image, as the label slices may be contours
+            save_debug_image(scaled_images_dir, image_slices[i], image, resx, resy, res_unit)
+            save_debug_image(scaled_labels_dir, image_slices[i], labels[i], resx, resy, res_unit)
+            save_debug_image(cropped_images_dir, image_slices[i], image[y_min:y_max, x_min:x_max], resx, resy, res_unit)
+            save_debug_image(cropped_labels_dir, image_slices[i], labels[i][y_min:y_max, x_min:x_max], resx, resy,
+                             res_unit)
+        image_writer.set_resolution(resx=resx, resy=resy, size_z=size_z, res_unit=res_unit)
+        label_writer.set_resolution(resx=resx, resy=resy, size_z=size_z, res_unit=res_unit)
+
+    return image_range
+
+
+def build_roi(roi_slices, slice_catalog_path, image_stacks_dir, label_stacks_dir, targetsize_nm_xy, size_z, padding,
+              patch_size, min_annotations, output_extension, codec=None, debug_dirs=None, labels_scaled=False,
+              border_width_nm=None):
+    """
+    build_roi_stacks for a ROI given as (roi, image slices, label slices), with its own connection to the slice
+    catalog, so that it can be run in a worker process.
+    """
+    roi, image_slices, label_slices = roi_slices
+    slice_catalog = SliceCatalog(slice_catalog_path)
+    try:
+        return build_roi_stacks(image_slices, label_slices, slice_catalog, targetsize_nm_xy, padding, patch_size,
+                                min_annotations, size_z, os.path.join(image_stacks_dir, roi + output_extension),
+                                os.path.join(label_stacks_dir, roi + output_extension), codec=codec,
+                                debug_dirs=debug_dirs, labels_scaled=labels_scaled, border_width_nm=border_width_nm)
+    except ValueError as error:
+        print("Stack error", roi, error)
+        return None
+    finally:
+        slice_catalog.close()
+
+
+def build_training_stacks(slice_catalog_path, images_dir, labels_dir, image_stacks_dir, label_stacks_dir,
+                          targetsize_nm_xy, size_z, padding, patch_size, min_annotations=5, output_extension='.tiff',
+                          clear_existing=False, rois=None, codec=None, debug_dirs=None, labels_scaled=False,
+                          contours_dir=None, border_width_nm=None):
+    """
+    Build the training stacks of every ROI with labels, replacing steps 040 to 070.
+
+    rois: only build these ROIs (e.g. the ones with slices changed by an incremental ingest)
+    contours_dir, border_width_nm: draw the labels from the consensus contours in contours_dir (see contour_store) with
+    a border border_width_nm wide, rather than reading them from labels_dir. The crop window follows the labels, so
+    the image stacks are written again with them.
+    debug_dirs, labels_scaled: see build_roi_stacks
+    """
+    for stacks_dir in (image_stacks_dir, label_stacks_dir) + tuple(debug_dirs or ()):
+        if stacks_dir is None:
+            continue
+        if clear_existing and os.path.exists(stacks_dir):
+            shutil.rmtree(stacks_dir)
+        if not os.path.exists(stacks_dir):
+            os.makedirs(stacks_dir)
+
+    image_index = get_slice_index(images_dir)
+    label_index = get_contour_index(contours_dir) if contours_dir else get_slice_index(labels_dir)
+    roi_slices = [(roi, image_index[roi], label_index[roi]) for roi in sorted(label_index)
+                  if roi in image_index and (rois is None or roi in rois)]
+
+    image_ranges = run_items(build_roi, roi_slices,
+                             (slice_catalog_path, image_stacks_dir, label_stacks_dir, targetsize_nm_xy, size_z, padding,
+                              patch_size, min_annotations, output_extension, codec, debug_dirs, labels_scaled,
+                              border_width_nm),
+                             unit=' rois')
+    nbuilt = sum(image_range is not None for image_range in image_ranges)
+
+    print(f'Built training stacks: {nbuilt}')
+    return nbuilt
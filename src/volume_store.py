@@ -0,0 +1,247 @@
+"""
+A chunked, compressed store for image volumes (and single images), similar to Zarr. A volume is a directory, named
+with VOLUME_EXTENSION, holding a meta.json with the shape, dtype, chunk shape, codec and resolution of the volume, and
+one compressed file per chunk (zlib, unless another codec from image_codecs was chosen), named by its chunk grid
+position (e.g. '2.0.1'). Chunks which were never written are read as zeros.
+
+Reading or writing a window only touches the chunks the window overlaps, so it costs time in proportion to the
+window rather than the whole volume.
+"""
+import os
+import json
+import shutil
+
+import numpy as np
+
+from src.image_codecs import decode, encode, format_codec, parse_codec
+
+
+VOLUME_EXTENSION = '.vol'
+META_FILENAME = 'meta.json'
+
+# default chunk shapes, in (z,) y, x order
+CHUNKS_3D = (16, 256, 256)
+CHUNKS_2D = (256, 256)
+
+COMPRESSION_LEVEL = 6
+FAST_COMPRESSION_LEVEL = 1
+
+
+def is_volume(path):
+    return os.path.isfile(os.path.join(path, META_FILENAME))
+
+
+def normalize_key(key, shape):
+    """
+    Turn a numpy style index of ints and slices in to the bounding (start, stop) of every axis, along with the index
+    to apply to the bounding box to get the result numpy would give.
+    """
+    if not isinstance(key, tuple):
+        key = (key,)
+    if any(k is Ellipsis for k in key):
+        i = next(i for i, k in enumerate(key) if k is Ellipsis)
+        key = key[:i] + (slice(None),) * (len(shape) - len(key) + 1) + key[i + 1:]
+    if len(key) > len(shape):
+        raise IndexError(f'Too many indices for a volume of {len(shape)} dimensions.')
+    key = key + (slice(None),) * (len(shape) - len(key))
+
+    bounds = []
+    post = []
+    for k, n in zip(key, shape):
+        if isinstance(k, slice):
+            start, stop, step = k.indices(n)
+            if step == 1:
+                stop = max(start, stop)
+                bounds.append((start, stop))
+                post.append(slice(None))
+            else:
+                indices = np.arange(start, stop, step)
+                if len(indices) == 0:
+                    bounds.append((0, 0))
+                    post.append(slice(None))
+                else:
+                    bounds.append((int(indices.min()), int(indices.max()) + 1))
+                    post.append(indices - indices.min())
+        else:
+            k = int(k)
+            if k < 0:
+                k += n
+            if not 0 <= k < n:
+                raise IndexError(f'Index {k} is out of bounds for an axis of size {n}.')
+            bounds.append((k, k + 1))
+            post.append(0)
+    return bounds, post
+
+
+def apply_post_index(array, post):
+    # fancy indices have to be applied one axis at a time to mean the same as they do in a slice
+    if all(isinstance(p, slice) or np.isscalar(p) for p in post):
+        return array[tuple(post)]
+    for axis in reversed(range(len(post))):
+        if not isinstance(post[axis], slice):
+            array = np.take(array, post[axis], axis=axis)
+    return array
+
+
+class Volume:
+    """
+    Windowed access to a volume in the store, with numpy style indexing, e.g. volume[10:22, 0:256, 512:768].
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILENAME), 'r') as f:
+            self.meta = json.load(f)
+        self.shape = tuple(self.meta['shape'])
+        self.dtype = np.dtype(self.meta['dtype'])
+        self.chunks = tuple(self.meta['chunks'])
+        self.level = self.meta['level']
+        # volumes written before codecs were configurable are all zlib
+        compression = self.meta['compression']
+        self.codec = parse_codec(f'deflate:{self.level}' if compression == 'zlib' else compression)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def resolution(self):
+        """
+        (resx, resy, size_z, unit) in the same form as image_processing.get_tag_resolution.
+        """
+        resolution = self.meta['resolution']
+        return resolution['resx'], resolution['resy'], resolution['size_z'], resolution['unit']
+
+    def set_resolution(self, resolution):
+        self.meta['resolution'] = resolution_meta(resolution)
+        with open(os.path.join(self.path, META_FILENAME), 'w') as f:
+            json.dump(self.meta, f)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        array = self[...]
+        return array.astype(dtype) if dtype is not None else array
+
+    def get_chunk_path(self, index):
+        return os.path.join(self.path, '.'.join(str(i) for i in index))
+
+    def read_chunk(self, index):
+        chunk_path = self.get_chunk_path(index)
+        if not os.path.exists(chunk_path):
+            return None
+        with open(chunk_path, 'rb') as f:
+            return decode(self.codec, f.read(), self.chunks, self.dtype)
+
+    def write_chunk(self, index, chunk):
+        with open(self.get_chunk_path(index), 'wb') as f:
+            f.write(encode(self.codec, chunk, self.dtype))
+
+    def get_chunk_indices(self, bounds):
+        ranges = [range(start // size, (stop - 1) // size + 1) if stop > start else range(0)
+                  for (start, stop), size in zip(bounds, self.chunks)]
+        return np.ndindex(*[len(r) for r in ranges]), ranges
+
+    def get_overlap(self, index, bounds):
+        """
+        The part of chunk index inside bounds, as slices in to the chunk and in to the bounding box.
+        """
+        chunk_slices = []
+        window_slices = []
+        for i, (start, stop), size in zip(index, bounds, self.chunks):
+            chunk_start = i * size
+            begin = max(start, chunk_start)
+            end = min(stop, chunk_start + size)
+            chunk_slices.append(slice(begin - chunk_start, end - chunk_start))
+            window_slices.append(slice(begin - start, end - start))
+        return tuple(chunk_slices), tuple(window_slices)
+
+    def read_window(self, bounds):
+        window = np.zeros([stop - start for start, stop in bounds], dtype=self.dtype)
+        grid, ranges = self.get_chunk_indices(bounds)
+        for position in grid:
+            index = tuple(r[p] for r, p in zip(ranges, position))
+            chunk = self.read_chunk(index)
+            if chunk is not None:
+                chunk_slices, window_slices = self.get_overlap(index, bounds)
+                window[window_slices] = chunk[chunk_slices]
+        return window
+
+    def write_window(self, bounds, window):
+        grid, ranges = self.get_chunk_indices(bounds)
+        for position in grid:
+            index = tuple(r[p] for r, p in zip(ranges, position))
+            chunk_slices, window_slices = self.get_overlap(index, bounds)
+            if all(s.stop - s.start == size for s, size in zip(chunk_slices, self.chunks)):
+                chunk = window[window_slices]
+            else:
+                # partly covered chunk, keep what is already there
+                chunk = self.read_chunk(index)
+                chunk = np.zeros(self.chunks, dtype=self.dtype) if chunk is None else chunk.copy()
+                chunk[chunk_slices] = window[window_slices]
+            self.write_chunk(index, chunk)
+
+    def __getitem__(self, key):
+        bounds, post = normalize_key(key, self.shape)
+        return apply_post_index(self.read_window(bounds), post)
+
+    def __setitem__(self, key, value):
+        bounds, post = normalize_key(key, self.shape)
+        if any(not isinstance(p, slice) and not np.isscalar(p) for p in post):
+            raise IndexError('Only ints and slices with a step of 1 can be written to a volume.')
+        window = np.zeros([stop - start for start, stop in bounds], dtype=self.dtype)
+        window[tuple(post)] = value
+        self.write_window(bounds, window)
+
+    def __iter__(self):
+        # decode one layer of chunks at a time rather than one per image
+        for start in range(0, self.shape[0], self.chunks[0]):
+            block = self[start:start + self.chunks[0]]
+            for image in block:
+                yield image
+
+
+def resolution_meta(resolution):
+    resx, resy, size_z, unit = resolution
+    return {'resx': float(resx), 'resy': float(resy), 'size_z': float(size_z or 1), 'unit': unit or ''}
+
+
+def create_volume(path, shape, dtype, chunks=None, resolution=(1, 1, 1, ''), level=COMPRESSION_LEVEL, codec=None):
+    """
+    Create an empty (all zero) volume, replacing any existing volume at path. Chunks are compressed with codec if it is
+    given, and with zlib at level otherwise.
+    """
+    codec = parse_codec(codec if codec is not None else f'deflate:{level}')
+    if chunks is None:
+        chunks = CHUNKS_3D if len(shape) == 3 else CHUNKS_2D
+    # no point in chunks bigger than the volume
+    chunks = tuple(int(min(c, max(s, 1))) for c, s in zip(chunks, shape))
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+
+    meta = {
+        'shape': [int(s) for s in shape],
+        'dtype': np.dtype(dtype).str,
+        'chunks': list(chunks),
+        'compression': format_codec(codec),
+        'level': codec.level,
+        'resolution': resolution_meta(resolution),
+    }
+    with open(os.path.join(path, META_FILENAME), 'w') as f:
+        json.dump(meta, f)
+    return Volume(path)
+
+
+def open_volume(path):
+    return Volume(path)
+
+
+def save_volume(path, array, resolution=(1, 1, 1, ''), chunks=None, level=COMPRESSION_LEVEL, codec=None):
+    array = np.asarray(array)
+    volume = create_volume(path, array.shape, array.dtype, chunks=chunks, resolution=resolution, level=level,
+                           codec=codec)
+    volume.write_window([(0, s) for s in array.shape], array)
+    return volume
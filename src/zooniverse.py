@@ -2,13 +2,409 @@ import os
 import csv
 import json
 import shutil
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
 import pandas as pd
 from tqdm import tqdm
 
+from src.csv_shards import find_shards, open_shard
+from src.export_streams import is_compressed, open_export
 
-# how many csv rows should we load in to memory at one time
+
+# how many csv rows should we load in to memory at first, afterwards the chunk size adapts to CHUNK_BYTES
 CHUNK_SIZE = 100
+# roughly how many bytes of csv data should we hold in memory at one time
+CHUNK_BYTES = 32 * 1024 * 1024
+
+# the only columns of the zooniverse csv that parse_row needs, along with their types
+CONVERT_COLUMNS = ['classification_id', 'user_name', 'workflow_id', 'workflow_name', 'expert', 'annotations',
+                   'subject_data', 'subject_ids']
+CONVERT_DTYPES = {'classification_id': 'int64', 'user_name': str, 'workflow_id': 'int64', 'workflow_name': str,
+                  'annotations': str, 'subject_data': str, 'subject_ids': str}
+
+# how many decoded subjects to keep, every subject is classified by many volunteers
+SUBJECT_CACHE_SIZE = 8192
+
+# when converting with several processes, split the csv in to this many shards per process to even out the load
+SHARDS_PER_WORKER = 4
+
+# how many per-slice csv files may be open at one time while converting
+MAX_OPEN_FILES = 256
+# buffered characters per slice csv before it is written out, and in total before everything is written out
+SLICE_BUFFER_SIZE = 16 * 1024
+TOTAL_BUFFER_SIZE = 64 * 1024 * 1024
+
+# kept in the output directory: the highest classification id ingested so far along with every slice written, and the
+# slices touched by the latest run
+INGEST_STATE_FILENAME = '.ingest-state.json'
+CHANGED_SLICES_FILENAME = '.changed-slices.json'
+# one row per converted classification, with who made it, for the slice catalog (written as a csv like the slices)
+CLASSIFICATIONS_FILENAME = '.classifications'
+
+
+class SliceCSVWriterPool:
+    """
+    Appends lines to the per-slice csvs. Rather than opening, checking and closing a file for every parsed entry, open
+    files are kept in a least recently used pool and lines are buffered in memory so they can be written in bulk.
+    The bytes written are the same as appending each line to its file as soon as it is parsed.
+    """
+
+    def __init__(self, output_dir, max_open_files=MAX_OPEN_FILES, slice_buffer_size=SLICE_BUFFER_SIZE,
+                 total_buffer_size=TOTAL_BUFFER_SIZE):
+        self.output_dir = output_dir
+        self.max_open_files = max_open_files
+        self.slice_buffer_size = slice_buffer_size
+        self.total_buffer_size = total_buffer_size
+        self.files = OrderedDict()
+        self.buffers = dict()
+        self.buffer_sizes = dict()
+        self.total_buffered = 0
+
+    def write(self, filename, header, line):
+        """
+        Queue one line for the csv called filename, preceded by the header if the csv doesn't exist yet.
+        """
+        if filename not in self.buffers:
+            # only check the file system the first time we see a slice, afterwards we know the header is written
+            self.buffers[filename] = []
+            self.buffer_sizes[filename] = 0
+            if not os.path.exists(self.get_path(filename)):
+                self.buffer(filename, header)
+        self.buffer(filename, line)
+
+        if self.buffer_sizes[filename] >= self.slice_buffer_size:
+            self.flush_file(filename)
+        if self.total_buffered >= self.total_buffer_size:
+            self.flush()
+
+    def buffer(self, filename, line):
+        self.buffers[filename].append(line)
+        self.buffer_sizes[filename] += len(line)
+        self.total_buffered += len(line)
+
+    def get_path(self, filename):
+        return self.output_dir + filename + '.csv'
+
+    def get_file(self, filename):
+        if filename in self.files:
+            self.files.move_to_end(filename)
+            return self.files[filename]
+
+        if len(self.files) >= self.max_open_files:
+            _, least_recent = self.files.popitem(last=False)
+            least_recent.close()
+
+        f = open(self.get_path(filename), 'a')
+        self.files[filename] = f
+        return f
+
+    def flush_file(self, filename):
+        lines = self.buffers[filename]
+        if lines:
+            self.get_file(filename).write(''.join(lines))
+            self.total_buffered -= self.buffer_sizes[filename]
+            self.buffers[filename] = []
+            self.buffer_sizes[filename] = 0
+
+    def flush(self):
+        for filename in self.buffers:
+            self.flush_file(filename)
+
+    def close(self):
+        self.flush()
+        for f in self.files.values():
+            f.close()
+        self.files.clear()
+
+
+def decode_subject_data(subject_data_json, subject_ids):
+    """
+    Decode the subject data json of a classification in to the metadata we keep and the images shown to the volunteer.
+    The retirement state is left out, it changes between classifications of the same subject.
+    """
+    subject_data = json.loads(subject_data_json)[str(subject_ids)]
+
+    metadata = {
+        'description': subject_data['description'] if 'description' in subject_data.keys() else '',
+        'attribution': subject_data['attribution'] if 'attribution' in subject_data.keys() else '',
+        'microscope': subject_data['microscope'] if 'microscope' in subject_data.keys() else '',
+        'raw_z_res': subject_data['Raw Z resolution (nm)'] if 'Raw Z resolution (nm)' in subject_data.keys() else 5,
+        'raw_xy_res': subject_data['Raw XY resolution (nm)'] if 'Raw XY resolution (nm)' in subject_data.keys() else 5,
+        'jpeg_quality': subject_data['jpeg quality (%)'] if 'jpeg quality (%)' in subject_data.keys() else 100,
+        'scaling_factor': subject_data['Scaling factor'] if 'Scaling factor' in subject_data.keys() else 1,
+        'subject_id': subject_data['Subject ID'] if 'Subject ID' in subject_data.keys() else 0,
+    }
+    images = {key: value for key, value in subject_data.items() if key.startswith('Image ')}
+
+    return metadata, images
+
+
+class SubjectCache:
+    """
+    Decoded subject data in a least recently used cache keyed by subject id, since the same subject turns up in many
+    rows.
+    """
+
+    def __init__(self, size=SUBJECT_CACHE_SIZE):
+        self.size = size
+        self.subjects = OrderedDict()
+        self.stats = dict(hits=0, misses=0)
+
+    def get(self, subject_data_json, subject_ids):
+        if subject_ids in self.subjects:
+            self.subjects.move_to_end(subject_ids)
+            self.stats['hits'] += 1
+            return self.subjects[subject_ids]
+
+        self.stats['misses'] += 1
+        subject = decode_subject_data(subject_data_json, subject_ids)
+        self.subjects[subject_ids] = subject
+        if len(self.subjects) > self.size:
+            self.subjects.popitem(last=False)
+        return subject
+
+
+def read_csv_chunks(csv_path, usecols=None, dtype=None, chunk_bytes=CHUNK_BYTES):
+    """
+    Read a csv in chunks. The number of rows in each chunk is adjusted to how much memory the previous chunk used,
+    so memory use stays flat regardless of how long the rows are. Compressed csvs (see export_streams) are streamed.
+    """
+    csv.field_size_limit(2**30)
+    stream = open_export(csv_path) if isinstance(csv_path, str) and is_compressed(csv_path) else None
+    reader = pd.read_csv(stream if stream is not None else csv_path,
+                         engine='c',
+                         error_bad_lines=False,
+                         usecols=usecols,
+                         dtype=dtype,
+                         iterator=True)
+
+    try:
+        rows = CHUNK_SIZE
+        while True:
+            try:
+                chunk = reader.get_chunk(rows)
+            except StopIteration:
+                break
+            if len(chunk.index) == 0:
+                break
+            yield chunk
+
+            used_bytes = chunk.memory_usage(index=False, deep=True).sum()
+            # don't let one unusual chunk swing the size too far
+            scale = min(4.0, max(0.25, chunk_bytes / max(used_bytes, 1)))
+            rows = max(1, int(len(chunk.index) * scale))
+    finally:
+        reader.close()
+        if stream is not None:
+            stream.close()
+
+
+class ScanRow:
+    """
+    One row of the zooniverse csv as seen by the sinks of an ExportScan. The raw columns are attributes as on the
+    row tuple, and the json columns are decoded the first time a sink asks for them and then shared with the others.
+    """
+
+    def __init__(self, row, subjects):
+        self.row = row
+        self.subjects = subjects
+        self._annotations = None
+        self._metadata = None
+        self._subject = None
+
+    def __getattr__(self, name):
+        return getattr(self.row, name)
+
+    @property
+    def decoded_annotations(self):
+        if self._annotations is None:
+            self._annotations = json.loads(self.row.annotations)
+        return self._annotations
+
+    @property
+    def decoded_metadata(self):
+        if self._metadata is None:
+            self._metadata = json.loads(self.row.metadata)
+        return self._metadata
+
+    @property
+    def subject(self):
+        """
+        (metadata, images) as returned by decode_subject_data.
+        """
+        if self._subject is None:
+            self._subject = self.subjects.get(self.row.subject_data, self.row.subject_ids)
+        return self._subject
+
+
+class ScanSink:
+    """
+    Something which consumes the zooniverse csv during an ExportScan.
+    """
+    # the columns of the zooniverse csv the sink reads, None for all of them
+    columns = None
+
+    def begin(self):
+        pass
+
+    def process(self, chunk, rows):
+        """
+        chunk: the next chunk of the zooniverse csv, which must not be modified as the other sinks see it too
+        rows: a ScanRow for each row of the chunk in the scan's workflow
+        """
+        raise NotImplementedError
+
+    def end(self):
+        pass
+
+
+class ExportScan:
+    """
+    Reads the zooniverse csv once and hands every chunk to each of the registered sinks, so that converting,
+    censoring and gathering statistics don't each need their own pass over a very large file. Each row is decoded at
+    most once however many sinks look at it.
+    """
+
+    def __init__(self, workflow=None, subjects=None):
+        self.workflow = workflow
+        self.subjects = subjects if subjects is not None else SubjectCache()
+        self.sinks = []
+
+    def register(self, sink):
+        self.sinks.append(sink)
+        return sink
+
+    def get_columns(self):
+        columns = {'workflow_name'} if self.workflow is not None else set()
+        for sink in self.sinks:
+            if sink.columns is None:
+                return None
+            columns.update(sink.columns)
+        return sorted(columns)
+
+    def run(self, zooniverse_csv_path, show_progress=True):
+        # only project and type the columns when no sink needs the csv as it is
+        columns = self.get_columns()
+        dtype = {column: CONVERT_DTYPES[column] for column in columns if column in CONVERT_DTYPES} if columns else None
+        self.scan_chunks(read_csv_chunks(zooniverse_csv_path, usecols=columns, dtype=dtype), show_progress)
+
+    def scan_chunks(self, zooniverse_csv_chunks, show_progress=True):
+        progress = tqdm(unit=' rows', disable=not show_progress)
+        for sink in self.sinks:
+            sink.begin()
+        try:
+            for chunk in zooniverse_csv_chunks:
+                progress.update(len(chunk.index))
+                # filter on workflow before any json decoding
+                in_workflow = chunk[chunk.workflow_name == self.workflow] if self.workflow is not None else chunk
+                rows = [ScanRow(row, self.subjects) for row in in_workflow.itertuples(index=False)]
+                for sink in self.sinks:
+                    sink.process(chunk, rows)
+        finally:
+            progress.close()
+            for sink in self.sinks:
+                sink.end()
+
+
+class ConversionSink(ScanSink):
+    """
+    Writes the per-slice csvs of a ZooniverseCSVParser.
+    """
+    columns = CONVERT_COLUMNS
+
+    def __init__(self, zoon_parser):
+        self.zoon_parser = zoon_parser
+
+    def begin(self):
+        self.zoon_parser.writers = SliceCSVWriterPool(self.zoon_parser.output_dir)
+
+    def process(self, chunk, rows):
+        self.zoon_parser.convert_rows(rows)
+
+    def end(self):
+        self.zoon_parser.writers.close()
+        self.zoon_parser.writers = None
+
+
+class CensorSink(ScanSink):
+    """
+    Writes a copy of the zooniverse csv with the columns identifying volunteers left empty.
+    """
+    columns = None
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.censored_csv = None
+        self.csv_writer = None
+        self.header_done = False
+
+    def begin(self):
+        self.censored_csv = open(self.output_path, mode='w', newline='')
+        self.csv_writer = csv.writer(self.censored_csv)
+
+    def process(self, chunk, rows):
+        chunk = chunk.assign(user_name='', user_id='', user_ip='')
+        if not self.header_done:
+            self.csv_writer.writerow(chunk.columns)
+            self.header_done = True
+        self.csv_writer.writerows(chunk.itertuples(index=False))
+
+    def end(self):
+        self.censored_csv.close()
+
+
+def convert_shard(job):
+    """
+    Convert one byte range of the zooniverse csv in to per-slice csvs in a directory of its own. Runs in a worker
+    process, so only the counters are sent back.
+    """
+    csv_path, header, start, end, output_dir, workflow, tool_label, watermark = job
+
+    zoon_parser = ZooniverseCSVParser(output_dir=output_dir, workflow=workflow, tool_label=tool_label)
+    zoon_parser.prepare_output_dir()
+    zoon_parser.ingested_watermark = watermark
+    with open_shard(csv_path, header, start, end) as shard:
+        zooniverse_csv_chunks = read_csv_chunks(shard, usecols=CONVERT_COLUMNS, dtype=CONVERT_DTYPES)
+        zoon_parser.convert_chunks(zooniverse_csv_chunks, show_progress=False)
+
+    return (zoon_parser.processed, zoon_parser.errors, zoon_parser.subject_cache, zoon_parser.watermark,
+            zoon_parser.changed_slices)
+
+
+def merge_shard_outputs(shard_dirs, output_dir):
+    """
+    Append the per-slice csvs written for each shard to the csvs in output_dir. Shards are merged in the order they
+    appear in the zooniverse csv, so the result is the same as converting the whole file in one process.
+    """
+    shard_files = [set(os.listdir(shard_dir)) for shard_dir in shard_dirs]
+    filenames = sorted(set().union(*shard_files))
+
+    for filename in tqdm(filenames, unit=' slices'):
+        output_path = os.path.join(output_dir, filename)
+        header_done = os.path.exists(output_path)
+        with open(output_path, 'ab') as output:
+            for shard_dir, files in zip(shard_dirs, shard_files):
+                if filename in files:
+                    with open(os.path.join(shard_dir, filename), 'rb') as shard:
+                        if header_done:
+                            shard.readline()
+                        shutil.copyfileobj(shard, output)
+                    header_done = True
+
+    for shard_dir in shard_dirs:
+        shutil.rmtree(shard_dir)
+
+
+def load_changed_slices(output_dir):
+    """
+    Filenames of the slices touched by the latest conversion in to output_dir, or None if there is no manifest.
+    """
+    manifest_path = os.path.join(output_dir, CHANGED_SLICES_FILENAME)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r') as f:
+        return [filename for _, _, filename in json.load(f)]
 
 
 class ZooniverseCSVParser:
@@ -17,12 +413,19 @@ class ZooniverseCSVParser:
     We load in chunks, so even very large csv files which wouldn't fit in memory can be converted.
     """
 
-    def __init__(self, output_dir, workflow=None, tool_label=None):
+    def __init__(self, output_dir, workflow=None, tool_label=None, subject_cache_size=SUBJECT_CACHE_SIZE):
         self.errors = dict(invalid_format=0, missing_ref_image=0)
         self.processed = 0
         self.output_dir = output_dir
         self.workflow = workflow
         self.tool_label = tool_label
+        self.writers = None
+        self.subjects = SubjectCache(subject_cache_size)
+        self.subject_cache = self.subjects.stats
+        # rows with a classification id up to ingested_watermark were converted by an earlier run
+        self.ingested_watermark = -1
+        self.watermark = -1
+        self.changed_slices = set()
 
     def prepare_output_dir(self):
         """
@@ -33,73 +436,127 @@ class ZooniverseCSVParser:
         if not os.path.exists(self.output_dir):
             os.makedirs(self.output_dir)
 
-    def convert(self, zooniverse_csv_path):
-        # since we're appending to csvs, we need to clear first to avoid duplication
-        self.prepare_output_dir()
-
-        csv.field_size_limit(2**30)
-        zooniverse_csv_chunks = pd.read_csv(zooniverse_csv_path,
-                                            engine='c',
-                                            error_bad_lines=False,
-                                            chunksize=CHUNK_SIZE)
+    def load_ingest_state(self):
+        state_path = os.path.join(self.output_dir, INGEST_STATE_FILENAME)
+        if not os.path.exists(state_path):
+            return None
+        with open(state_path, 'r') as f:
+            return json.load(f)
 
-        for chunk in tqdm(zooniverse_csv_chunks,  unit=' rows', unit_scale=CHUNK_SIZE):
-            chunk = chunk[chunk.workflow_name == self.workflow]
-
-            for index, row in chunk.iterrows():
-                try:
-                    parsed_entries = self.parse_row(row)
-                    self.write_parsed_entries(parsed_entries)
-                except MissingRefImageError:
-                    self.errors['missing_ref_image'] += 1
-                except InvalidAnnotationFormatError:
-                    self.errors['invalid_format'] += 1
+    def save_ingest_state(self, previous_slices):
+        """
+        Record the watermark and every slice written so far, along with a manifest of the slices this run touched so
+        that later steps can limit their work to those.
+        """
+        changed_slices = sorted(self.changed_slices)
+        slices = sorted(set(previous_slices) | set(self.changed_slices))
+        with open(os.path.join(self.output_dir, INGEST_STATE_FILENAME), 'w') as f:
+            json.dump({'watermark': self.watermark, 'slices': slices}, f)
+        with open(os.path.join(self.output_dir, CHANGED_SLICES_FILENAME), 'w') as f:
+            json.dump(changed_slices, f)
+
+    def prepare_conversion(self, incremental=False):
+        """
+        incremental: keep the csvs of an earlier run and only append the classifications newer than the highest
+        classification id it ingested. Falls back to a full conversion if there is no earlier run.
 
-            self.processed += len(chunk.index)
+        Returns the slices written by earlier runs, for save_ingest_state.
+        """
+        state = self.load_ingest_state() if incremental else None
+        if state is None:
+            # since we're appending to csvs, we need to clear first to avoid duplication
+            self.prepare_output_dir()
+            return []
+
+        self.ingested_watermark = self.watermark = state['watermark']
+        return [tuple(key) for key in state['slices']]
+
+    def convert(self, zooniverse_csv_path, workers=1, incremental=False):
+        previous_slices = self.prepare_conversion(incremental)
+
+        if workers > 1 and is_compressed(zooniverse_csv_path):
+            # shards are byte ranges of the csv on disk, a compressed stream can only be read from the start
+            print('Compressed zooniverse csv, converting in one process (extract it to convert in parallel)...')
+        if workers > 1 and not is_compressed(zooniverse_csv_path):
+            self.convert_shards(zooniverse_csv_path, workers)
+        else:
+            zooniverse_csv_chunks = read_csv_chunks(zooniverse_csv_path, usecols=CONVERT_COLUMNS, dtype=CONVERT_DTYPES)
+            self.convert_chunks(zooniverse_csv_chunks)
+
+        self.save_ingest_state(previous_slices)
+
+    def convert_shards(self, zooniverse_csv_path, workers):
+        """
+        Split the zooniverse csv in to byte ranges on record boundaries and convert them in parallel, then merge the
+        per-slice csvs of every shard in to the output directory.
+        """
+        header, shards = find_shards(zooniverse_csv_path, workers * SHARDS_PER_WORKER)
+        shard_dirs = [os.path.join(self.output_dir, f'.shard{i:04d}', '') for i in range(len(shards))]
+        jobs = [(zooniverse_csv_path, header, start, end, shard_dir, self.workflow, self.tool_label,
+                 self.ingested_watermark)
+                for (start, end), shard_dir in zip(shards, shard_dirs)]
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for processed, errors, subject_cache, watermark, changed_slices in tqdm(executor.map(convert_shard, jobs),
+                                                                                    total=len(jobs), unit=' shards'):
+                self.processed += processed
+                self.watermark = max(self.watermark, watermark)
+                self.changed_slices.update(changed_slices)
+                for key, count in errors.items():
+                    self.errors[key] += count
+                for key, count in subject_cache.items():
+                    self.subject_cache[key] += count
+
+        print('Merging shards...')
+        merge_shard_outputs(shard_dirs, self.output_dir)
+
+    def convert_chunks(self, zooniverse_csv_chunks, show_progress=True):
+        scan = ExportScan(workflow=self.workflow, subjects=self.subjects)
+        scan.register(ConversionSink(self))
+        scan.scan_chunks(zooniverse_csv_chunks, show_progress=show_progress)
+
+    def convert_rows(self, rows):
+        """
+        Convert the ScanRows of the workflow, skipping classifications an earlier run already ingested.
+        """
+        for row in rows:
+            if row.classification_id <= self.ingested_watermark:
+                continue
+            self.processed += 1
+            self.watermark = max(self.watermark, int(row.classification_id))
+
+            try:
+                parsed_entries = self.parse_decoded_row(row, row.decoded_annotations, *row.subject)
+                self.write_parsed_entries(parsed_entries)
+                self.write_classification(row)
+            except MissingRefImageError:
+                self.errors['missing_ref_image'] += 1
+            except InvalidAnnotationFormatError:
+                self.errors['invalid_format'] += 1
 
     def censor(self, zooniverse_csv_path, output_path):
-        csv.field_size_limit(2**30)
-        zooniverse_csv_chunks = pd.read_csv(zooniverse_csv_path,
-                                            engine='c',
-                                            error_bad_lines=False,
-                                            chunksize=CHUNK_SIZE)
-
-        header_done = False
-        with open(output_path, mode='w', newline='') as censored_csv:
-            csv_writer = csv.writer(censored_csv)
-            for chunk in tqdm(zooniverse_csv_chunks,  unit=' rows', unit_scale=CHUNK_SIZE):
-                for index, row in chunk.iterrows():
-                    row['user_name'] = ''
-                    row['user_id'] = ''
-                    row['user_ip'] = ''
-                    if not header_done:
-                        csv_writer.writerow(chunk.columns)
-                        header_done = True
-                    csv_writer.writerow(row)
+        scan = ExportScan()
+        scan.register(CensorSink(output_path))
+        scan.run(zooniverse_csv_path)
 
     def parse_row(self, row):
         """
         Parses one row of the zooniverse csv, and extracts the parameters we are interested in.
         """
-        parsed_entries = []
-
         annotations = json.loads(row.annotations)
-        annotations = annotations[0]  # seems to always be a list of only one element
+        subject, images = self.get_subject(row)
+        return self.parse_decoded_row(row, annotations, subject, images)
 
-        subject_data = json.loads(row.subject_data)[str(row.subject_ids)]
+    def parse_decoded_row(self, row, annotations, subject, images):
+        """
+        Same as parse_row, for a row whose annotations and subject data have already been decoded.
+        """
+        parsed_entries = []
 
-        description = subject_data['description'] if 'description' in subject_data.keys() else ''
-        attribution = subject_data['attribution'] if 'attribution' in subject_data.keys() else ''
-        microscope = subject_data['microscope'] if 'microscope' in subject_data.keys() else ''
-        raw_z_res = subject_data['Raw Z resolution (nm)'] if 'Raw Z resolution (nm)' in subject_data.keys() else 5
-        raw_xy_res = subject_data['Raw XY resolution (nm)'] if 'Raw XY resolution (nm)' in subject_data.keys() else 5
-        jpeg_quality = subject_data['jpeg quality (%)'] if 'jpeg quality (%)' in subject_data.keys() else 100
-        scaling_factor = subject_data['Scaling factor'] if 'Scaling factor' in subject_data.keys() else 1
-        retired = "\"" + str(subject_data['retired']) + "\"" if 'retired' in subject_data.keys() else ''
-        subject_id = subject_data['Subject ID'] if 'Subject ID' in subject_data.keys() else 0
+        annotations = annotations[0]  # seems to always be a list of only one element
 
         # i.e. the 5 slices from the zooniverse classification screen
-        slices = self.slices_from_annotations(annotations, subject_data)
+        slices = self.slices_from_annotations(annotations, images)
 
         # NOTE: this is where to modify the code if we don't want to use the other 4 slices from the zooniverse screen
         for z_slice in slices.values():
@@ -113,13 +570,13 @@ class ZooniverseCSVParser:
                 'classification id': row.classification_id,
 
                 # from subject data
-                'raw xy resolution (nm)': raw_xy_res,
-                'raw z resolution (nm)': raw_z_res,
-                'microscope': microscope,
-                'jpeg quality (%)': jpeg_quality,
-                'attribution': attribution,
-                'subject id': subject_id,
-                'scaling factor': scaling_factor,
+                'raw xy resolution (nm)': subject['raw_xy_res'],
+                'raw z resolution (nm)': subject['raw_z_res'],
+                'microscope': subject['microscope'],
+                'jpeg quality (%)': subject['jpeg_quality'],
+                'attribution': subject['attribution'],
+                'subject id': subject['subject_id'],
+                'scaling factor': subject['scaling_factor'],
 
                 'ROI': slice_filename_parts[0],
                 'slice z': slice_filename_parts[1][:-4],
@@ -142,18 +599,28 @@ class ZooniverseCSVParser:
 
         return parsed_entries
 
+    def get_subject(self, row):
+        """
+        Returns the decoded subject metadata and images for a row. The same subject turns up in many rows, so decoded
+        subjects are kept in a least recently used cache keyed by subject id.
+        """
+        return self.subjects.get(row.subject_data, row.subject_ids)
+
     def write_parsed_entries(self, parsed_entries):
         for parsed_entry in parsed_entries:
-            filename = self.output_dir+parsed_entry['filename']+'.csv'
-            exists = os.path.exists(filename)
-            f = open(filename, 'a')
-            if not exists:
-                f.write(','.join(parsed_entry.keys()) + '\n')
+            header = ','.join(parsed_entry.keys()) + '\n'
             values = [str(entry) for entry in parsed_entry.values()]
-            f.write(','.join(values) + '\n')
-            f.close()
+            self.writers.write(parsed_entry['filename'], header, ','.join(values) + '\n')
+            self.changed_slices.add((parsed_entry['ROI'], parsed_entry['slice z'], parsed_entry['filename']))
+
+    def write_classification(self, row):
+        user_name = row.user_name if isinstance(row.user_name, str) else ''
+        values = [str(row.classification_id), "\"" + user_name.replace("\"", "\"\"") + "\"", str(row.subject_ids),
+                  str(row.expert is True)]
+        self.writers.write(CLASSIFICATIONS_FILENAME, 'classification id,user name,subject id,expert\n',
+                           ','.join(values) + '\n')
 
-    def slices_from_annotations(self, annotations, subject_data):
+    def slices_from_annotations(self, annotations, subject_images):
         """
         The annotations are a list of lists (rough idea being one inner list corresponds to one mitochondria).
 
@@ -169,13 +636,13 @@ class ZooniverseCSVParser:
                 points = []
                 for point in annotation['points']:
                     points.append((point['x'], point['y']))
-                if f'Image {frame}' in subject_data.keys():
+                if f'Image {frame}' in subject_images.keys():
                     if frame not in slices:
                         slices[frame] = dict()
                         slices[frame]['annotations'] = []
                     slices[frame]['tool'] = annotation['tool']
                     slices[frame]['tool_label'] = annotation['tool_label']
-                    slices[frame]['image'] = subject_data[f'Image {frame}']
+                    slices[frame]['image'] = subject_images[f'Image {frame}']
                     slices[frame]['annotations'].append(points)
                 else:
                     raise MissingRefImageError
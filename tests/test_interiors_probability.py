@@ -0,0 +1,179 @@
+"""
+Checks that get_closed_points joins strokes in to the same loops as the original implementation, which is kept here as
+reference_closed_points. The annotations are written in the processed csv format and parsed as the pipeline parses
+them, so that the points are float arrays as in aggregation.
+
+Run from the repository root with: python -m pytest tests
+"""
+import math
+import random
+
+import numpy as np
+import pytest
+
+from src.helpers import parse_annotation_points
+from src.interiors_probability import get_closed_points, get_endpoint_matches
+
+
+def reference_endpoint_matches(annotation):
+    # the endpoint matching of the original get_closed_points, unchanged
+    def get_distance(p1, p2):
+        return math.sqrt((p1[0] - p2[0])**2 + (p1[1] - p2[1])**2)
+
+    def encode_point(segmenti, dir):
+        s = str(segmenti)
+        if dir == -1:
+            s += "E"
+        else:
+            s += "S"
+        return s
+
+    segment_distances = []
+    final_segment_distances = []
+    pointdir_done = []
+    l = len(annotation)
+
+    for f in range(l):
+        for t in range(l):
+            for fdir in range(-1, 1):   # last, first element
+                for tdir in range(-1, 1):   # last, first element
+                    if f is not t or fdir is not tdir:
+                        segment_distances.append([f, fdir, t, tdir, get_distance(annotation[f][fdir], annotation[t][tdir])])
+
+    segment_distances = sorted(segment_distances, key=lambda x: x[-1])
+
+    for segment in segment_distances:
+        fpdir = encode_point(segment[0], segment[1])
+        tpdir = encode_point(segment[2], segment[3])
+        if fpdir not in pointdir_done and tpdir not in pointdir_done:
+            pointdir_done.append(fpdir)
+            pointdir_done.append(tpdir)
+            final_segment_distances.append(segment)
+    return final_segment_distances
+
+
+def reference_closed_points(annotation):
+    # the loop assembly of the original get_closed_points, unchanged
+    final_segment_distances = reference_endpoint_matches(annotation)
+    l = len(annotation)
+
+    dsegmenti_done = []
+    segmenti = -1
+    endsegmenti = -1
+    pointslists = []
+    points = []
+    while len(dsegmenti_done) != l:
+        if segmenti >= 0:
+            i = 0
+            for segment_distance in final_segment_distances:
+                if i not in dsegmenti_done:
+                    if segment_distance[0] == segmenti or segment_distance[2] == segmenti:
+                        dsegmenti = i
+                        dsegment = final_segment_distances[dsegmenti]
+                        if segment_distance[0] == segmenti:
+                            segmenti = segment_distance[2]
+                        else:
+                            segmenti = segment_distance[0]
+                        break
+                i += 1
+        else:
+            i = 0
+            for segment_distance in final_segment_distances:
+                if i not in dsegmenti_done:
+                    dsegmenti = i
+                    break
+                i += 1
+            dsegment = final_segment_distances[dsegmenti]
+            segmenti = dsegment[0]
+            endsegmenti = dsegment[2]
+
+        dsegmenti_done.append(dsegmenti)
+
+        segment = annotation[segmenti]
+        if dsegment[0] == segmenti:
+            if dsegment[1] == -1:
+                segment = segment[::-1]
+        else:
+            if dsegment[3] == -1:
+                segment = segment[::-1]
+        points.extend(segment)
+
+        if segmenti == endsegmenti:
+            # closed loop
+            segmenti = -1
+            endsegmenti = -1
+            pointslists.append(points)
+            points = []
+
+    return pointslists
+
+
+# annotations strings as they appear in the processed csv, one per case
+ANNOTATIONS = {
+    'single stroke': "[[(412.5, 233.25), (430.0, 240.75), (441.25, 262.0), (436.5, 288.0), (415.0, 301.5), "
+                     "(391.75, 290.0), (384.0, 262.5), (395.25, 239.0), (410.0, 234.5)]]",
+    'single point': "[[(250.0, 250.0)]]",
+    'two strokes': "[[(100.0, 80.5), (140.25, 92.0), (158.0, 130.75)], "
+                   "[(155.5, 134.0), (120.0, 160.25), (96.0, 120.0), (98.5, 84.0)]]",
+    'reversed fragments': "[[(300.0, 300.0), (340.0, 300.0)], [(300.0, 340.0), (300.0, 302.0)], "
+                          "[(342.0, 300.0), (340.0, 340.0), (302.0, 340.0)]]",
+    'with a single point stroke': "[[(10.0, 10.0), (50.0, 10.0), (50.0, 50.0)], [(50.0, 52.0)], "
+                                  "[(50.0, 54.0), (10.0, 54.0), (10.0, 12.0)]]",
+    'two nuclei': "[[(20.0, 20.0), (60.0, 20.0), (60.0, 60.0)], [(61.0, 61.0), (20.0, 60.0), (20.0, 21.0)], "
+                  "[(200.0, 200.0), (260.0, 200.0), (260.0, 260.0), (200.0, 260.0), (200.0, 201.0)]]",
+    # every gap is the same length, so the order the ties are broken in decides the loop
+    'equal gaps': "[[(0.0, 0.0), (9.0, 0.0)], [(10.0, 0.0), (10.0, 9.0)], [(10.0, 10.0), (1.0, 10.0)], "
+                  "[(0.0, 10.0), (0.0, 1.0)]]",
+    # the end of the first stroke is as close to the start of the second as to the start of the third
+    'equidistant endpoints': "[[(0.0, 5.0), (5.0, 5.0)], [(5.0, 8.0), (9.0, 8.0), (9.0, 1.0)], "
+                             "[(5.0, 2.0), (2.0, 2.0), (0.0, 4.0)]]",
+    # the end of the first stroke to the start of the second is as far as its start to the end of the second
+    'equidistant ends': "[[(0.0, 0.0), (10.0, 0.0)], [(10.0, 3.0), (5.0, 6.0), (0.0, 3.0)]]",
+    'coincident endpoints': "[[(0.0, 0.0), (4.0, 0.0)], [(4.0, 0.0), (4.0, 4.0)], [(4.0, 4.0), (0.0, 4.0)], "
+                            "[(0.0, 4.0), (0.0, 0.0)]]",
+}
+
+
+def fragmented_outline(rng, nstrokes, grid):
+    """
+    A closed outline around a circle, cut in to nstrokes strokes of randomly reversed direction, snapped to a grid of
+    the given spacing so that gaps are often the same length.
+    """
+    npoints = rng.randint(max(nstrokes, 3), 40)
+    angles = sorted(rng.uniform(0, 2 * math.pi) for _ in range(npoints))
+    radius = rng.uniform(5, 60)
+    points = [(round(radius * math.cos(a) / grid) * grid, round(radius * math.sin(a) / grid) * grid) for a in angles]
+    cuts = sorted(rng.sample(range(1, npoints), nstrokes - 1))
+    strokes = [points[i:j] for i, j in zip([0] + cuts, cuts + [npoints])]
+    strokes = [stroke[::-1] if rng.random() < 0.5 else stroke for stroke in strokes]
+    rng.shuffle(strokes)
+    return '[' + ', '.join('[' + ', '.join(f'({x:.1f}, {y:.1f})' for x, y in stroke) + ']'
+                           for stroke in strokes) + ']'
+
+
+def assert_same_loops(annotation):
+    matches = get_endpoint_matches(annotation)
+    assert matches == reference_endpoint_matches(annotation)
+
+    loops = get_closed_points(annotation)
+    reference_loops = reference_closed_points(annotation)
+    assert len(loops) == len(reference_loops)
+    for loop, reference_loop in zip(loops, reference_loops):
+        assert np.array_equal(np.array(loop), np.array(reference_loop))
+
+
+@pytest.mark.parametrize('name', sorted(ANNOTATIONS))
+def test_closed_points_match_reference(name):
+    assert_same_loops(parse_annotation_points(ANNOTATIONS[name]))
+
+
+def test_equal_gaps_break_ties_in_stroke_order():
+    matches = get_endpoint_matches(parse_annotation_points(ANNOTATIONS['equal gaps']))
+    assert [match[:4] for match in matches] == [[0, -1, 1, 0], [0, 0, 3, -1], [1, -1, 2, 0], [2, -1, 3, 0]]
+
+
+def test_fragmented_outlines_match_reference():
+    rng = random.Random(0)
+    for _ in range(300):
+        annotation = fragmented_outline(rng, rng.randint(1, 8), rng.choice([0.5, 1.0, 5.0]))
+        assert_same_loops(parse_annotation_points(annotation))